@@ -0,0 +1,185 @@
+"""
+Admission control in front of the method handlers: a cap on requests
+handled at once, a cap on the cost of a request and token bucket rate
+limits per account and login. The cost of a request is the number of
+clients or users it asks for, so a large clients_interests request
+takes as many tokens as that many small ones
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+TOO_MANY_REQUESTS = 429
+UNAVAILABLE = 503
+PAYLOAD_TOO_LARGE = 413
+
+
+def request_cost(body):
+    """
+    Number of clients or users of the request, at least 1
+    """
+    arguments = body.get("arguments")
+    if not isinstance(arguments, dict):
+        return 1
+    for name in ("client_ids", "users"):
+        items = arguments.get(name)
+        if isinstance(items, list):
+            return max(1, len(items))
+    return 1
+
+
+def limit_key(body):
+    return f"rl:{body.get('account') or ''}/{body.get('login')}"
+
+
+class RateLimiter:
+    """
+    Token buckets kept in process, rate tokens per second up to burst.
+    Buckets of max_keys recently seen keys are kept, the bucket of
+    an evicted key starts full
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # key: [tokens, time they were counted at]
+        self.buckets = OrderedDict()
+
+    def take(self, key, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                elapsed = now - bucket[1]
+                bucket[0] = min(self.burst, bucket[0] + elapsed * self.rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+
+class RedisRateLimiter:
+    """
+    Token buckets in Redis shared by the workers. The store is resolved
+    per call, so forked workers use their own connections. Requests are
+    let through while Redis is unavailable
+    """
+
+    def __init__(self, rate, burst, get_store):
+        self.rate = rate
+        self.burst = burst
+        self.get_store = get_store
+
+    def take(self, key, cost=1):
+        return self.get_store().take_tokens(key, self.rate, self.burst, cost)
+
+
+class Admission:
+    """
+    max_in_flight: requests handled at once, 0 - unlimited. The thread
+    pool server takes a slot per connection when it's accepted
+    max_cost: cost of a request, 0 - unlimited
+    limiter: RateLimiter, RedisRateLimiter or None
+    """
+
+    def __init__(self, max_in_flight=0, max_cost=0, limiter=None):
+        self.max_in_flight = max_in_flight
+        self.max_cost = max_cost
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def acquire(self):
+        """
+        Take a slot of the request, False if all slots are taken
+        """
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def check(self, body):
+        """
+        Error pair (response, code) if the request isn't admitted by its
+        cost or the rate limit, None otherwise. A request costing more
+        than the burst takes the whole bucket
+        """
+        cost = request_cost(body)
+        if self.max_cost and cost > self.max_cost:
+            message = f"Request cost {cost} exceeds {self.max_cost}"
+            return message, PAYLOAD_TOO_LARGE
+        if self.limiter is not None:
+            cost = min(cost, self.limiter.burst)
+            if not self.limiter.take(limit_key(body), cost):
+                return "Rate limit exceeded", TOO_MANY_REQUESTS
+        return None
+
+
+def make_admission(args, get_store=None):
+    """
+    Admission of the command line arguments, None if nothing is limited.
+    get_store: function returning the store of Redis token buckets
+    """
+    limiter = None
+    if args.rate_limit:
+        burst = args.rate_limit_burst or max(1, args.rate_limit)
+        if args.rate_limit_redis:
+            limiter = RedisRateLimiter(args.rate_limit, burst, get_store)
+        else:
+            limiter = RateLimiter(args.rate_limit, burst)
+    if not (args.max_in_flight or args.max_request_cost or limiter):
+        return None
+    return Admission(args.max_in_flight, args.max_request_cost, limiter)
+
+
+def add_admission_arguments(op):
+    op.add_argument(
+        "--max-in-flight",
+        action="store",
+        type=int,
+        default=0,
+        help="requests handled at once by a worker, others are rejected"
+        " with 503, 0 - unlimited; with --threads connections are counted"
+        " when they are accepted",
+    )
+    op.add_argument(
+        "--max-request-cost",
+        action="store",
+        type=int,
+        default=0,
+        help="max number of clients or users of a request, 0 - unlimited",
+    )
+    op.add_argument(
+        "--rate-limit",
+        action="store",
+        type=float,
+        default=0,
+        help="clients or users per second requested by an account and login,"
+        " 0 - unlimited",
+    )
+    op.add_argument(
+        "--rate-limit-burst",
+        action="store",
+        type=int,
+        help="size of the token bucket, the rate by default",
+    )
+    op.add_argument(
+        "--rate-limit-redis",
+        action="store_true",
+        help="keep token buckets in the Redis cache shared by workers,"
+        " per worker by default",
+    )
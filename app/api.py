@@ -2,17 +2,51 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import functools
 import hashlib
+import hmac
 import json
 import logging
+import os
 import re
+import signal
+import socket
+import threading
+import time
 import uuid
 from argparse import ArgumentParser  # from optparse import OptionParser
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
-from app.scoring import get_interests, get_score
-from app.store import RedisStore
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from app import deadline, log, profiling, scoring
+from app.admission import (
+    PAYLOAD_TOO_LARGE,
+    TOO_MANY_REQUESTS,
+    UNAVAILABLE,
+    add_admission_arguments,
+    make_admission,
+)
+from app.deadline import add_deadline_arguments
+from app.log import add_log_arguments, log_request_body
+from app.metrics import metrics
+from app.profiling import add_profiling_arguments, finish_timing, record, start_timing
+from app.snapshot import SnapshotStore
+from app.scoring import get_interests_many, get_score, get_scores_many
+from app.store import (
+    CODECS,
+    DeadlineExceeded,
+    LocalCache,
+    RedisStore,
+    ReplicatedRedisStore,
+    ShardedRedisStore,
+    get_codec,
+)
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -23,12 +57,17 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    PAYLOAD_TOO_LARGE: "Payload Too Large",
+    TOO_MANY_REQUESTS: "Too Many Requests",
+    UNAVAILABLE: "Service Unavailable",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
 UNKNOWN = 0
 MALE = 1
@@ -40,173 +79,258 @@ GENDERS = {
 }
 
 
+class StdlibJSON:
+    """
+    Codec of request and response bodies, parses bytes as they are read
+    """
+
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+
+class OrJSON(StdlibJSON):
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("orjson is not installed")
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers which don't fit 64 bits
+            return super().dumps(obj)
+
+
+JSON_CODECS = {"json": StdlibJSON, "orjson": OrJSON}
+json_codec = OrJSON() if orjson is not None else StdlibJSON()
+
+# clients_interests responses for more clients are streamed in chunks
+STREAM_THRESHOLD = 1000
+STREAM_CHUNK_SIZE = 500
+
+
+EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+PHONE_RE = re.compile(r"^7\d{10}$")
+
+
 class Field:
-    def __init__(self, value=None, required=True, nullable=False):
+    """
+    Description of a request field. check() doesn't change the field, it
+    returns True for a valid value, None for an empty value which is
+    allowed or an error message. Messages are built once per field
+    """
+
+    def __init__(self, required=True, nullable=False):
         self.field_name = self.__class__.__name__
-        self.value = value
         self.required = required
         self.nullable = nullable
-
-    def __get__(self, instance, owner):
-        return getattr(instance, "value", None)
-
-    def __set__(self, instance, value):
-        self.validate()
-        instance.value = value
-
-    def validate(self):
-        if self.required:
-            if self.value is None:
-                return False, f"{self.field_name} is required"
-        if not self.nullable and not self.value:
-            return False, f"{self.field_name} must not be nullable"
-        elif self.nullable and not self.value:
-            return None, OK
-        return True, OK
+        self.required_error = f"{self.field_name} is required"
+        self.empty_result = (
+            None if nullable else f"{self.field_name} must not be nullable"
+        )
+
+    def check(self, value):
+        if value is None and self.required:
+            return self.required_error
+        if not value:
+            return self.empty_result
+        return True
 
 
 class CharField(Field):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
-
-    def validate(self):
-        parent_result = super().validate()
-        if not parent_result[0]:
-            return parent_result[0], parent_result[1]
-        if not self.value or not isinstance(self.value, str):
-            return False, f"{self.field_name} must be a str"
-        return True, OK
+        self.type_error = f"{self.field_name} must be a str"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True:
+            return result
+        if not isinstance(value, str):
+            return self.type_error
+        return True
 
 
 class ArgumentsField(Field):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
-
-    def validate(self):
-        parent_result = super().validate()
-        if not parent_result[0]:
-            return parent_result[0], parent_result[1]
-        if not self.value or not isinstance(self.value, dict):
-            return False, f"{self.field_name} must be a dict"
-        return True, OK
+        self.type_error = f"{self.field_name} must be a dict"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True:
+            return result
+        if not isinstance(value, dict):
+            return self.type_error
+        return True
 
 
 class EmailField(CharField):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
-
-    def validate(self):
-        parent_result = super().validate()
-        if not parent_result[0]:
-            return parent_result[0], parent_result[1]
-        if not self.value or not re.match(r"[^@]+@[^@]+\.[^@]+", self.value):
-            return False, f"{self.field_name} must have appropriate email format"
-        return True, OK
+        self.format_error = f"{self.field_name} must have appropriate email format"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True:
+            return result
+        if not EMAIL_RE.match(value):
+            return self.format_error
+        return True
 
 
 class PhoneField(Field):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
+        self.format_error = f"{self.field_name} must have appropriate phone format"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True:
+            return result
+        if not PHONE_RE.match(str(value)):
+            return self.format_error
+        return True
 
-    def validate(self):
-        # self.value = str(self.value)
-        parent_result = super().validate()
-        if not parent_result[0]:
-            return parent_result[0], parent_result[1]
-        if not self.value or not re.match(r"^7\d{10}$", str(self.value)):
-            return False, f"{self.field_name} must have appropriate phone format"
-        return True, OK
+
+@functools.lru_cache(maxsize=4096)
+def is_valid_date(value):
+    try:
+        datetime.datetime.strptime(value, "%d.%m.%Y")
+    except ValueError:
+        return False
+    return True
 
 
 class DateField(Field):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
-
-    def validate(self):
-        parent_result = super().validate()
-        if not parent_result[0]:
-            return parent_result[0], parent_result[1]
-        if self.value:
-            try:
-                datetime.datetime.strptime(self.value, "%d.%m.%Y")
-                return True, OK
-            except ValueError:
-                return False, f"{self.field_name} must have appropriate date format"
-        return True, OK
+        self.format_error = f"{self.field_name} must have appropriate date format"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True:
+            return result
+        if not is_valid_date(value):
+            return self.format_error
+        return True
 
 
 class BirthDayField(DateField):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
-
-    def validate(self):
-        parent_result = super().validate()
-        return parent_result[0], parent_result[1]
+    pass
 
 
 class GenderField(Field):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
-
-    def validate(self):
-        parent_result = super().validate()
-        if not parent_result[0] and self.value != 0:
-            return parent_result[0], parent_result[1]
-        if self.value and self.value not in GENDERS:
-            return False, f"{self.field_name} must have value in (0, 1, 2)"
-        return True, OK
+        self.value_error = f"{self.field_name} must have value in (0, 1, 2)"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True and value != 0:
+            return result
+        if value and value not in GENDERS:
+            return self.value_error
+        return True
 
 
 class ClientIDsField(Field):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.field_name = self.__class__.__name__
-
-    def validate(self):
-        parent_result = super().validate()
-        if not parent_result[0]:
-            return parent_result[0], parent_result[1]
-        if not self.value or (
-            not isinstance(self.value, list)
-            or not all(isinstance(client_id, int) for client_id in self.value)
+        self.type_error = f"{self.field_name} must be a list with integer"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True:
+            return result
+        if not isinstance(value, list) or not all(
+            isinstance(client_id, int) for client_id in value
         ):
-            return False, f"{self.field_name} must be a list with integer"
-        return True, OK
+            return self.type_error
+        return True
+
+
+class ArgumentsListField(Field):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.type_error = f"{self.field_name} must be a list"
+
+    def check(self, value):
+        result = super().check(value)
+        if result is not True:
+            return result
+        if not isinstance(value, list):
+            return self.type_error
+        return True
 
 
-class RequestValidator:
-    def validate(self, request_instance, data):
-        is_fields_valid = {}
-        for field_name, field_instance in request_instance.__class__.__dict__.items():
-            if isinstance(field_instance, Field):
-                field_instance.value = data.get(field_name)
-                request_instance._fields[field_name] = field_instance.value
-                is_valid, error = field_instance.validate()
-                is_fields_valid[field_name] = is_valid, error
-        return is_fields_valid
+class RequestMeta(type):
+    """
+    Compiles fields declared by a request class into its schema when the
+    class is created. Values of the fields are kept in slots of request
+    instances, every field has a bit in the `valid` mask of the request.
+    `pairs` of field names are compiled into masks as well
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        fields = [
+            (key, value) for key, value in namespace.items() if isinstance(value, Field)
+        ]
+        for key, _ in fields:
+            del namespace[key]
+        namespace["__slots__"] = namespace.get("__slots__", ()) + tuple(
+            key for key, _ in fields
+        )
+        namespace["schema"] = tuple(
+            (key, field, 1 << i) for i, (key, field) in enumerate(fields)
+        )
+        bits = {key: bit for key, _, bit in namespace["schema"]}
+        namespace["pairs"] = tuple(
+            bits[first] | bits[second] for first, second in namespace.get("pairs", ())
+        )
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class RequestValidator(metaclass=RequestMeta):
+    __slots__ = ("valid",)
+
+    def clean(self, data):
+        """
+        Set fields from data. Returns the name and the error of the first
+        invalid field or None
+        """
+        valid, error = 0, None
+        for name, field, bit in self.schema:
+            value = data.get(name)
+            setattr(self, name, value)
+            result = field.check(value)
+            if result is True:
+                valid |= bit
+            elif result is not None and error is None:
+                error = name, result
+        self.valid = valid
+        return error
 
 
 class ClientsInterestsRequest(RequestValidator):
     client_ids = ClientIDsField(required=True)
     date = DateField(required=False, nullable=True)
 
-    def __init__(self):
-        self._fields = {}
-
     def validate(self, data):
-        is_fields_valid = super().validate(self, data)
-        for key, value in is_fields_valid.items():
-            is_valid, error = value
-            if is_valid == False:
-                logging.error(f"Invalid Field '{key}'- {error}")
-                return False
+        error = self.clean(data)
+        if error:
+            logging.error("Invalid Field '%s'- %s", *error)
+            return False
         return True
 
 
@@ -218,25 +342,29 @@ class OnlineScoreRequest(RequestValidator):
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
-    def __init__(self):
-        self._fields = {}
+    # at least one of the pairs must be valid
+    pairs = (("phone", "email"), ("first_name", "last_name"), ("gender", "birthday"))
 
     def validate(self, data):
-        is_field_valid = super().validate(self, data)
-        for key, value in is_field_valid.items():
-            is_valid, error = value
-            if is_valid == False:
-                logging.error(f"Invalid Field '{key}'- {error}")
-                return False
-        if (
-            (is_field_valid["phone"][0] and is_field_valid["email"][0])
-            or (is_field_valid["first_name"][0] and is_field_valid["last_name"][0])
-            or (is_field_valid["gender"][0] and is_field_valid["birthday"][0])
-        ):
-            return True
+        error = self.clean(data)
+        if error:
+            logging.error("Invalid Field '%s'- %s", *error)
+            return False
+        for mask in self.pairs:
+            if self.valid & mask == mask:
+                return True
+        return False
 
-        else:
+
+class BatchOnlineScoreRequest(RequestValidator):
+    users = ArgumentsListField(required=True)
+
+    def validate(self, data):
+        error = self.clean(data)
+        if error:
+            logging.error("Invalid Field '%s'- %s", *error)
             return False
+        return True
 
 
 class MethodRequest(RequestValidator):
@@ -246,124 +374,399 @@ class MethodRequest(RequestValidator):
     arguments = ArgumentsField(required=True, nullable=True)
     method = CharField(required=True, nullable=False)
 
-    def __init__(self):
-        self._fields = {}
-
     @property
     def is_admin(self):
-        return self._fields["login"] == ADMIN_LOGIN
+        return self.login == ADMIN_LOGIN
 
     def validate(self, data):
-        is_fields_valid = super().validate(self, data)
-        for key, value in is_fields_valid.items():
-            is_valid, error = value
-            if is_valid == False:
-                return False
-        return True
+        return self.clean(data) is None
+
+
+class AuthCache:
+    """
+    Bounded memo of verified (account, login, token) triples and
+    the admin digest of the current hour
+    """
+
+    def __init__(self, maxsize=4096):
+        # digests of users never change, so entries only get evicted
+        self.verified = LocalCache(maxsize, ttl=float("inf"))
+        self.admin = None, 0
+        self.admin_refreshes = 0
+
+    def get_admin_digest(self):
+        digest, expires = self.admin
+        if time.time() < expires:
+            return digest
+        hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        digest = hashlib.sha512(
+            bytes(hour.strftime("%Y%m%d%H") + ADMIN_SALT, "utf-8")
+        ).hexdigest()
+        expires = (hour + datetime.timedelta(hours=1)).timestamp()
+        self.admin = digest, expires
+        self.admin_refreshes += 1
+        return digest
+
+    def stats(self):
+        return dict(self.verified.stats(), admin_refreshes=self.admin_refreshes)
+
+
+auth_cache = AuthCache()
+metrics.gauge(
+    "auth_cache_hits_total", lambda counters: auth_cache.verified.hits, "counter"
+)
+metrics.gauge(
+    "auth_cache_misses_total", lambda counters: auth_cache.verified.misses, "counter"
+)
 
 
 def check_auth(request):
+    # empty tokens of other types pass validation as null ones
+    if not isinstance(request.token, str):
+        return False
     if request.is_admin:
-        digest = hashlib.sha512(
-            bytes(
-                datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT, "utf-8"
-            )  # ADMIN_SALT
-        ).hexdigest()
-    else:
-        digest = hashlib.sha512(
-            bytes(request._fields["account"] + request._fields["login"] + SALT, "utf-8")
-        ).hexdigest()
-    if digest == request._fields["token"]:
+        digest = auth_cache.get_admin_digest()
+        return hmac.compare_digest(
+            bytes(digest, "utf-8"), bytes(request.token, "utf-8")
+        )
+    key = request.account, request.login, request.token
+    if auth_cache.verified.get(key):
+        return True
+    digest = hashlib.sha512(
+        bytes(request.account + request.login + SALT, "utf-8")
+    ).hexdigest()
+    if hmac.compare_digest(bytes(digest, "utf-8"), bytes(request.token, "utf-8")):
+        auth_cache.verified.set(key, True)
         return True
     return False
 
 
-def method_handler(request, ctx, store):
-    validator = MethodRequest()
-    if not validator.validate(request["body"]):
-        code = INVALID_REQUEST
-        response = "Validation error: MethodRequest"
-        return response, code
-    if not check_auth(validator):
-        code = FORBIDDEN
-        response = "Forbidden"
-        return response, code
-    if not request["body"].get("method", False):
-        code = INVALID_REQUEST
-        response = "Method is not provided"
-        return response, code
-
-    if request["body"]["method"] == "online_score":
-        has = []
-        validator = OnlineScoreRequest()
-        if validator.validate(request["body"]["arguments"]):
-            score = get_score(store, **request["body"]["arguments"])
-            for key in request["body"]["arguments"].keys():
-                if request["body"]["arguments"][key] is not None:
-                    has.append(key)
-            ctx["has"] = has
-            response, code = {"score": score}, OK
+def check_online_score(arguments, ctx):
+    validator = OnlineScoreRequest()
+    if not validator.validate(arguments):
+        return "OnlineScoreRequest arguments error", INVALID_REQUEST
+    ctx["has"] = [key for key, value in arguments.items() if value is not None]
+    return None
+
+
+def check_clients_interests(arguments, ctx):
+    validator = ClientsInterestsRequest()
+    if not validator.validate(arguments):
+        return "ClientsInterestsRequest arguments error", INVALID_REQUEST
+    ctx["nclients"] = len(arguments["client_ids"])
+    return None
+
+
+def check_batch_online_score(arguments, ctx):
+    validator = BatchOnlineScoreRequest()
+    if not validator.validate(arguments):
+        return "BatchOnlineScoreRequest arguments error", INVALID_REQUEST
+    ctx["nusers"] = len(arguments["users"])
+    return None
+
+
+def split_users(users):
+    """
+    Every user of the batch is validated independently.
+    Returns valid users and results of the batch where invalid
+    users already have their errors
+    """
+    valid, results = [], []
+    for user in users:
+        if isinstance(user, dict) and OnlineScoreRequest().validate(user):
+            valid.append(user)
+            results.append(None)
         else:
-            code = INVALID_REQUEST
-            response = "OnlineScoreRequest arguments error"
-            return response, code
-
-    elif request["body"]["method"] == "clients_interests":
-        validator = ClientsInterestsRequest()
-        if validator.validate(request["body"]["arguments"]):
-            response = {}
-            for item in request["body"]["arguments"]["client_ids"]:
-                try:
-                    response[f"client{item}"] = get_interests(store, item)
-                    code = OK
-                    ctx["nclients"] = len(request["body"]["arguments"]["client_ids"])
-                except Exception:
-                    logging.exception("Could't connect to redis server")
-                    code = INTERNAL_ERROR
-                    response = "API can't connect to store"
-                    return response, code
-        else:
-            code = INVALID_REQUEST
-            response = "ClientsInterestsRequest arguments error"
-            return response, code
+            results.append({"error": "OnlineScoreRequest arguments error"})
+    return valid, results
 
-    else:
+
+def batch_response(results, scores):
+    scores = iter(scores)
+    return {"scores": [r or {"score": next(scores)} for r in results]}
+
+
+def online_score_handler(arguments, ctx, store, cache):
+    error = check_online_score(arguments, ctx)
+    if error:
+        return error
+    return {"score": get_score(cache, **arguments)}, OK
+
+
+def batch_online_score_handler(arguments, ctx, store, cache):
+    error = check_batch_online_score(arguments, ctx)
+    if error:
+        return error
+    users, results = split_users(arguments["users"])
+    return batch_response(results, get_scores_many(cache, users)), OK
+
+
+def clients_interests_handler(arguments, ctx, store, cache):
+    error = check_clients_interests(arguments, ctx)
+    if error:
+        return error
+    client_ids = arguments["client_ids"]
+    try:
+        if len(client_ids) > STREAM_THRESHOLD:
+            return InterestsStream(store, client_ids, ctx, STREAM_CHUNK_SIZE), OK
+        interests, errors = get_interests_many(store, client_ids)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        logging.exception("Could't connect to redis server")
+        return "API can't connect to store", INTERNAL_ERROR
+    return interests_response(client_ids, interests, errors, ctx), OK
+
+
+def interests_response(client_ids, interests, errors, ctx):
+    """
+    Clients which interests failed to be obtained get null value
+    and are reported in the context of the request
+    """
+    if errors:
+        errors = {f"client{cid}": error for cid, error in errors.items()}
+        ctx.setdefault("errors", {}).update(errors)
+        logging.error("Failed to obtain interests: %s", errors)
+    return {f"client{cid}": interests.get(cid) for cid in client_ids}
+
+
+class InterestsStream:
+    """
+    Response of clients_interests obtained from the store and written
+    chunk by chunk. The first chunk is obtained right away, so the request
+    still fails with an error if the store can't be reached
+    """
+
+    def __init__(self, store, client_ids, ctx, chunk_size):
+        self.store = store
+        self.ctx = ctx
+        client_ids = list(dict.fromkeys(client_ids))
+        self.chunks = []
+        for start in range(0, len(client_ids), chunk_size):
+            end = start + chunk_size
+            self.chunks.append(client_ids[start:end])
+        self.first = self.fetch(self.chunks[0])
+
+    def fetch(self, client_ids):
+        interests, errors = get_interests_many(self.store, client_ids)
+        return interests_response(client_ids, interests, errors, self.ctx)
+
+    def __iter__(self):
+        yield self.first
+        for client_ids in self.chunks[1:]:
+            yield self.fetch(client_ids)
+
+
+METHODS = {
+    "online_score": online_score_handler,
+    "clients_interests": clients_interests_handler,
+    "batch_online_score": batch_online_score_handler,
+}
+
+
+def check_method_request(body):
+    """
+    Validate the envelope of the request and authenticate it.
+    Returns an error pair (response, code) or None
+    """
+    start = time.perf_counter()
+    validator = MethodRequest()
+    valid = validator.validate(body)
+    record("validate", start)
+    if not valid:
+        return "Validation error: MethodRequest", INVALID_REQUEST
+    start = time.perf_counter()
+    authorized = check_auth(validator)
+    record("auth", start)
+    if not authorized:
+        return "Forbidden", FORBIDDEN
+    if not body.get("method", False):
+        return "Method is not provided", INVALID_REQUEST
+    if body["method"] not in METHODS:
         logging.error("Invalid method - Unsupported method was given")
-        code = INVALID_REQUEST
-        response = "Unsupported method was given"
-    return response, code
+        return "Unsupported method was given", INVALID_REQUEST
+    return None
+
+
+# admission control of method requests, None - everything is admitted
+admission = None
+
+
+def method_handler(request, ctx, store, cache=None):
+    """
+    Scores are cached in the cache, the store is used for it if
+    no separate cache is given
+    """
+    error = check_method_request(request["body"])
+    if error:
+        return error
+    if deadline.expired():
+        return "Deadline exceeded before the request was handled", GATEWAY_TIMEOUT
+    if admission is not None:
+        # after authentication, so buckets of others can't be drained
+        try:
+            error = admission.check(request["body"])
+        except DeadlineExceeded as e:
+            return str(e), GATEWAY_TIMEOUT
+        if error:
+            return error
+    handler = METHODS[request["body"]["method"]]
+    cache = store if cache is None else cache
+    start = time.perf_counter()
+    try:
+        return handler(request["body"]["arguments"], ctx, store, cache)
+    except DeadlineExceeded as e:
+        return str(e), GATEWAY_TIMEOUT
+    finally:
+        record("handler", start)
+
+
+def wrap_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def log_response(ctx, r):
+    """
+    Log the context of the request with the code of the response,
+    the response itself is logged only if it's an error
+    """
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    ctx["code"] = r["code"]
+    if "error" in r:
+        ctx["error"] = r["error"]
+    logging.info(ctx)
+
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def record_request(request, code, start):
+    """
+    Count the request and its latency by method and code,
+    methods outside METHODS are counted as unknown
+    """
+    method = request.get("method") if isinstance(request, dict) else None
+    if method not in METHODS:
+        method = "unknown"
+    labels = (("method", method), ("code", str(code)))
+    metrics.inc("api_requests_total", labels)
+    elapsed = time.perf_counter() - start
+    metrics.observe("api_request_duration_seconds", labels, elapsed)
+
+
+def make_store(nodes=None, replicas=None, **kwargs):
+    """
+    Store of the Redis node, keys are sharded if several nodes are given.
+    Reads of a single node are made from its replicas if there are any.
+    nodes, replicas: lists of (host, port) pairs
+    """
+    if nodes and len(nodes) > 1:
+        return ShardedRedisStore(nodes, **kwargs)
+    host, port = nodes[0] if nodes else ("localhost", 6379)
+    if replicas:
+        return ReplicatedRedisStore(replicas, host=host, port=port, **kwargs)
+    return RedisStore(host=host, port=port, **kwargs)
+
+
+def redis_address(value):
+    """
+    (host, port) of a host:port argument
+    """
+    host, _, port = value.rpartition(":")
+    return host or "localhost", int(port)
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {"method": method_handler}
-    store = RedisStore(host="localhost")
+    store = make_store()
+    # store of cached scores, None - the store is used
+    cache = None
+    # persistent connections: seconds a connection may stay idle
+    # and number of requests served over it before it is closed
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+    max_requests = 100
+    # headers and body are separate writes, with Nagle's algorithm the body
+    # of a response on a persistent connection waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
 
     def get_request_id(self, headers):
         return headers.get("HTTP_X_REQUEST_ID", uuid.uuid4().hex)
 
+    def do_GET(self):
+        self.requests_handled += 1
+        if self.path.strip("/") != "metrics":
+            self.send_json(wrap_response({}, NOT_FOUND), NOT_FOUND, True)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(OK)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_response_headers(True)
+        self.wfile.write(body)
+
     def do_POST(self):
+        # connections of the thread pool are admitted when they are accepted
+        if admission is None or isinstance(self.server, ThreadPoolHTTPServer):
+            self.handle_post()
+        elif not admission.acquire():
+            self.reject_busy()
+        else:
+            try:
+                self.handle_post()
+            finally:
+                admission.release()
+
+    def reject_busy(self):
+        # the body isn't read, so the connection is closed
+        start = time.perf_counter()
+        r = wrap_response("Server is busy", UNAVAILABLE)
+        self.send_json(r, UNAVAILABLE, False)
+        record_request(None, UNAVAILABLE, start)
+
+    def handle_post(self):
+        start = time.perf_counter()
+        start_timing(self.headers)
+        deadline.start(self.headers)
         response, code = {}, HTTPStatus.OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
+        body_read = False
+        self.requests_handled += 1
         try:
-            data_string = self.rfile.read(int(self.headers["Content-Length"])).decode(
-                "utf-8"
-            )
-            request = json.loads(data_string)
+            length = int(self.headers["Content-Length"])
+            if length < 0:
+                raise ValueError(f"Invalid Content-Length: {length}")
+            data = self.rfile.read(length)
+            body_read = True
+            record("read", start)
+            parse_start = time.perf_counter()
+            request = json_codec.loads(data)
+            record("parse", parse_start)
         except Exception as e:
             logging.error(f"Bad request: {e}")
             code = BAD_REQUEST
 
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            log_request_body(self.path, data, context["request_id"])
             if path in self.router:
                 try:
                     response, code = self.router[path](
-                        {"body": request, "headers": self.headers}, context, self.store
+                        {"body": request, "headers": self.headers},
+                        context,
+                        self.store,
+                        self.cache,
                     )
                 except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
+                    logging.exception("Unexpected error: %s", e)
                     code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
@@ -371,37 +774,444 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             logging.exception("Exception: Empty request was given")
             code = INVALID_REQUEST
 
+        if isinstance(response, InterestsStream):
+            # chunks are fetched while the stream is written, so the request
+            # is logged with errors of all of them once it's written
+            r = {"code": code}
+            try:
+                if not self.write_stream(response, body_read):
+                    r["error"] = "Response is truncated"
+            finally:
+                finish_timing(context, start)
+                log_response(context, r)
+                record_request(request, code, start)
+            return
+        r = wrap_response(response, code)
+        serialize_start = time.perf_counter()
+        body = json_codec.dumps(r)
+        record("serialize", serialize_start)
+        finish_timing(context, start)
+        log_response(context, r)
+        self.send_body(body, code, body_read)
+        record_request(request, code, start)
+        return
+
+    def send_json(self, r, code, body_read):
+        self.send_body(json_codec.dumps(r), code, body_read)
+
+    def send_body(self, body, code, body_read):
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_response_headers(body_read)
+        self.wfile.write(body)
+
+    def end_response_headers(self, body_read):
+        # unread body would be taken for the next request
+        if not body_read or self.requests_handled >= self.max_requests:
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+
+    def write_stream(self, stream, body_read):
+        """
+        Write the response envelope around chunks of the stream, with
+        chunked transfer encoding for HTTP/1.1 clients. False if the stream
+        failed and the response is truncated
+        """
+        chunked = self.request_version == "HTTP/1.1"
+        self.send_response(OK)
+        self.send_header("Content-Type", "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode("utf-8"))
-        return
+            self.close_connection = True
+        self.end_response_headers(body_read)
+        write = self.write_chunk if chunked else self.wfile.write
+        # formatting of the envelope is the same as the codec uses
+        head = json_codec.dumps({"response": {}})[:-2]
+        tail = json_codec.dumps({"response": {}, "code": OK}).removeprefix(head)
+        item_separator = json_codec.dumps([0, 0])[2:-2]
+        write(head)
+        separator = b""
+        try:
+            for response in stream:
+                write(separator + json_codec.dumps(response)[1:-1])
+                separator = item_separator
+        except Exception:
+            # the client gets a truncated response
+            logging.exception("Could't stream response")
+            self.close_connection = True
+            return False
+        write(tail)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        return True
 
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
 
-if __name__ == "__main__":
-    op = ArgumentParser()
-    op.add_argument("-p", "--port", action="store", type=int, default=8080)
-    op.add_argument("-l", "--log", action="store", default="./logs")
-    args = op.parse_args()
 
-    logging.basicConfig(
-        filename=args.log,
-        level=logging.INFO,
-        format="[%(asctime)s] %(levelname).1s %(message)s",
-        datefmt="%Y.%m.%d %H:%M:%S",
-    )
+class SerialHTTPHandler(MainHTTPHandler):
+    """
+    Handler of the serial server, which can't wait for the next request
+    of an idle client, so connections are closed after a request
+    """
+
+    max_requests = 1
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTP server which handles connections in a bounded pool of threads
+    """
+
+    # seconds a rejected connection is drained before it's closed
+    linger = 2
 
-    server = HTTPServer(("localhost", args.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % args.port)
+    def __init__(self, server_address, handler_class, threads=8):
+        super().__init__(server_address, handler_class)
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        # rejected connections with the time they are closed at
+        self.rejected = []
+
+    def process_request_thread(self, request, client_address, control=None):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            if control is not None:
+                control.release()
+
+    def process_request(self, request, client_address):
+        # a connection takes a slot of admission until it's closed, so
+        # connections beyond the cap are rejected right away instead of
+        # waiting in the queue of the executor for a thread
+        control = admission
+        if control is not None and not control.acquire():
+            self.reject_busy(request)
+            return
+        self.executor.submit(
+            self.process_request_thread, request, client_address, control
+        )
+
+    def reject_busy(self, request):
+        start = time.perf_counter()
+        body = json_codec.dumps(wrap_response("Server is busy", UNAVAILABLE))
+        head = (
+            f"HTTP/1.1 {UNAVAILABLE} {HTTPStatus(UNAVAILABLE).phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            request.sendall(head.encode("latin-1") + body)
+            request.shutdown(socket.SHUT_WR)
+            request.setblocking(False)
+        except OSError:
+            request.close()
+        else:
+            self.rejected.append((request, time.monotonic() + self.linger))
+        record_request(None, UNAVAILABLE, start)
+
+    def service_actions(self):
+        """
+        Close rejected connections once the rest of their requests is read,
+        closing them with unread data would reset them before clients read
+        the response
+        """
+        now = time.monotonic()
+        lingering = []
+        for request, until in self.rejected:
+            try:
+                while request.recv(65536):
+                    pass
+                done = True
+            except BlockingIOError:
+                done = now >= until
+            except OSError:
+                done = True
+            if done:
+                request.close()
+            else:
+                lingering.append((request, until))
+        self.rejected = lingering
+
+    def server_close(self):
+        super().server_close()
+        # let requests which are already accepted finish
+        self.executor.shutdown(wait=True)
+        for request, _ in self.rejected:
+            request.close()
+        self.rejected = []
+
+
+def make_server(port, threads=0):
+    if threads:
+        return ThreadPoolHTTPServer(("localhost", port), MainHTTPHandler, threads)
+    return HTTPServer(("localhost", port), SerialHTTPHandler)
+
+
+def serve_worker(server, store_factory, cache_factory=None):
+    """
+    Serve requests in a forked worker until SIGTERM is received
+    """
+    MainHTTPHandler.store = store_factory()
+    MainHTTPHandler.cache = cache_factory() if cache_factory else None
+    # shutdown() blocks until serve_forever() returns, so it can't be
+    # called from the signal handler running in the serving thread
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: threading.Thread(target=server.shutdown).start(),
+    )
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
     try:
-        print("server is ready")
         server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def serve_prefork(server, workers, store_factory, cache_factory=None):
+    """
+    Fork workers which share the listening socket of the server
+    """
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve_worker(server, store_factory, cache_factory)
+            except Exception:
+                logging.exception("Worker %s failed" % os.getpid())
+                code = 1
+            finally:
+                # records of the last requests are still queued
+                try:
+                    log.stop_logging()
+                finally:
+                    os._exit(code)
+        children.append(pid)
+    logging.info("Started workers: %s" % children)
+
+    def stop(signum=None, frame=None):
+        signal_children(signal.SIGTERM)
+
+    def signal_children(signum, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    if profiling.profiler:
+        # workers inherited the profiler, the master has nothing to profile
+        signal.signal(profiling.PROFILE_SIGNAL, signal_children)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
     except KeyboardInterrupt:
-        pass
+        stop()
+        for pid in children:
+            os.waitpid(pid, 0)
     server.server_close()
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("-p", "--port", action="store", type=int, default=8080)
+    op.add_argument("-l", "--log", action="store", default="./logs")
+    op.add_argument(
+        "--redis",
+        action="append",
+        type=redis_address,
+        help="host:port of a Redis node, keys are sharded over several nodes",
+    )
+    op.add_argument(
+        "--redis-replica",
+        action="append",
+        type=redis_address,
+        help="host:port of a replica of the Redis node to read interests from",
+    )
+    op.add_argument(
+        "--cache-redis",
+        action="append",
+        type=redis_address,
+        help="host:port of a Redis node caching scores, the store by default",
+    )
+    op.add_argument(
+        "--snapshot",
+        action="store",
+        help="snapshot file built by app.snapshot to serve interests from,"
+        " Redis is used for scores only",
+    )
+    op.add_argument(
+        "--snapshot-check-interval",
+        action="store",
+        type=float,
+        default=5,
+        help="seconds between checks of the snapshot file for a new snapshot",
+    )
+    op.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=1,
+        help="number of pre-forked worker processes",
+    )
+    op.add_argument(
+        "-t",
+        "--threads",
+        action="store",
+        type=int,
+        default=0,
+        help="size of the thread pool of every worker, 0 - handle serially",
+    )
+    op.add_argument(
+        "--local-cache-size",
+        action="store",
+        type=int,
+        default=0,
+        help="max number of Redis values kept in process, 0 - disabled",
+    )
+    op.add_argument(
+        "--local-cache-ttl",
+        action="store",
+        type=int,
+        default=60,
+        help="seconds a value is kept in process, capped by its Redis TTL",
+    )
+    op.add_argument(
+        "--keepalive-timeout",
+        action="store",
+        type=float,
+        default=15,
+        help="seconds an idle persistent connection is kept open",
+    )
+    op.add_argument(
+        "--max-keepalive-requests",
+        action="store",
+        type=int,
+        default=100,
+        help="requests served over a persistent connection before closing it",
+    )
+    op.add_argument(
+        "--stream-threshold",
+        action="store",
+        type=int,
+        default=STREAM_THRESHOLD,
+        help="clients_interests responses for more clients are streamed",
+    )
+    op.add_argument(
+        "--stream-chunk-size",
+        action="store",
+        type=int,
+        default=STREAM_CHUNK_SIZE,
+        help="clients obtained from the store per chunk of a stream",
+    )
+    op.add_argument(
+        "--json",
+        choices=sorted(JSON_CODECS),
+        default=json_codec.name,
+        help="codec of request and response bodies",
+    )
+    op.add_argument(
+        "--store-codec",
+        choices=sorted(CODECS),
+        default="json",
+        help="codec of interests in the store, as written by app.migrate",
+    )
+    op.add_argument(
+        "--score-lock-timeout",
+        action="store",
+        type=float,
+        default=0,
+        help="seconds workers wait for a score computed by another worker,"
+        " 0 - concurrent requests are coalesced within a worker only",
+    )
+    op.add_argument(
+        "--score-ttl",
+        action="store",
+        type=int,
+        default=scoring.SCORE_TTL,
+        help="seconds scores are kept in cache",
+    )
+    op.add_argument(
+        "--score-soft-ttl",
+        action="store",
+        type=int,
+        default=scoring.SCORE_SOFT_TTL,
+        help="age in seconds of cached scores which are refreshed in background"
+        " when requested, 0 - no refresh",
+    )
+    add_log_arguments(op)
+    add_profiling_arguments(op)
+    add_admission_arguments(op)
+    add_deadline_arguments(op)
+    args = op.parse_args()
+    if args.redis_replica and args.redis and len(args.redis) > 1:
+        op.error("replicas of several Redis nodes aren't supported")
+    json_codec = JSON_CODECS[args.json]()
+    STREAM_THRESHOLD = args.stream_threshold
+    STREAM_CHUNK_SIZE = args.stream_chunk_size
+
+    log.BODY_SAMPLE_RATE = args.log_body_sample_rate
+    log.BODY_MAX_SIZE = args.log_body_max_size
+    log_writer = log.setup_logging(args.log, fmt=args.log_format)
+    profiling.TIMING_SAMPLE_RATE = args.timing_sample_rate
+    deadline.REQUEST_TIMEOUT = args.request_timeout
+    deadline.MAX_TIMEOUT = args.max_request_timeout
+    if args.profile_dir:
+        profiling.install(
+            args.profile_dir, args.profile_interval, args.profile_duration
+        )
+    admission = make_admission(
+        args, lambda: MainHTTPHandler.cache or MainHTTPHandler.store
+    )
+    scoring.SCORE_TTL = args.score_ttl
+    scoring.SCORE_SOFT_TTL = args.score_soft_ttl
+    if args.score_lock_timeout:
+        scoring.score_flight = scoring.RedisSingleFlight(args.score_lock_timeout)
+
+    store_factory = functools.partial(
+        make_store,
+        args.redis,
+        args.redis_replica,
+        local_cache_size=args.local_cache_size,
+        local_cache_ttl=args.local_cache_ttl,
+        codec=get_codec(args.store_codec),
+    )
+    cache_factory = None
+    if args.cache_redis or args.snapshot:
+        cache_factory = functools.partial(
+            make_store,
+            args.cache_redis or args.redis,
+            local_cache_size=args.local_cache_size,
+            local_cache_ttl=args.local_cache_ttl,
+        )
+        MainHTTPHandler.cache = cache_factory()
+    if args.snapshot:
+        store_factory = functools.partial(
+            SnapshotStore, args.snapshot, args.snapshot_check_interval
+        )
+    MainHTTPHandler.store = store_factory()
+    MainHTTPHandler.timeout = args.keepalive_timeout
+    MainHTTPHandler.max_requests = args.max_keepalive_requests
+    server = make_server(args.port, args.threads)
+    logging.info("Starting server at %s", args.port)
+    print("server is ready")
+    if args.workers > 1:
+        serve_prefork(server, args.workers, store_factory, cache_factory)
+    else:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    log_writer.stop()
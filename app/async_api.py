@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import uuid
+from argparse import ArgumentParser
+
+from aiohttp import web
+
+from app import api, deadline, log, profiling
+from app.api import (
+    BAD_REQUEST,
+    GATEWAY_TIMEOUT,
+    INTERNAL_ERROR,
+    INVALID_REQUEST,
+    NOT_FOUND,
+    OK,
+    UNAVAILABLE,
+    batch_response,
+    check_batch_online_score,
+    check_clients_interests,
+    check_method_request,
+    check_online_score,
+    interests_response,
+    log_response,
+    record_request,
+    split_users,
+    wrap_response,
+)
+from app.admission import add_admission_arguments, make_admission
+from app.deadline import add_deadline_arguments
+from app.log import add_log_arguments, log_request_body
+from app.metrics import metrics
+from app.profiling import (
+    add_profiling_arguments,
+    finish_timing,
+    record,
+    start_timing,
+)
+from app.scoring import (
+    async_get_interests_many,
+    async_get_score,
+    async_get_scores_many,
+)
+from app.store import (
+    CODECS,
+    AsyncRedisStore,
+    DeadlineExceeded,
+    AsyncReplicatedRedisStore,
+    AsyncShardedRedisStore,
+    get_codec,
+)
+
+
+async def online_score_handler(arguments, ctx, store, cache):
+    error = check_online_score(arguments, ctx)
+    if error:
+        return error
+    return {"score": await async_get_score(cache, **arguments)}, OK
+
+
+async def batch_online_score_handler(arguments, ctx, store, cache):
+    error = check_batch_online_score(arguments, ctx)
+    if error:
+        return error
+    users, results = split_users(arguments["users"])
+    scores = await async_get_scores_many(cache, users)
+    return batch_response(results, scores), OK
+
+
+async def clients_interests_handler(arguments, ctx, store, cache):
+    error = check_clients_interests(arguments, ctx)
+    if error:
+        return error
+    client_ids = arguments["client_ids"]
+    try:
+        interests, errors = await async_get_interests_many(store, client_ids)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        logging.exception("Could't connect to redis server")
+        return "API can't connect to store", INTERNAL_ERROR
+    return interests_response(client_ids, interests, errors, ctx), OK
+
+
+METHODS = {
+    "online_score": online_score_handler,
+    "clients_interests": clients_interests_handler,
+    "batch_online_score": batch_online_score_handler,
+}
+
+
+async def method_handler(request, ctx, store, cache=None):
+    error = check_method_request(request["body"])
+    if error:
+        return error
+    if deadline.expired():
+        return "Deadline exceeded before the request was handled", GATEWAY_TIMEOUT
+    if api.admission is not None:
+        error = api.admission.check(request["body"])
+        if error:
+            return error
+    handler = METHODS[request["body"]["method"]]
+    cache = store if cache is None else cache
+    start = time.perf_counter()
+    try:
+        return await handler(request["body"]["arguments"], ctx, store, cache)
+    except DeadlineExceeded as e:
+        return str(e), GATEWAY_TIMEOUT
+    finally:
+        record("handler", start)
+
+
+class MainHandler:
+    """
+    aiohttp counterpart of app.api.MainHTTPHandler
+    """
+
+    router = {"method": method_handler}
+
+    def __init__(self, store, cache=None):
+        self.store = store
+        self.cache = cache
+
+    def get_request_id(self, headers):
+        return headers.get("HTTP_X_REQUEST_ID", uuid.uuid4().hex)
+
+    async def get_metrics(self, http_request):
+        return web.Response(
+            body=metrics.render().encode("utf-8"),
+            headers={"Content-Type": api.METRICS_CONTENT_TYPE},
+        )
+
+    async def post(self, http_request):
+        admission = api.admission
+        if admission is None:
+            return await self.handle_post(http_request)
+        if not admission.acquire():
+            start = time.perf_counter()
+            r = wrap_response("Server is busy", UNAVAILABLE)
+            record_request(None, UNAVAILABLE, start)
+            return web.json_response(r, status=UNAVAILABLE)
+        try:
+            return await self.handle_post(http_request)
+        finally:
+            admission.release()
+
+    async def handle_post(self, http_request):
+        start = time.perf_counter()
+        start_timing(http_request.headers)
+        deadline.start(http_request.headers)
+        response, code = {}, OK
+        context = {"request_id": self.get_request_id(http_request.headers)}
+        request = None
+        try:
+            data = await http_request.read()
+            record("read", start)
+            parse_start = time.perf_counter()
+            request = api.json_codec.loads(data)
+            record("parse", parse_start)
+        except Exception as e:
+            logging.error(f"Bad request: {e}")
+            code = BAD_REQUEST
+
+        if request:
+            path = http_request.path.strip("/")
+            log_request_body(http_request.path, data, context["request_id"])
+            if path in self.router:
+                try:
+                    response, code = await self.router[path](
+                        {"body": request, "headers": http_request.headers},
+                        context,
+                        self.store,
+                        self.cache,
+                    )
+                except Exception as e:
+                    logging.exception("Unexpected error: %s", e)
+                    code = INTERNAL_ERROR
+            else:
+                code = NOT_FOUND
+        else:
+            logging.exception("Exception: Empty request was given")
+            code = INVALID_REQUEST
+
+        r = wrap_response(response, code)
+        serialize_start = time.perf_counter()
+        body = api.json_codec.dumps(r)
+        record("serialize", serialize_start)
+        finish_timing(context, start)
+        log_response(context, r)
+        record_request(request, code, start)
+        return web.Response(body=body, status=code, content_type="application/json")
+
+
+def make_store(nodes=None, replicas=None, **kwargs):
+    """
+    app.api.make_store() counterpart for asyncio stores
+    """
+    if nodes and len(nodes) > 1:
+        return AsyncShardedRedisStore(nodes, **kwargs)
+    host, port = nodes[0] if nodes else ("localhost", 6379)
+    if replicas:
+        return AsyncReplicatedRedisStore(replicas, host=host, port=port, **kwargs)
+    return AsyncRedisStore(host=host, port=port, **kwargs)
+
+
+def make_app(store, cache=None):
+    handler = MainHandler(store, cache)
+
+    async def close_store(app):
+        await store.close()
+        if cache is not None:
+            await cache.close()
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler.get_metrics)
+    app.router.add_post("/{path:.*}", handler.post)
+    app.on_cleanup.append(close_store)
+    return app
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("-p", "--port", action="store", type=int, default=8080)
+    op.add_argument("-l", "--log", action="store", default="./logs")
+    op.add_argument(
+        "--redis",
+        action="append",
+        type=api.redis_address,
+        help="host:port of a Redis node, keys are sharded over several nodes",
+    )
+    op.add_argument(
+        "--redis-replica",
+        action="append",
+        type=api.redis_address,
+        help="host:port of a replica of the Redis node to read interests from",
+    )
+    op.add_argument(
+        "--cache-redis",
+        action="append",
+        type=api.redis_address,
+        help="host:port of a Redis node caching scores, the store by default",
+    )
+    op.add_argument(
+        "--json",
+        choices=sorted(api.JSON_CODECS),
+        default=api.json_codec.name,
+        help="codec of request and response bodies",
+    )
+    op.add_argument(
+        "--store-codec",
+        choices=sorted(CODECS),
+        default="json",
+        help="codec of interests in the store, as written by app.migrate",
+    )
+    add_log_arguments(op)
+    add_profiling_arguments(op)
+    add_admission_arguments(op)
+    add_deadline_arguments(op)
+    args = op.parse_args()
+    if args.redis_replica and args.redis and len(args.redis) > 1:
+        op.error("replicas of several Redis nodes aren't supported")
+    if args.rate_limit_redis:
+        op.error(
+            "--rate-limit-redis is for workers of app.api, this server is one process"
+        )
+    api.admission = make_admission(args)
+    api.json_codec = api.JSON_CODECS[args.json]()
+
+    log.BODY_SAMPLE_RATE = args.log_body_sample_rate
+    log.BODY_MAX_SIZE = args.log_body_max_size
+    log_writer = log.setup_logging(args.log, fmt=args.log_format)
+    profiling.TIMING_SAMPLE_RATE = args.timing_sample_rate
+    deadline.REQUEST_TIMEOUT = args.request_timeout
+    deadline.MAX_TIMEOUT = args.max_request_timeout
+    if args.profile_dir:
+        profiling.install(
+            args.profile_dir, args.profile_interval, args.profile_duration
+        )
+
+    logging.info("Starting async server at %s", args.port)
+    print("server is ready")
+    store = make_store(
+        args.redis, args.redis_replica, codec=get_codec(args.store_codec)
+    )
+    cache = make_store(args.cache_redis) if args.cache_redis else None
+    web.run_app(
+        make_app(store, cache),
+        host="localhost",
+        port=args.port,
+        print=None,
+    )
+    log_writer.stop()
@@ -0,0 +1,69 @@
+"""
+Deadlines of requests. The deadline of the request being handled is
+kept in a context variable, so the store calls made for it trim their
+retries to the time left without the deadline being an argument of
+every store method. Threads of sharded calls run in the context of the
+request, background refreshes run without a deadline
+"""
+
+import contextvars
+import time
+
+TIMEOUT_HEADER = "X-Request-Timeout"
+# seconds a request may take, the header may set up to MAX_TIMEOUT
+REQUEST_TIMEOUT = 5.0
+MAX_TIMEOUT = 30.0
+
+# time.monotonic() deadline of the current request, None - no deadline
+current = contextvars.ContextVar("deadline", default=None)
+
+
+def start(headers):
+    """
+    Set the deadline of the request of the headers and return it,
+    a header which isn't a positive number is ignored
+    """
+    timeout = REQUEST_TIMEOUT
+    value = headers.get(TIMEOUT_HEADER)
+    if value:
+        try:
+            requested = float(value)
+        except ValueError:
+            requested = 0
+        if requested > 0:
+            timeout = min(requested, MAX_TIMEOUT)
+    deadline = time.monotonic() + timeout if timeout > 0 else None
+    current.set(deadline)
+    return deadline
+
+
+def remaining():
+    """
+    Seconds left until the deadline of the request, None if it has none
+    """
+    deadline = current.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def add_deadline_arguments(op):
+    op.add_argument(
+        "--request-timeout",
+        action="store",
+        type=float,
+        default=REQUEST_TIMEOUT,
+        help="seconds a request may take, 504 after them, 0 - no deadline",
+    )
+    op.add_argument(
+        "--max-request-timeout",
+        action="store",
+        type=float,
+        default=MAX_TIMEOUT,
+        help=f"max seconds a request may ask for with {TIMEOUT_HEADER}",
+    )
@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = "[%(asctime)s] %(levelname).1s %(message)s"
+DATE_FORMAT = "%Y.%m.%d %H:%M:%S"
+
+# share of request bodies which are logged and max logged bytes of a body
+BODY_SAMPLE_RATE = 1.0
+BODY_MAX_SIZE = 1024
+
+# writer of the process started by setup_logging()
+writer = None
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line. Keys of dict messages become keys
+    of the object, other messages are put under "message"
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+        }
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        # the traceback was rendered by the thread which logged it
+        if record.exc_text and record.exc_text not in line:
+            line = f"{line}\n{record.exc_text}"
+        return line
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    Puts records into the queue as they are. Messages are formatted by
+    the writer thread, only tracebacks are rendered right away, so frames
+    aren't kept alive in the queue. Dict messages are copied, as the
+    caller may go on changing them, like the context of a request
+    """
+
+    def prepare(self, record):
+        if isinstance(record.msg, dict):
+            record.msg = {
+                key: dict(value) if isinstance(value, dict) else value
+                for key, value in record.msg.items()
+            }
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogWriter:
+    """
+    Background thread writing records which request threads put into
+    a queue. Forked processes get a writer of their own
+    """
+
+    def __init__(self, handler, level):
+        self.handler = handler
+        self.level = level
+        self.listener = None
+        self.start()
+        os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        records = queue.SimpleQueue()
+        root = logging.getLogger()
+        root.handlers = [AsyncQueueHandler(records)]
+        root.setLevel(self.level)
+        self.listener = QueueListener(records, self.handler)
+        self.listener.start()
+
+    def stop(self):
+        """
+        Write records which are still queued
+        """
+        self.listener.stop()
+        self.handler.flush()
+
+
+def setup_logging(filename=None, level=logging.INFO, fmt="text"):
+    global writer
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    if fmt == "json":
+        handler.setFormatter(JSONFormatter(datefmt=DATE_FORMAT))
+    else:
+        handler.setFormatter(TextFormatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+    writer = LogWriter(handler, level)
+    return writer
+
+
+def stop_logging():
+    """
+    Write records still queued by this process, forked workers leave
+    with os._exit() which doesn't run exit handlers
+    """
+    if writer is not None:
+        writer.stop()
+
+
+def log_request_body(path, data, request_id):
+    """
+    Log a sample of request bodies truncated to BODY_MAX_SIZE bytes
+    """
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    if BODY_SAMPLE_RATE < 1 and random.random() >= BODY_SAMPLE_RATE:
+        return
+    body = data[:BODY_MAX_SIZE].decode("utf-8", "replace")
+    if len(data) > BODY_MAX_SIZE:
+        body += f"... ({len(data)} bytes)"
+    logging.info({"path": path, "body": body, "request_id": request_id})
+
+
+def add_log_arguments(op):
+    op.add_argument(
+        "--log-format",
+        choices=("text", "json"),
+        default="text",
+        help="format of log lines, json - one JSON object per line",
+    )
+    op.add_argument(
+        "--log-body-sample-rate",
+        action="store",
+        type=float,
+        default=BODY_SAMPLE_RATE,
+        help="share of request bodies which are logged",
+    )
+    op.add_argument(
+        "--log-body-max-size",
+        action="store",
+        type=int,
+        default=BODY_MAX_SIZE,
+        help="max logged bytes of a request body",
+    )
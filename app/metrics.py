@@ -0,0 +1,178 @@
+"""
+Counters and histograms of the process in Prometheus text format.
+Every thread records into its own shard, so recording takes no lock;
+shards are summed when metrics are rendered
+"""
+
+import bisect
+import os
+import threading
+
+# upper bounds of latency buckets in seconds
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+
+HELP = {
+    "api_requests_total": "Requests by method and response code",
+    "api_request_duration_seconds": "Time to handle a request",
+    "redis_call_duration_seconds": "Time of a Redis call including retries",
+    "redis_retries_total": "Retries of Redis calls",
+    "redis_failures_total": "Redis calls failed after retries",
+    "score_cache_requests_total": "Score lookups by cache result",
+    "score_cache_hit_ratio": "Share of score lookups served from cache",
+    "circuit_breaker_state": "State of a circuit breaker:"
+    " 0 closed, 1 half-open, 2 open",
+    "circuit_breaker_rejected_total": "Calls rejected by a circuit breaker",
+    "local_cache_hits_total": "Lookups served by the in-process cache",
+    "local_cache_misses_total": "Lookups missed by the in-process cache",
+    "local_cache_size": "Entries of the in-process cache",
+    "auth_cache_hits_total": "Tokens found in the memo of verified tokens",
+    "auth_cache_misses_total": "Tokens missing in the memo of verified tokens",
+}
+
+
+class Shard:
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = {}
+        # bucket counts, the last one is +Inf, followed by sum and count
+        self.histograms = {}
+
+
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        # name: function of the collected counters and type of the metric
+        self.gauges = {}
+        os.register_at_fork(after_in_child=self.reset)
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def reset(self):
+        with self.lock:
+            self.local = threading.local()
+            self.shards = []
+
+    def inc(self, name, labels=(), value=1):
+        """
+        labels: tuple of (name, value) pairs
+        """
+        counters = self.shard().counters
+        key = name, labels
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self.shard().histograms
+        key = name, labels
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 3)
+        histogram[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def gauge(self, name, fn, kind="gauge"):
+        """
+        Metric read when metrics are rendered. fn takes the collected
+        counters and returns the value or a list of (labels, value) pairs,
+        kind: "gauge" or "counter" for totals kept by other objects
+        """
+        self.gauges[name] = fn, kind
+
+    def collect(self):
+        """
+        Counters and histograms summed over the shards
+        """
+        counters, histograms = {}, {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in list(shard.histograms.items()):
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = list(histogram)
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, histogram)]
+        return counters, histograms
+
+    def render(self):
+        counters, histograms = self.collect()
+        lines = []
+        for name, samples in group(counters).items():
+            describe(lines, name, "counter")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, samples in group(histograms).items():
+            describe(lines, name, "histogram")
+            for labels, histogram in samples:
+                cumulative = 0
+                bounds = [str(b) for b in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram):
+                    cumulative += count
+                    bucket_labels = format_labels(labels + (("le", bound),))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                suffix = format_labels(labels)
+                lines.append(f"{name}_sum{suffix} {histogram[-2]}")
+                lines.append(f"{name}_count{suffix} {histogram[-1]}")
+        for name, (fn, kind) in self.gauges.items():
+            describe(lines, name, kind)
+            value = fn(counters)
+            if not isinstance(value, list):
+                value = [((), value)]
+            for labels, sample in value:
+                lines.append(f"{name}{format_labels(labels)} {sample}")
+        return "\n".join(lines) + "\n"
+
+
+def group(samples):
+    grouped = {}
+    for (name, labels), value in sorted(samples.items()):
+        grouped.setdefault(name, []).append((labels, value))
+    return grouped
+
+
+def describe(lines, name, kind):
+    if name in HELP:
+        lines.append(f"# HELP {name} {HELP[name]}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+metrics = Metrics()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rewrite stored client interests (i:<cid> keys) into another codec
+
+    python -m app.migrate --port 6379 --codec json
+"""
+
+import logging
+from argparse import ArgumentParser
+
+import redis
+
+from app.store import CODECS, LiteralCodec
+
+
+def migrate(connection, codec, pattern="i:*", batch=1000, dry_run=False):
+    """
+    Re-encode values of keys matching the pattern with the codec.
+    Values which the codec already decodes are left as is.
+    Returns counts of migrated, skipped and failed keys
+    """
+    legacy = LiteralCodec()
+    stats = {"migrated": 0, "skipped": 0, "failed": 0}
+    keys = []
+    for key in connection.scan_iter(match=pattern, count=batch, _type="string"):
+        keys.append(key)
+        if len(keys) >= batch:
+            migrate_batch(connection, codec, legacy, keys, stats, dry_run)
+            keys = []
+    if keys:
+        migrate_batch(connection, codec, legacy, keys, stats, dry_run)
+    return stats
+
+
+def migrate_batch(connection, codec, legacy, keys, stats, dry_run):
+    values = connection.mget(keys)
+    pipe = connection.pipeline(transaction=False)
+    for key, value in zip(keys, values):
+        if value is None:
+            continue
+        try:
+            codec.decode(value)
+            stats["skipped"] += 1
+            continue
+        except Exception:
+            pass
+        try:
+            data = codec.encode(legacy.decode(value))
+        except Exception as e:
+            logging.error(f"Couldn't migrate {key!r}: {e}")
+            stats["failed"] += 1
+            continue
+        pipe.set(key, data, keepttl=True)
+        stats["migrated"] += 1
+    if not dry_run:
+        pipe.execute()
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("--host", action="store", default="localhost")
+    op.add_argument("-p", "--port", action="store", type=int, default=6379)
+    op.add_argument("--codec", choices=sorted(CODECS), default="json")
+    op.add_argument("--pattern", action="store", default="i:*")
+    op.add_argument("--batch", action="store", type=int, default=1000)
+    op.add_argument("--dry-run", action="store_true")
+    args = op.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt="%Y.%m.%d %H:%M:%S",
+    )
+
+    stats = migrate(
+        redis.StrictRedis(host=args.host, port=args.port),
+        CODECS[args.codec](),
+        args.pattern,
+        args.batch,
+        args.dry_run,
+    )
+    logging.info(f"Migration to {args.codec} finished: {stats}")
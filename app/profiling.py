@@ -0,0 +1,199 @@
+"""
+Opt-in timing of the phases of requests and a sampling profiler
+started at runtime by a signal
+
+Timings of a request are recorded when it has the X-Timing: 1 header
+or is sampled with TIMING_SAMPLE_RATE. They are kept in the timings
+context variable, so the store adds Redis time without knowing the
+request, and logged as ctx["timings"] in milliseconds.
+
+    kill -USR2 <pid>  # start sampling stacks, again - stop and dump
+
+Stacks are written in collapsed format ("outer;inner count" lines),
+ready for flamegraph.pl or speedscope
+"""
+
+import contextvars
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+TIMING_HEADER = "X-Timing"
+# share of requests timed without the header
+TIMING_SAMPLE_RATE = 0.0
+PROFILE_SIGNAL = signal.SIGUSR2
+
+timings = contextvars.ContextVar("timings", default=None)
+# profiler toggled by PROFILE_SIGNAL, set by install()
+profiler = None
+
+
+def start_timing(headers):
+    """
+    Begin timing of the request if it's asked for or sampled,
+    timings of the previous request of the context are dropped
+    """
+    if headers.get(TIMING_HEADER) == "1" or (
+        TIMING_SAMPLE_RATE and random.random() < TIMING_SAMPLE_RATE
+    ):
+        timings.set({})
+    else:
+        timings.set(None)
+
+
+def record(phase, start):
+    """
+    Add the time since start (time.perf_counter()) to the phase
+    """
+    current = timings.get()
+    if current is not None:
+        current[phase] = current.get(phase, 0) + time.perf_counter() - start
+
+
+def add(phase, elapsed):
+    current = timings.get()
+    if current is not None:
+        current[phase] = current.get(phase, 0) + elapsed
+
+
+def finish_timing(ctx, start):
+    """
+    Put timings of the request in ms with the total since start into ctx.
+    Tasks spawned by the request may still add to the recorded dict,
+    so ctx gets a copy
+    """
+    current = timings.get()
+    if current is None:
+        return
+    timings.set(None)
+    current["total"] = time.perf_counter() - start
+    ctx["timings"] = {name: round(s * 1000, 3) for name, s in current.items()}
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of all threads every interval seconds until stopped
+    or for duration seconds and writes the counts of stacks into
+    directory/profile-<pid>-<time>.txt
+    """
+
+    def __init__(self, directory=".", interval=0.005, duration=60):
+        self.directory = directory
+        self.interval = interval
+        self.duration = duration
+        self.thread = None
+        self.stopped = threading.Event()
+        self.stacks = {}
+
+    @property
+    def running(self):
+        # the sampling thread doesn't exist in a forked child
+        return self.thread is not None and self.thread.is_alive()
+
+    def toggle(self, signum=None, frame=None):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        self.stopped = threading.Event()
+        self.stacks = {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        logging.info("Profiling of %s started", os.getpid())
+
+    def stop(self):
+        """
+        Stop sampling, the thread writes the profile. Doesn't wait for it,
+        it's called from the signal handler
+        """
+        self.stopped.set()
+
+    def run(self):
+        deadline = time.monotonic() + self.duration
+        while not self.stopped.wait(self.interval):
+            if time.monotonic() >= deadline:
+                break
+            self.sample()
+        try:
+            path = self.dump()
+        except OSError as e:
+            logging.error("Couldn't write profile: %s", e)
+            return
+        logging.info("Profile of %s is written to %s", os.getpid(), path)
+
+    def sample(self):
+        own = threading.get_ident()
+        stacks = self.stacks
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own:
+                stack = collapse(frame)
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+    def dump(self):
+        name = f"profile-{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}.txt"
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def install(directory=".", interval=0.005, duration=60):
+    """
+    Toggle a sampling profiler with PROFILE_SIGNAL, the handler is
+    inherited by forked workers
+    """
+    global profiler
+    profiler = SamplingProfiler(directory, interval, duration)
+    signal.signal(PROFILE_SIGNAL, profiler.toggle)
+    return profiler
+
+
+def add_profiling_arguments(op):
+    op.add_argument(
+        "--timing-sample-rate",
+        action="store",
+        type=float,
+        default=TIMING_SAMPLE_RATE,
+        help="share of requests with timings of phases logged, requests"
+        f" with the {TIMING_HEADER}: 1 header are always timed",
+    )
+    op.add_argument(
+        "--profile-dir",
+        action="store",
+        help="enable the sampling profiler toggled by SIGUSR2,"
+        " profiles are written into the directory",
+    )
+    op.add_argument(
+        "--profile-interval",
+        action="store",
+        type=float,
+        default=0.005,
+        help="seconds between samples of stacks",
+    )
+    op.add_argument(
+        "--profile-duration",
+        action="store",
+        type=float,
+        default=60,
+        help="seconds of profiling if it isn't stopped by the signal",
+    )
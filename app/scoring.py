@@ -1,14 +1,40 @@
+import asyncio
+import contextvars
+import csv
 import datetime
+import functools
 import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
 
-def get_score(
-    store,
+from app import deadline
+from app.metrics import metrics
+from app.store import DEADLINE_EXCEEDED, DeadlineExceeded
+
+SCORE_COLUMNS = (
+    "phone",
+    "email",
+    "birthday",
+    "gender",
+    "first_name",
+    "last_name",
+)
+
+
+def get_score_key(
     phone=None,
-    email=None,
     birthday=None,
-    gender=None,
     first_name=None,
     last_name=None,
 ):
@@ -20,10 +46,18 @@ def get_score(
         if birthday is not None
         else "",
     ]
-    key = "uid:" + hashlib.md5(bytes("".join(key_parts), "utf-8")).hexdigest()
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score.decode("utf-8"))
+    return "uid:" + hashlib.md5(bytes("".join(key_parts), "utf-8")).hexdigest()
+
+
+def compute_score(
+    phone=None,
+    email=None,
+    birthday=None,
+    gender=None,
+    first_name=None,
+    last_name=None,
+):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -32,19 +66,535 @@ def get_score(
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
+    return score
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share the result of the first one
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, store=None):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            # the leader's call is bounded by its own deadline only
+            try:
+                return future.result(timeout=deadline.remaining())
+            except FutureTimeoutError:
+                raise DeadlineExceeded(DEADLINE_EXCEEDED) from None
+        try:
+            future.set_result(self.call(key, fn, store))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+            # the leader was interrupted, waiting callers give up too
+            if not future.done():
+                future.cancel()
+        return future.result()
+
+    def call(self, key, fn, store):
+        return fn()
+
+
+class RedisSingleFlight(SingleFlight):
+    """
+    SingleFlight across processes sharing the cache. The process holding
+    a lock of the key in the store computes the value, others wait for it
+    to appear in the cache up to lock_timeout seconds
+    """
+
+    def __init__(self, lock_timeout=1, poll_interval=0.01, load=None):
+        super().__init__()
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.load = load or decode_score
+
+    def call(self, key, fn, store):
+        lock = "lock:" + key
+        token = store.cache_lock(lock, self.lock_timeout)
+        if token is None:
+            wait = self.lock_timeout
+            left = deadline.remaining()
+            if left is not None:
+                wait = min(wait, left)
+            wait_until = time.monotonic() + wait
+            while time.monotonic() < wait_until:
+                time.sleep(self.poll_interval)
+                value = store.cache_get(key)
+                if value is not None:
+                    return self.load(value)
+            # the holder of the lock failed to populate the cache
+            return fn()
+        try:
+            return fn()
+        finally:
+            store.cache_unlock(lock, token)
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines of one event loop
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        future = self.calls.get(key)
+        if future is not None:
+            try:
+                shielded = asyncio.shield(future)
+                return await asyncio.wait_for(shielded, deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(DEADLINE_EXCEEDED) from None
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            future.set_result(await fn())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            del self.calls[key]
+            if not future.done():
+                future.cancel()
+        return future.result()
+
+
+class Refresher:
+    """
+    Runs refreshes of stale cached values in a background thread,
+    one at a time per key
+    """
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.executor = None
+        self.pid = None
+
+    def submit(self, key, fn):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            # threads of the executor don't survive a fork
+            if self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(self.max_workers)
+                self.pid = os.getpid()
+        self.executor.submit(self.run, key, fn)
+
+    def run(self, key, fn):
+        try:
+            fn()
+        except Exception:
+            logging.exception("Couldn't refresh %s", key)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+score_flight = SingleFlight()
+async_score_flight = AsyncSingleFlight()
+score_refresher = Refresher()
+# refreshes scheduled by async_get_score()
+refresh_tasks = set()
+
+# scores are kept in cache for SCORE_TTL seconds and refreshed in
+# background when they are requested after SCORE_SOFT_TTL seconds,
+# 0 - no refresh
+SCORE_TTL = 60 * 60
+SCORE_SOFT_TTL = 50 * 60
+
+
+def encode_score(score):
+    """
+    Cached value of the score with the time it should be refreshed at
+    """
+    if not SCORE_SOFT_TTL:
+        return score
+    return b"%r;%d" % (score, time.time() + SCORE_SOFT_TTL)
+
+
+def parse_score(value):
+    """
+    Score and the time it should be refreshed at, None for values
+    cached without it
+    """
+    score, _, refresh_at = value.partition(b";")
+    # compute_score() returns int 0 when nothing is filled, so a cached
+    # zero is answered the same as a computed one
+    return float(score) or 0, int(refresh_at) if refresh_at else None
+
+
+def decode_score(value):
+    return parse_score(value)[0]
+
+
+def is_stale(refresh_at):
+    return refresh_at is not None and refresh_at <= time.time()
+
+
+# labels of score_cache_requests_total
+HIT = (("result", "hit"),)
+STALE = (("result", "stale"),)
+MISS = (("result", "miss"),)
+
+
+def score_cache_hit_ratio(counters):
+    """
+    Share of lookups served from cache, stale scores included
+    """
+    name = "score_cache_requests_total"
+    hits = counters.get((name, HIT), 0) + counters.get((name, STALE), 0)
+    total = hits + counters.get((name, MISS), 0)
+    return hits / total if total else 0.0
+
+
+metrics.gauge("score_cache_hit_ratio", score_cache_hit_ratio)
+
+
+def get_score(
+    store,
+    phone=None,
+    email=None,
+    birthday=None,
+    gender=None,
+    first_name=None,
+    last_name=None,
+):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    fill = functools.partial(
+        fill_score,
+        store,
+        key,
+        phone,
+        email,
+        birthday,
+        gender,
+        first_name,
+        last_name,
+    )
+    cached = store.cache_get(key)
+    if cached is not None:
+        score, refresh_at = parse_score(cached)
+        if is_stale(refresh_at):
+            metrics.inc("score_cache_requests_total", STALE)
+            score_refresher.submit(key, fill)
+        else:
+            metrics.inc("score_cache_requests_total", HIT)
+        return score
+    metrics.inc("score_cache_requests_total", MISS)
+    # concurrent misses of the key compute and cache the score once
+    return score_flight.do(key, fill, store)
+
+
+def fill_score(store, key, *args):
+    score = compute_score(*args)
     try:
-        store.cache_set(key, score, 60 * 60)
+        store.cache_set(key, encode_score(score), SCORE_TTL)
     except Exception:
         logging.exception("Could't connect to redis server to set new value")
     return score
 
 
+def get_scores_many(store, users):
+    """
+    Scores of several users obtained with one cache lookup and
+    missing or stale ones cached with one write.
+    users: list of keyword arguments of get_score()
+    """
+    keys = [get_user_score_key(user) for user in users]
+    scores, missing = collect_scores(users, keys, store.cache_get_many(keys))
+    if missing:
+        try:
+            store.cache_set_many(missing, SCORE_TTL)
+        except Exception:
+            logging.exception("Could't connect to redis server to set values")
+    return scores
+
+
+def get_user_score_key(user):
+    return get_score_key(
+        user.get("phone"),
+        user.get("birthday"),
+        user.get("first_name"),
+        user.get("last_name"),
+    )
+
+
+def collect_scores(users, keys, cached):
+    """
+    Scores of users and mapping of keys to cached values of scores
+    missing in cache or stale
+    """
+    scores, missing = [], {}
+    hits = stale = 0
+    for user, key, value in zip(users, keys, cached):
+        if value is not None:
+            score, refresh_at = parse_score(value)
+            if not is_stale(refresh_at):
+                hits += 1
+                scores.append(score)
+                continue
+            stale += 1
+        score = compute_score(
+            user.get("phone"),
+            user.get("email"),
+            user.get("birthday"),
+            user.get("gender"),
+            user.get("first_name"),
+            user.get("last_name"),
+        )
+        scores.append(score)
+        missing[key] = encode_score(score)
+    count_lookups(hits, stale, len(scores) - hits - stale)
+    return scores, missing
+
+
+def count_lookups(hits, stale, misses):
+    for labels, value in ((HIT, hits), (STALE, stale), (MISS, misses)):
+        if value:
+            metrics.inc("score_cache_requests_total", labels, value)
+
+
 def get_interests(store, cid):
     """
     Function was modified by simplification of type of stored data
     """
-    r = store.get("i:%s" % cid)
+    return decode_interests(store.get("i:%s" % cid), store.codec)
+
+
+def get_interests_many(store, cids):
+    """
+    Obtain interests of several clients in one round trip.
+    Returns interests and errors of the clients keyed by client id
+    """
+    values = store.get_many(["i:%s" % cid for cid in cids])
+    return decode_interests_many(cids, values, store.codec)
+
+
+def decode_interests_many(cids, values, codec):
+    interests, errors = {}, {}
+    for cid, r in zip(cids, values):
+        if isinstance(r, Exception):
+            errors[cid] = str(r)
+            continue
+        try:
+            interests[cid] = decode_interests(r, codec)
+        except Exception as e:
+            errors[cid] = f"Malformed interests: {e}"
+    return interests, errors
+
+
+def decode_interests(r, codec):
     if r and isinstance(r, bytes):
-        r = eval(r.decode("utf-8"))
+        r = codec.decode(r)
     return r
+
+
+async def async_get_score(
+    store,
+    phone=None,
+    email=None,
+    birthday=None,
+    gender=None,
+    first_name=None,
+    last_name=None,
+):
+    """
+    get_score() counterpart for AsyncRedisStore
+    """
+    key = get_score_key(phone, birthday, first_name, last_name)
+    fill = functools.partial(
+        async_fill_score,
+        store,
+        key,
+        phone,
+        email,
+        birthday,
+        gender,
+        first_name,
+        last_name,
+    )
+    cached = await store.cache_get(key)
+    if cached is not None:
+        score, refresh_at = parse_score(cached)
+        if is_stale(refresh_at):
+            metrics.inc("score_cache_requests_total", STALE)
+            # concurrent refreshes of the key are coalesced, the refresh
+            # outlives the request, so it runs without its deadline
+            task = contextvars.Context().run(
+                asyncio.create_task, async_score_flight.do(key, fill)
+            )
+            refresh_tasks.add(task)
+            task.add_done_callback(refresh_tasks.discard)
+        else:
+            metrics.inc("score_cache_requests_total", HIT)
+        return score
+    metrics.inc("score_cache_requests_total", MISS)
+    return await async_score_flight.do(key, fill)
+
+
+async def async_fill_score(store, key, *args):
+    score = compute_score(*args)
+    try:
+        await store.cache_set(key, encode_score(score), SCORE_TTL)
+    except Exception:
+        logging.exception("Could't connect to redis server to set new value")
+    return score
+
+
+async def async_get_scores_many(store, users):
+    """
+    get_scores_many() counterpart for AsyncRedisStore
+    """
+    keys = [get_user_score_key(user) for user in users]
+    cached = await store.cache_get_many(keys)
+    scores, missing = collect_scores(users, keys, cached)
+    if missing:
+        try:
+            await store.cache_set_many(missing, SCORE_TTL)
+        except Exception:
+            logging.exception("Could't connect to redis server to set values")
+    return scores
+
+
+async def async_get_interests(store, cid):
+    """
+    get_interests() counterpart for AsyncRedisStore
+    """
+    return decode_interests(await store.get("i:%s" % cid), store.codec)
+
+
+async def async_get_interests_many(store, cids):
+    """
+    get_interests_many() counterpart for AsyncRedisStore
+    """
+    values = await store.get_many(["i:%s" % cid for cid in cids])
+    return decode_interests_many(cids, values, store.codec)
+
+
+@functools.lru_cache(maxsize=65536)
+def birthday_key(birthday):
+    return datetime.datetime.strptime(birthday, "%d.%m.%Y").strftime("%Y%m%d")
+
+
+def score_columns(columns):
+    """
+    get_score() without cache for columnar input.
+    columns: mapping of argument names of get_score() to sequences
+    (lists or NumPy arrays) of equal length, missing columns are None.
+    Returns uid: keys and scores of the rows equal to get_score() ones
+    """
+    size = len(next(iter(columns.values())))
+    columns = {
+        name: columns[name] if name in columns else [None] * size
+        for name in SCORE_COLUMNS
+    }
+    md5 = hashlib.md5
+    keys = [
+        "uid:"
+        + md5(
+            bytes(
+                "%s%s%s%s"
+                % (
+                    first_name or "",
+                    last_name or "",
+                    phone,
+                    "" if birthday is None else birthday_key(birthday),
+                ),
+                "utf-8",
+            )
+        ).hexdigest()
+        for phone, birthday, first_name, last_name in zip(
+            columns["phone"],
+            columns["birthday"],
+            columns["first_name"],
+            columns["last_name"],
+        )
+    ]
+    if np is None:
+        scores = [
+            compute_score(*row)
+            for row in zip(*(columns[name] for name in SCORE_COLUMNS))
+        ]
+    else:
+        scores = compute_scores(**columns).tolist()
+    # get_score() returns int 0 when nothing is filled
+    return keys, [score or 0 for score in scores]
+
+
+def compute_scores(phone, email, birthday, gender, first_name, last_name):
+    """
+    compute_score() for NumPy arrays
+    """
+
+    def filled(column):
+        return np.asarray(column, dtype=object).astype(bool)
+
+    return (
+        1.5 * filled(phone)
+        + 1.5 * filled(email)
+        + 1.5 * (filled(birthday) & filled(gender))
+        + 0.5 * (filled(first_name) & filled(last_name))
+    )
+
+
+def score_chunks(chunks, processes=1):
+    """
+    Score columnar chunks, in a pool of processes if processes > 1.
+    Yields keys and scores of every chunk in order
+    """
+    if processes <= 1:
+        yield from map(score_columns, chunks)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap(score_columns, chunks)
+
+
+def read_jsonl(fp, chunk_size=10000):
+    """
+    Chunks of columns from lines with arguments of get_score()
+    """
+    rows = (json.loads(line) for line in fp if line.strip())
+    return to_columns(rows, chunk_size)
+
+
+def read_csv(fp, chunk_size=10000):
+    """
+    Chunks of columns from CSV with header of get_score() arguments.
+    Empty cells are missing values
+    """
+
+    def convert(row):
+        row = {name: value or None for name, value in row.items()}
+        if row.get("gender") is not None:
+            row["gender"] = int(row["gender"])
+        return row
+
+    return to_columns(map(convert, csv.DictReader(fp)), chunk_size)
+
+
+def to_columns(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield rows_to_columns(chunk)
+            chunk = []
+    if chunk:
+        yield rows_to_columns(chunk)
+
+
+def rows_to_columns(rows):
+    return {name: [row.get(name) for row in rows] for name in SCORE_COLUMNS}
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Read-only snapshot of client interests (i:<cid> keys) served from
+a memory-mapped file instead of Redis
+
+    python -m app.snapshot --port 6379 --output interests.snap
+
+Layout of the file, little-endian:
+    header: magic, codec name, number of slots, number of entries
+    slots: (hash, offset) pairs of an open addressing hash table,
+        offset 0 is an empty slot
+    entries: key length, value length, key, value
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+import redis
+
+from app.store import CODECS, StoreError, get_codec
+
+MAGIC = b"PDPSNAP1"
+HEADER = struct.Struct("<8s8sQQ")
+SLOT = struct.Struct("<QQ")
+ENTRY = struct.Struct("<HI")
+
+
+def hash_key(key):
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def build_snapshot(items, path, codec_name="json"):
+    """
+    Write (key, value) pairs into a snapshot file. Values are stored
+    encoded with the codec. The file is replaced atomically, so stores
+    reading the previous snapshot switch to the new one on reload.
+    Returns the number of entries
+    """
+    codec = CODECS[codec_name]()
+    entries = {}
+    for key, value in items:
+        entries[key.encode("utf-8")] = codec.encode(value)
+    nslots = 8
+    while nslots < 2 * len(entries):
+        nslots *= 2
+    mask = nslots - 1
+    table = [(0, 0)] * nslots
+    offset = HEADER.size + nslots * SLOT.size
+    for key, value in entries.items():
+        h = hash_key(key)
+        i = h & mask
+        while table[i][1]:
+            i = (i + 1) & mask
+        table[i] = h, offset
+        offset += ENTRY.size + len(key) + len(value)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        # readable by servers running as other users like any data file
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            name = codec_name.encode("ascii")
+            f.write(HEADER.pack(MAGIC, name, nslots, len(entries)))
+            f.write(b"".join(SLOT.pack(h, offset) for h, offset in table))
+            for key, value in entries.items():
+                f.write(ENTRY.pack(len(key), len(value)))
+                f.write(key)
+                f.write(value)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(entries)
+
+
+class Snapshot:
+    """
+    Memory-mapped snapshot file. Pages are shared by the processes
+    which map the same file
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, name, self.nslots, self.size = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise StoreError(f"{path} isn't a snapshot")
+        self.codec = CODECS[name.rstrip(b"\0").decode("ascii")]()
+
+    def get(self, key):
+        key = key.encode("utf-8")
+        data = self.data
+        h = hash_key(key)
+        mask = self.nslots - 1
+        i = h & mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(data, HEADER.size + i * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h:
+                key_size, value_size = ENTRY.unpack_from(data, offset)
+                start = offset + ENTRY.size
+                end = start + key_size
+                if data[start:end] == key:
+                    start = end + value_size
+                    return data[end:start]
+            i = (i + 1) & mask
+
+
+class SnapshotStore:
+    """
+    Store of interests with the get() interface of RedisStore backed by
+    a snapshot file. The file is checked for a new snapshot every
+    check_interval seconds, 0 - only on reload()
+    """
+
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.snapshot = Snapshot(path)
+        self.next_check = time.monotonic() + check_interval
+
+    @property
+    def codec(self):
+        return self.snapshot.codec
+
+    def reload(self):
+        """
+        Switch to the snapshot currently at the path if it was replaced.
+        Lookups in progress finish with the previous one
+        """
+        with self.lock:
+            stat = os.stat(self.path)
+            current = self.snapshot.stat
+            if (stat.st_ino, stat.st_mtime_ns) == (current.st_ino, current.st_mtime_ns):
+                return False
+            self.snapshot = Snapshot(self.path)
+        logging.info("Loaded snapshot %s of %s keys", self.path, self.snapshot.size)
+        return True
+
+    def check(self):
+        if not self.check_interval or time.monotonic() < self.next_check:
+            return
+        self.next_check = time.monotonic() + self.check_interval
+        try:
+            self.reload()
+        except Exception as e:
+            logging.warning(f"Couldn't reload snapshot {self.path}: {e}")
+
+    def get(self, key):
+        self.check()
+        return self.snapshot.get(key)
+
+    def get_many(self, keys):
+        self.check()
+        snapshot = self.snapshot
+        return [snapshot.get(key) for key in keys]
+
+
+def dump_redis(connection, pattern="i:*", batch=1000, codec=None):
+    """
+    Decoded values of keys matching the pattern. Values which can't
+    be decoded are skipped. codec: codec of the values, JSON by default
+    """
+    codec = codec or get_codec()
+    keys = []
+    for key in connection.scan_iter(match=pattern, count=batch, _type="string"):
+        keys.append(key)
+        if len(keys) >= batch:
+            yield from decode_batch(connection, codec, keys)
+            keys = []
+    if keys:
+        yield from decode_batch(connection, codec, keys)
+
+
+def decode_batch(connection, codec, keys):
+    for key, value in zip(keys, connection.mget(keys)):
+        if value is None:
+            continue
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        try:
+            yield key, codec.decode(value)
+        except Exception as e:
+            logging.error(f"Couldn't decode {key!r}: {e}")
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("--host", action="store", default="localhost")
+    op.add_argument("-p", "--port", action="store", type=int, default=6379)
+    op.add_argument("--codec", choices=sorted(CODECS), default="json")
+    op.add_argument("--store-codec", choices=sorted(CODECS), default="json")
+    op.add_argument("--pattern", action="store", default="i:*")
+    op.add_argument("--batch", action="store", type=int, default=1000)
+    op.add_argument("-o", "--output", action="store", required=True)
+    args = op.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt="%Y.%m.%d %H:%M:%S",
+    )
+
+    count = build_snapshot(
+        dump_redis(
+            redis.StrictRedis(host=args.host, port=args.port),
+            args.pattern,
+            args.batch,
+            get_codec(args.store_codec),
+        ),
+        args.output,
+        args.codec,
+    )
+    logging.info(f"Snapshot {args.output} of {count} keys is built")
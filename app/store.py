@@ -1,58 +1,1208 @@
+import ast
+import asyncio
+import bisect
+import contextvars
+import hashlib
+import itertools
+import json
 import logging
+import os
+import random
+import threading
 import time
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import redis
+import redis.asyncio
 
+from app import profiling
+from app.deadline import current as current_deadline
+from app.deadline import expired as deadline_expired
+from app.metrics import metrics
 
-class RedisStore:
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+RETRY_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+RETRIES_EXHAUSTED = "Failed to connect to Redis after multiple retries."
+DEADLINE_EXCEEDED = "Deadline of the request exceeded."
+
+# delete the lock only if it's still held by the caller
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# token bucket of rate tokens per second holding up to burst tokens,
+# takes cost tokens if there are enough of them. Time is Redis' own, so
+# workers with skewed clocks share the bucket
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call("time")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("hmget", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local taken = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    taken = 1
+end
+redis.call("hset", KEYS[1], "tokens", tostring(tokens), "updated", now)
+redis.call("pexpire", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return taken
+"""
+
+
+class StoreError(Exception):
     """
-    Redis storage is implemented by this class.
+    Store can't be reached within the retry budget of the call
+    """
+
+
+class DeadlineExceeded(StoreError):
+    """
+    Store can't be reached before the deadline of the request
+    """
+
+
+class LiteralCodec:
+    """
+    Python literals as they were stored originally, decoded safely
+    """
+
+    name = "literal"
+
+    def encode(self, value):
+        return repr(value).encode("utf-8")
+
+    def decode(self, data):
+        return ast.literal_eval(data.decode("utf-8"))
+
+
+class JSONCodec:
+    name = "json"
+
+    def encode(self, value):
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec:
     """
+    Compact binary format, requires msgpack to be installed
+    """
+
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+
+    def encode(self, value):
+        return msgpack.packb(value)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+
+class FallbackCodec:
+    """
+    Encodes with the primary codec and decodes values which weren't
+    migrated yet with the legacy one
+    """
+
+    def __init__(self, primary, legacy=None):
+        self.primary = primary
+        self.legacy = legacy or LiteralCodec()
+        self.name = primary.name
+
+    def encode(self, value):
+        return self.primary.encode(value)
+
+    def decode(self, data):
+        try:
+            return self.primary.decode(data)
+        except Exception:
+            return self.legacy.decode(data)
+
+
+CODECS = {
+    "literal": LiteralCodec,
+    "json": JSONCodec,
+    "msgpack": MsgpackCodec,
+}
+
+
+def get_codec(name="json"):
+    return FallbackCodec(CODECS[name]())
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing dependency after `failure_threshold`
+    consecutive failures. Once `recovery_timeout` seconds have passed
+    `half_open_max_calls` trial calls are let through: a success closes
+    the circuit, a failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name="circuit",
+        failure_threshold=5,
+        recovery_timeout=30,
+        half_open_max_calls=1,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = 0
+        self.trial_calls = 0
+        self.lock = threading.Lock()
+        breakers.add(self)
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.recovery_timeout:
+                    self.rejected += 1
+                    return False
+                self.set_state(self.HALF_OPEN)
+                self.trial_calls = 0
+            if self.state == self.HALF_OPEN:
+                if self.trial_calls >= self.half_open_max_calls:
+                    self.rejected += 1
+                    return False
+                self.trial_calls += 1
+            return True
+
+    def record_success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.failures = 0
+            self.set_state(self.CLOSED)
+
+    def release(self):
+        """
+        Give back a trial call which ended without an outcome, like
+        a call abandoned at the deadline of the request
+        """
+        if self.state != self.HALF_OPEN:
+            return
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.trial_calls:
+                self.trial_calls -= 1
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            tripped = self.failures >= self.failure_threshold
+            if tripped or self.state == self.HALF_OPEN:
+                self.opened_at = time.monotonic()
+                self.set_state(self.OPEN)
+
+    def set_state(self, state):
+        if self.state != state:
+            logging.warning(f"Circuit {self.name}: {self.state} -> {state}")
+            self.state = state
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class LocalCache:
+    """
+    In-process LRU cache with expiration of entries
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, name="local"):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[1] < time.monotonic():
+                del self.data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Entry never outlives the ttl of the cache nor the given one
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self.lock:
+            self.data[key] = value, time.monotonic() + ttl
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+        }
+
+
+# breakers and in-process caches of the stores of the process,
+# they are read when metrics are rendered
+breakers = weakref.WeakSet()
+local_caches = weakref.WeakSet()
+
+BREAKER_STATES = {
+    CircuitBreaker.CLOSED: 0,
+    CircuitBreaker.HALF_OPEN: 1,
+    CircuitBreaker.OPEN: 2,
+}
+
+
+def samples(objects, label, value, combine=sum):
+    """
+    Values of the objects labelled with their names, values of objects
+    with the same name are combined
+    """
+    values = {}
+    for obj in list(objects):
+        values.setdefault(obj.name, []).append(value(obj))
+    values = sorted(values.items())
+    return [(((label, name),), combine(group)) for name, group in values]
+
 
-    def __init__(self, host="localhost", port=6379, max_retries=3, timeout=2):
+def export(name, objects, label, value, kind="gauge", combine=sum):
+    """
+    Export value of every object of the set as a metric
+    """
+
+    def collect(counters):
+        return samples(objects, label, value, combine)
+
+    metrics.gauge(name, collect, kind)
+
+
+export(
+    "circuit_breaker_state",
+    breakers,
+    "breaker",
+    lambda breaker: BREAKER_STATES[breaker.state],
+    combine=max,
+)
+export(
+    "circuit_breaker_rejected_total",
+    breakers,
+    "breaker",
+    lambda breaker: breaker.rejected,
+    "counter",
+)
+export(
+    "local_cache_hits_total",
+    local_caches,
+    "node",
+    lambda cache: cache.hits,
+    "counter",
+)
+export(
+    "local_cache_misses_total",
+    local_caches,
+    "node",
+    lambda cache: cache.misses,
+    "counter",
+)
+export("local_cache_size", local_caches, "node", lambda cache: len(cache.data))
+
+
+def encode_value(value):
+    """
+    Bytes of the value as Redis returns them
+    """
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("utf-8")
+
+
+class BaseRedisStore:
+    """
+    Connection settings and retry policy shared by the Redis stores.
+    Every call is retried with jittered exponential backoff until
+    max_retries attempts are made or `timeout` seconds have passed.
+    """
+
+    def __init__(
+        self,
+        host="localhost",
+        port=6379,
+        max_retries=3,
+        timeout=1,
+        max_connections=50,
+        socket_timeout=0.5,
+        socket_connect_timeout=0.5,
+        health_check_interval=30,
+        backoff_base=0.05,
+        backoff_cap=0.5,
+        breaker_threshold=5,
+        breaker_timeout=30,
+        local_cache_size=0,
+        local_cache_ttl=60,
+        codec=None,
+    ):
         self.host = host
         self.port = port
         self.max_retries = max_retries
         self.timeout = timeout
+        self.max_connections = max_connections
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.health_check_interval = health_check_interval
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # score cache is optional, so it is skipped while Redis is failing
+        self.cache_breaker = CircuitBreaker(
+            f"cache {host}:{port}", breaker_threshold, breaker_timeout
+        )
+        # format of values of the persistent store
+        self.codec = codec or get_codec()
+        # optional tier in front of Redis for hot keys
+        self.local_cache = None
+        if local_cache_size:
+            self.local_cache = LocalCache(
+                local_cache_size, local_cache_ttl, name=f"{host}:{port}"
+            )
+            local_caches.add(self.local_cache)
         self.connection = None
+        self.metric_labels = (("node", f"{host}:{port}"),)
+
+    def local_get(self, key):
+        if self.local_cache is None:
+            return None
+        return self.local_cache.get(key)
+
+    def local_get_many(self, keys):
+        """
+        Values found in the local cache and keys to obtain from Redis
+        """
+        if self.local_cache is None:
+            return [None] * len(keys), list(keys)
+        values = [self.local_cache.get(key) for key in keys]
+        return values, [k for k, v in zip(keys, values) if v is None]
+
+    def local_set(self, key, value, ttl=None):
+        if self.local_cache is not None and value is not None:
+            self.local_cache.set(key, encode_value(value), ttl)
+
+    def local_merge(self, keys, values, missing, fetched):
+        fetched = dict(zip(missing, fetched))
+        for i, key in enumerate(keys):
+            if values[i] is None:
+                values[i] = fetched[key]
+                if not isinstance(values[i], Exception):
+                    self.local_set(key, values[i])
+        return values
+
+    def pool_kwargs(self):
+        return {
+            "host": self.host,
+            "port": self.port,
+            "max_connections": self.max_connections,
+            "socket_timeout": self.socket_timeout,
+            "socket_connect_timeout": self.socket_connect_timeout,
+            "health_check_interval": self.health_check_interval,
+            # how long to wait for a free connection of the pool
+            "timeout": self.socket_connect_timeout,
+        }
+
+    def cache_allow(self):
+        """
+        Whether the cache may be called. A request out of time doesn't
+        reach the breaker, its deadline says nothing of the cache
+        """
+        return not deadline_expired() and self.cache_breaker.allow()
+
+    def call_deadline(self):
+        """
+        Deadline of a call, its timeout trimmed to the deadline of
+        the request, and whether it's trimmed
+        """
+        deadline = time.monotonic() + self.timeout
+        request_deadline = current_deadline.get()
+        if request_deadline is None or deadline < request_deadline:
+            return deadline, False
+        if request_deadline <= time.monotonic():
+            raise DeadlineExceeded(DEADLINE_EXCEEDED)
+        return request_deadline, True
+
+    def failure(self, attempt, trimmed):
+        """
+        Error of a call which failed after attempt, calls with retries
+        left fail for the deadline of the request
+        """
+        metrics.inc("redis_failures_total", self.metric_labels)
+        if trimmed and attempt + 1 < self.max_retries:
+            return DeadlineExceeded(DEADLINE_EXCEEDED)
+        return StoreError(RETRIES_EXHAUSTED)
+
+    def backoff(self, attempt, deadline):
+        """
+        Delay before the next attempt or None if it doesn't fit the deadline
+        """
+        if attempt + 1 >= self.max_retries:
+            return None
+        cap = min(self.backoff_cap, self.backoff_base * 2**attempt)
+        delay = random.uniform(0, cap)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+
+class RedisStore(BaseRedisStore):
+    """
+    Redis storage is implemented by this class.
+    """
 
     def connect(self):
-        return redis.StrictRedis(host=self.host, port=self.port)
+        pool = redis.BlockingConnectionPool(**self.pool_kwargs())
+        return redis.StrictRedis(connection_pool=pool)
+
+    def call(self, command):
+        """
+        Run command(connection) retrying on connection errors
+        """
+        deadline, trimmed = self.call_deadline()
+        start = time.perf_counter()
+        labels = self.metric_labels
+        try:
+            for attempt in range(self.max_retries):
+                try:
+                    if not self.connection:
+                        self.connection = self.connect()
+                    return command(self.connection)
+                except RETRY_ERRORS:
+                    delay = self.backoff(attempt, deadline)
+                    if delay is None:
+                        break
+                    metrics.inc("redis_retries_total", labels)
+                    time.sleep(delay)
+            raise self.failure(attempt, trimmed)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("redis_call_duration_seconds", labels, elapsed)
+            profiling.add("redis", elapsed)
+
+    def read(self, command):
+        """
+        call() of a read only command
+        """
+        return self.call(command)
 
     def get(self, key):
         """
         Method to obtain client_interest from persistent cache
         """
-        for _ in range(self.max_retries):
-            try:
-                if not self.connection:
-                    self.connection = self.connect()
-                return self.connection.get(key)
-            except redis.ConnectionError:
-                time.sleep(self.timeout)
-        raise Exception("Failed to connect to Redis after multiple retries.")
+        value = self.local_get(key)
+        if value is None:
+            value = self.read(lambda connection: connection.get(key))
+            self.local_set(key, value)
+        return value
+
+    def get_many(self, keys):
+        """
+        Method to obtain several values in one round trip.
+        Values of keys which failed individually are returned as exceptions
+        """
+        values, missing = self.local_get_many(keys)
+        if not missing:
+            return values
+
+        def command(connection):
+            pipe = connection.pipeline(transaction=False)
+            for key in missing:
+                pipe.get(key)
+            return pipe.execute(raise_on_error=False)
+
+        return self.local_merge(keys, values, missing, self.read(command))
 
     def cache_get(self, key):
         """
         Method to obtain online_score from cache
         """
+        if not self.cache_allow():
+            return None
         try:
             res = self.get(key)
-        except Exception:
-            logging.exception("Could't connect to redis server to read value")
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return None
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't read value from redis cache: {e}")
             return None
+        self.cache_breaker.record_success()
         return res
 
     def cache_set(self, key, value, timeout=5):
         """
         Method to set up value
         """
-        for _ in range(self.max_retries):
+        self.local_set(key, value, timeout)
+        if not self.cache_allow():
+            return
+        try:
+            self.call(
+                lambda connection: connection.setex(key, timeout, value),
+            )
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't set value to redis cache: {e}")
+            return
+        self.cache_breaker.record_success()
+
+    def cache_get_many(self, keys):
+        """
+        Method to obtain several online_scores from cache in one round trip
+        """
+        if not self.cache_allow():
+            return [None] * len(keys)
+        values, missing = self.local_get_many(keys)
+        if not missing:
+            return values
+        try:
+            fetched = self.read(lambda connection: connection.mget(missing))
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return [None] * len(keys)
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't read values from redis cache: {e}")
+            return [None] * len(keys)
+        self.cache_breaker.record_success()
+        return self.local_merge(keys, values, missing, fetched)
+
+    def cache_set_many(self, mapping, timeout=5):
+        """
+        Method to set up several values in one round trip
+        """
+        for key, value in mapping.items():
+            self.local_set(key, value, timeout)
+        if not self.cache_allow():
+            return
+
+        def command(connection):
+            pipe = connection.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipe.setex(key, timeout, value)
+            pipe.execute()
+
+        try:
+            self.call(command)
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't set values to redis cache: {e}")
+            return
+        self.cache_breaker.record_success()
+
+    def cache_lock(self, key, timeout=1):
+        """
+        Lock the key for timeout seconds. Returns the token of the lock,
+        None if it's held by another caller. The caller is given the lock
+        if the cache is unavailable or the request is out of time
+        """
+        token = uuid.uuid4().hex
+        if not self.cache_allow():
+            return token
+        try:
+            acquired = self.call(
+                lambda connection: connection.set(
+                    key,
+                    token,
+                    nx=True,
+                    px=int(timeout * 1000),
+                ),
+            )
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return token
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't lock redis cache key: {e}")
+            return token
+        self.cache_breaker.record_success()
+        return token if acquired else None
+
+    def cache_unlock(self, key, token):
+        def command(connection):
+            return connection.eval(UNLOCK_SCRIPT, 1, key, token)
+
+        try:
+            self.call(command)
+        except Exception as e:
+            logging.warning(f"Could't unlock redis cache key: {e}")
+
+    def take_tokens(self, key, rate, burst, cost=1):
+        """
+        Take cost tokens from the bucket of the key refilled with rate
+        tokens per second up to burst. Tokens are given if the cache
+        is unavailable, DeadlineExceeded is raised once the request is
+        out of time, so it can't be used to skip the limit
+        """
+        if deadline_expired():
+            raise DeadlineExceeded(DEADLINE_EXCEEDED)
+        if not self.cache_breaker.allow():
+            return True
+
+        def command(connection):
+            args = rate, burst, cost
+            return connection.eval(TOKEN_BUCKET_SCRIPT, 1, key, *args)
+
+        try:
+            taken = self.call(command)
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            raise
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't take tokens of redis key: {e}")
+            return True
+        self.cache_breaker.record_success()
+        return bool(taken)
+
+
+class AsyncRedisStore(BaseRedisStore):
+    """
+    asyncio counterpart of RedisStore built on redis.asyncio
+    """
+
+    def connect(self):
+        pool = redis.asyncio.BlockingConnectionPool(**self.pool_kwargs())
+        return redis.asyncio.StrictRedis(connection_pool=pool)
+
+    async def close(self):
+        if self.connection:
+            await self.connection.close(close_connection_pool=True)
+            self.connection = None
+
+    async def call(self, command):
+        """
+        Await command(connection) retrying on connection errors
+        """
+        deadline, trimmed = self.call_deadline()
+        start = time.perf_counter()
+        labels = self.metric_labels
+        try:
+            for attempt in range(self.max_retries):
+                try:
+                    if not self.connection:
+                        self.connection = self.connect()
+                    if not trimmed:
+                        return await command(self.connection)
+                    # the socket timeout may outlast the request
+                    timeout = deadline - time.monotonic()
+                    result = command(self.connection)
+                    return await asyncio.wait_for(result, timeout)
+                except asyncio.TimeoutError:
+                    metrics.inc("redis_failures_total", labels)
+                    raise DeadlineExceeded(DEADLINE_EXCEEDED)
+                except RETRY_ERRORS:
+                    delay = self.backoff(attempt, deadline)
+                    if delay is None:
+                        break
+                    metrics.inc("redis_retries_total", labels)
+                    await asyncio.sleep(delay)
+            raise self.failure(attempt, trimmed)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("redis_call_duration_seconds", labels, elapsed)
+            profiling.add("redis", elapsed)
+
+    async def read(self, command):
+        """
+        call() of a read only command
+        """
+        return await self.call(command)
+
+    async def get(self, key):
+        """
+        Method to obtain client_interest from persistent cache
+        """
+        value = self.local_get(key)
+        if value is None:
+            value = await self.read(lambda connection: connection.get(key))
+            self.local_set(key, value)
+        return value
+
+    async def get_many(self, keys):
+        """
+        Method to obtain several values in one round trip.
+        Values of keys which failed individually are returned as exceptions
+        """
+        values, missing = self.local_get_many(keys)
+        if not missing:
+            return values
+
+        async def command(connection):
+            pipe = connection.pipeline(transaction=False)
+            for key in missing:
+                pipe.get(key)
+            return await pipe.execute(raise_on_error=False)
+
+        fetched = await self.read(command)
+        return self.local_merge(keys, values, missing, fetched)
+
+    async def cache_get(self, key):
+        """
+        Method to obtain online_score from cache
+        """
+        if not self.cache_allow():
+            return None
+        try:
+            res = await self.get(key)
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return None
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't read value from redis cache: {e}")
+            return None
+        self.cache_breaker.record_success()
+        return res
+
+    async def cache_set(self, key, value, timeout=5):
+        """
+        Method to set up value
+        """
+        self.local_set(key, value, timeout)
+        if not self.cache_allow():
+            return
+        try:
+            await self.call(
+                lambda connection: connection.setex(key, timeout, value),
+            )
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't set value to redis cache: {e}")
+            return
+        self.cache_breaker.record_success()
+
+    async def cache_get_many(self, keys):
+        """
+        Method to obtain several online_scores from cache in one round trip
+        """
+        if not self.cache_allow():
+            return [None] * len(keys)
+        values, missing = self.local_get_many(keys)
+        if not missing:
+            return values
+        try:
+            fetched = await self.read(
+                lambda connection: connection.mget(missing),
+            )
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return [None] * len(keys)
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't read values from redis cache: {e}")
+            return [None] * len(keys)
+        self.cache_breaker.record_success()
+        return self.local_merge(keys, values, missing, fetched)
+
+    async def cache_set_many(self, mapping, timeout=5):
+        """
+        Method to set up several values in one round trip
+        """
+        for key, value in mapping.items():
+            self.local_set(key, value, timeout)
+        if not self.cache_allow():
+            return
+
+        async def command(connection):
+            pipe = connection.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipe.setex(key, timeout, value)
+            await pipe.execute()
+
+        try:
+            await self.call(command)
+        except DeadlineExceeded:
+            self.cache_breaker.release()
+            return
+        except Exception as e:
+            self.cache_breaker.record_failure()
+            logging.warning(f"Could't set values to redis cache: {e}")
+            return
+        self.cache_breaker.record_success()
+
+
+class BaseReplicatedStore:
+    """
+    Reads of the store are made from its replicas in turn and from
+    the primary when the replica fails. Failing replicas are skipped
+    until their breaker lets them be tried again
+    """
+
+    replica_class = None
+
+    def __init__(self, replicas=(), **kwargs):
+        """
+        replicas: list of (host, port) pairs
+        """
+        super().__init__(**kwargs)
+        threshold = kwargs.get("breaker_threshold", 5)
+        timeout = kwargs.get("breaker_timeout", 30)
+        # a failed read is retried by the primary
+        kwargs.update(max_retries=1, local_cache_size=0, codec=self.codec)
+        self.replicas = []
+        for host, port in replicas:
+            kwargs.update(host=host, port=port)
+            name = f"replica {host}:{port}"
+            breaker = CircuitBreaker(name, threshold, timeout)
+            self.replicas.append((self.replica_class(**kwargs), breaker))
+        self.turn = itertools.count()
+
+    def next_replica(self):
+        """
+        Next replica which may be read with its breaker, None if
+        every replica is failing
+        """
+        if deadline_expired():
+            raise DeadlineExceeded(DEADLINE_EXCEEDED)
+        for _ in self.replicas:
+            replica = self.replicas[next(self.turn) % len(self.replicas)]
+            if replica[1].allow():
+                return replica
+        return None
+
+    def replica_failed(self, replica, breaker, error):
+        breaker.record_failure()
+        name = f"{replica.host}:{replica.port}"
+        logging.warning(f"Could't read from replica {name}: {error}")
+
+
+class ReplicatedRedisStore(BaseReplicatedStore, RedisStore):
+    """
+    RedisStore of the primary reading from its replicas
+    """
+
+    replica_class = RedisStore
+
+    def read(self, command):
+        replica = self.next_replica()
+        if replica is not None:
+            store, breaker = replica
+            try:
+                result = store.call(command)
+            except DeadlineExceeded:
+                # the primary has no more time than the replica
+                breaker.release()
+                raise
+            except Exception as e:
+                self.replica_failed(store, breaker, e)
+            else:
+                breaker.record_success()
+                return result
+        return self.call(command)
+
+
+class AsyncReplicatedRedisStore(BaseReplicatedStore, AsyncRedisStore):
+    """
+    asyncio counterpart of ReplicatedRedisStore
+    """
+
+    replica_class = AsyncRedisStore
+
+    async def close(self):
+        await super().close()
+        for store, _ in self.replicas:
+            await store.close()
+
+    async def read(self, command):
+        replica = self.next_replica()
+        if replica is not None:
+            store, breaker = replica
+            try:
+                result = await store.call(command)
+            except DeadlineExceeded:
+                # the primary has no more time than the replica
+                breaker.release()
+                raise
+            except Exception as e:
+                self.replica_failed(store, breaker, e)
+            else:
+                breaker.record_success()
+                return result
+        return await self.call(command)
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes. Every node is placed on the ring
+    at `vnodes` points, so adding or removing a node moves about 1/N of
+    the keys and keys are spread evenly
+    """
+
+    def __init__(self, names, vnodes=160):
+        points = sorted(
+            (self.hash(f"{name}#{i}"), index)
+            for index, name in enumerate(names)
+            for i in range(vnodes)
+        )
+        self.points = [point for point, _ in points]
+        self.nodes = [index for _, index in points]
+
+    @staticmethod
+    def hash(key):
+        digest = hashlib.md5(key.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def get_node(self, key):
+        """
+        Index of the node the key belongs to
+        """
+        i = bisect.bisect(self.points, self.hash(key))
+        return self.nodes[i % len(self.nodes)]
+
+    def group(self, keys):
+        """
+        Positions of the keys grouped by index of their node
+        """
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.get_node(key), []).append(i)
+        return groups
+
+
+class BaseShardedStore:
+    """
+    Keys distributed over several stores with consistent hashing
+    """
+
+    store_class = None
+
+    def __init__(self, nodes, vnodes=160, **kwargs):
+        """
+        nodes: list of (host, port) pairs, kwargs are passed to
+        the store of every node
+        """
+        make = self.store_class
+        self.nodes = [make(host=h, port=p, **kwargs) for h, p in nodes]
+        self.ring = HashRing([f"{h}:{p}" for h, p in nodes], vnodes)
+        self.codec = self.nodes[0].codec
+
+    def node(self, key):
+        return self.nodes[self.ring.get_node(key)]
+
+    def split(self, keys):
+        """
+        Nodes with keys they keep and their positions among the keys
+        """
+        return [
+            (self.nodes[node], [keys[i] for i in positions], positions)
+            for node, positions in self.ring.group(keys).items()
+        ]
+
+    @staticmethod
+    def merge(size, parts, results):
+        """
+        Values of the keys in their order. Keys of nodes which failed
+        get the error as value, unless every node failed
+        """
+        values = [None] * size
+        errors = 0
+        for (_, _, positions), result in zip(parts, results):
+            if isinstance(result, Exception):
+                errors += 1
+                result = [result] * len(positions)
+            for i, value in zip(positions, result):
+                values[i] = value
+        if errors and errors == len(parts):
+            raise next(r for r in results if isinstance(r, Exception))
+        return values
+
+    @staticmethod
+    def misses(parts, results):
+        """
+        Cached values of nodes which failed are missed
+        """
+        return [
+            [None] * len(keys) if isinstance(result, Exception) else result
+            for (_, keys, _), result in zip(parts, results)
+        ]
+
+
+class ShardedRedisStore(BaseShardedStore):
+    """
+    RedisStore over several Redis nodes. Batch calls are made to
+    the nodes in parallel
+    """
+
+    store_class = RedisStore
+
+    def __init__(self, nodes, vnodes=160, **kwargs):
+        super().__init__(nodes, vnodes, **kwargs)
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def fan_out(self, calls):
+        """
+        Results of the calls, exceptions are returned as results
+        """
+
+        def call(fn):
             try:
-                if not self.connection:
-                    self.connection = self.connect()
-                self.connection.setex(key, timeout, value)
-                return
-            except redis.ConnectionError:
-                time.sleep(self.timeout)
-        raise Exception("Failed to connect to Redis after multiple retries.")
+                return fn()
+            except Exception as e:
+                return e
+
+        if len(calls) == 1:
+            return [call(calls[0])]
+        with self.lock:
+            # threads of the executor don't survive a fork
+            if self.pid != os.getpid():
+                # as many threads as connections of the nodes, so calls of
+                # concurrent requests don't queue behind each other
+                size = sum(node.max_connections for node in self.nodes)
+                self.executor = ThreadPoolExecutor(size)
+                self.pid = os.getpid()
+        # calls run in the context of the request, so their Redis time
+        # is added to its timings
+        calls = [calls[0]] + [
+            partial(contextvars.copy_context().run, fn) for fn in calls[1:]
+        ]
+        futures = [self.executor.submit(call, fn) for fn in calls[1:]]
+        # the first call is made by the request thread, which would
+        # otherwise only wait
+        return [call(calls[0])] + [future.result() for future in futures]
+
+    def get(self, key):
+        return self.node(key).get(key)
+
+    def get_many(self, keys):
+        parts = self.split(keys)
+        calls = [partial(node.get_many, part) for node, part, _ in parts]
+        return self.merge(len(keys), parts, self.fan_out(calls))
+
+    def cache_get(self, key):
+        return self.node(key).cache_get(key)
+
+    def cache_set(self, key, value, timeout=5):
+        return self.node(key).cache_set(key, value, timeout)
+
+    def cache_get_many(self, keys):
+        parts = self.split(keys)
+        calls = [partial(n.cache_get_many, part) for n, part, _ in parts]
+        results = self.misses(parts, self.fan_out(calls))
+        return self.merge(len(keys), parts, results)
+
+    def cache_set_many(self, mapping, timeout=5):
+        calls = [
+            partial(n.cache_set_many, {k: mapping[k] for k in part}, timeout)
+            for n, part, _ in self.split(list(mapping))
+        ]
+        for result in self.fan_out(calls):
+            if isinstance(result, Exception):
+                raise result
+
+    def cache_lock(self, key, timeout=1):
+        return self.node(key).cache_lock(key, timeout)
+
+    def cache_unlock(self, key, token):
+        return self.node(key).cache_unlock(key, token)
+
+    def take_tokens(self, key, rate, burst, cost=1):
+        return self.node(key).take_tokens(key, rate, burst, cost)
+
+
+class AsyncShardedRedisStore(BaseShardedStore):
+    """
+    asyncio counterpart of ShardedRedisStore
+    """
+
+    store_class = AsyncRedisStore
+
+    async def close(self):
+        await asyncio.gather(*(node.close() for node in self.nodes))
+
+    async def fan_out(self, calls):
+        return await asyncio.gather(
+            *(fn() for fn in calls),
+            return_exceptions=True,
+        )
+
+    async def get(self, key):
+        return await self.node(key).get(key)
+
+    async def get_many(self, keys):
+        parts = self.split(keys)
+        calls = [partial(node.get_many, part) for node, part, _ in parts]
+        return self.merge(len(keys), parts, await self.fan_out(calls))
+
+    async def cache_get(self, key):
+        return await self.node(key).cache_get(key)
+
+    async def cache_set(self, key, value, timeout=5):
+        return await self.node(key).cache_set(key, value, timeout)
+
+    async def cache_get_many(self, keys):
+        parts = self.split(keys)
+        calls = [partial(n.cache_get_many, part) for n, part, _ in parts]
+        results = self.misses(parts, await self.fan_out(calls))
+        return self.merge(len(keys), parts, results)
+
+    async def cache_set_many(self, mapping, timeout=5):
+        calls = [
+            partial(n.cache_set_many, {k: mapping[k] for k in part}, timeout)
+            for n, part, _ in self.split(list(mapping))
+        ]
+        for result in await self.fan_out(calls):
+            if isinstance(result, Exception):
+                raise result
@@ -0,0 +1,45 @@
+"""
+Baselines of benchmark results to compare later runs with
+"""
+
+import json
+
+
+def save(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold=0.1, higher_is_better=()):
+    """
+    Rows of name, value, baseline value, relative change and whether it's
+    a regression larger than threshold. Results missing in the baseline
+    have None baseline
+    """
+    rows = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            rows.append((name, value, base, None, False))
+            continue
+        change = (value - base) / base
+        worse = -change if name in higher_is_better else change
+        rows.append((name, value, base, change, worse > threshold))
+    return rows
+
+
+def print_comparison(rows, unit):
+    for name, value, base, change, regressed in rows:
+        if change is None:
+            print(f"{name:<40} {value:10.2f} {unit}")
+            continue
+        mark = "  REGRESSION" if regressed else ""
+        print(
+            f"{name:<40} {value:10.2f} {unit}  baseline {base:10.2f}"
+            f"  {change:+7.1%}{mark}"
+        )
@@ -0,0 +1,78 @@
+"""
+Benchmark of bulk scoring against the per-row get_score() loop
+
+    python -m benchmarks.bench_bulk_scoring -n 200000 --processes 4
+"""
+
+import random
+import time
+from argparse import ArgumentParser
+
+from app.scoring import (
+    get_score,
+    rows_to_columns,
+    score_chunks,
+    score_columns,
+    to_columns,
+)
+
+
+class NullStore:
+    def cache_get(self, key):
+        return None
+
+    def cache_set(self, key, value, timeout=5):
+        pass
+
+
+def make_rows(number, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(number):
+        row = {
+            "phone": rng.choice([None, "7%010d" % i]),
+            "email": rng.choice([None, "user%s@otus.ru" % i]),
+            "birthday": rng.choice(
+                [None, "%02d.%02d.%d" % (rng.randint(1, 28), rng.randint(1, 12), 1990)]
+            ),
+            "gender": rng.choice([None, 0, 1, 2]),
+            "first_name": rng.choice([None, "first%s" % i]),
+            "last_name": rng.choice([None, "last%s" % i]),
+        }
+        rows.append({k: v for k, v in row.items() if v is not None})
+    return rows
+
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def run(number=100000, chunk_size=10000, processes=4):
+    rows = make_rows(number)
+    store = NullStore()
+    chunks = list(to_columns(rows, chunk_size))
+
+    loop_time, expected = measure(lambda: [get_score(store, **row) for row in rows])
+    bulk_time, (keys, scores) = measure(lambda: score_columns(rows_to_columns(rows)))
+    parallel_time, results = measure(lambda: list(score_chunks(chunks, processes)))
+    parallel = [score for _, chunk_scores in results for score in chunk_scores]
+
+    assert scores == expected and parallel == expected
+    return {
+        "get_score loop": loop_time,
+        "score_columns": bulk_time,
+        f"score_chunks x{processes}": parallel_time,
+    }
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("-n", "--number", action="store", type=int, default=100000)
+    op.add_argument("--chunk-size", action="store", type=int, default=10000)
+    op.add_argument("--processes", action="store", type=int, default=4)
+    args = op.parse_args()
+    timings = run(args.number, args.chunk_size, args.processes)
+    for name, seconds in timings.items():
+        print(f"{name:<20} {seconds:8.3f} s {args.number / seconds:12.0f} rows/s")
@@ -0,0 +1,64 @@
+"""
+Benchmark of parsing a request body and encoding a response per request
+
+    python -m benchmarks.bench_json
+"""
+
+import json
+import timeit
+from argparse import ArgumentParser
+
+from app.api import JSON_CODECS, orjson
+
+REQUEST = json.dumps(
+    {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd2"
+        "09a27954dca045e5bb12418e7d89b6d718a21e6dc8ac19bd37b2a14b3f0a4bc6",
+        "arguments": {"client_ids": list(range(100)), "date": "20.07.2017"},
+    }
+).encode("utf-8")
+RESPONSE = {
+    "response": {f"client{i}": ["sport", "music", "books"] for i in range(100)},
+    "code": 200,
+}
+
+
+def baseline():
+    """
+    Previous path: decode to str, parse, encode the response to str and bytes
+    """
+    json.loads(REQUEST.decode("utf-8"))
+    json.dumps(RESPONSE).encode("utf-8")
+
+
+def make_case(codec):
+    def case():
+        codec.loads(REQUEST)
+        codec.dumps(RESPONSE)
+
+    return case
+
+
+def run(number=5000, repeat=5):
+    """
+    Best time of a request in microseconds
+    """
+    cases = {"str + json (before)": baseline}
+    for name, codec in JSON_CODECS.items():
+        if name != "orjson" or orjson is not None:
+            cases[name] = make_case(codec())
+    return {
+        name: min(timeit.repeat(case, number=number, repeat=repeat)) / number * 1e6
+        for name, case in cases.items()
+    }
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("-n", "--number", action="store", type=int, default=5000)
+    args = op.parse_args()
+    for name, us in run(args.number).items():
+        print(f"{name:<20} {us:8.2f} us")
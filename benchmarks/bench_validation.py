@@ -0,0 +1,82 @@
+"""
+Benchmark of request validation
+
+    python -m benchmarks.bench_validation
+"""
+
+import logging
+import timeit
+from argparse import ArgumentParser
+
+from app.api import ClientsInterestsRequest, MethodRequest, OnlineScoreRequest
+from benchmarks import legacy_validation as legacy
+
+METHOD_REQUEST = {
+    "account": "horns&hoofs",
+    "login": "h&f",
+    "method": "online_score",
+    "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd2"
+    "09a27954dca045e5bb12418e7d89b6d718a21e6dc8ac19bd37b2a14b3f0a4bc6",
+    "arguments": {},
+}
+ONLINE_SCORE_REQUEST = {
+    "phone": "79175002040",
+    "email": "stupnikov@otus.ru",
+    "gender": 1,
+    "birthday": "01.01.2000",
+    "first_name": "a",
+    "last_name": "b",
+}
+INVALID_ONLINE_SCORE_REQUEST = dict(ONLINE_SCORE_REQUEST, email="stupnikovotus.ru")
+CLIENTS_INTERESTS_REQUEST = {"client_ids": list(range(100)), "date": "20.07.2017"}
+
+CASES = {
+    "MethodRequest": lambda: MethodRequest().validate(METHOD_REQUEST),
+    "OnlineScoreRequest": lambda: OnlineScoreRequest().validate(ONLINE_SCORE_REQUEST),
+    "OnlineScoreRequest invalid": lambda: OnlineScoreRequest().validate(
+        INVALID_ONLINE_SCORE_REQUEST
+    ),
+    "ClientsInterestsRequest": lambda: ClientsInterestsRequest().validate(
+        CLIENTS_INTERESTS_REQUEST
+    ),
+}
+# the same cases validated by the previous implementation
+LEGACY_CASES = {
+    "MethodRequest": lambda: legacy.MethodRequest().validate(METHOD_REQUEST),
+    "OnlineScoreRequest": lambda: legacy.OnlineScoreRequest().validate(
+        ONLINE_SCORE_REQUEST
+    ),
+    "OnlineScoreRequest invalid": lambda: legacy.OnlineScoreRequest().validate(
+        INVALID_ONLINE_SCORE_REQUEST
+    ),
+    "ClientsInterestsRequest": lambda: legacy.ClientsInterestsRequest().validate(
+        CLIENTS_INTERESTS_REQUEST
+    ),
+}
+
+
+def best(case, number, repeat):
+    return min(timeit.repeat(case, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(number=20000, repeat=5):
+    """
+    Best time of a single call of every case before and after
+    in microseconds
+    """
+    return {
+        name: (best(LEGACY_CASES[name], number, repeat), best(case, number, repeat))
+        for name, case in CASES.items()
+    }
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("-n", "--number", action="store", type=int, default=20000)
+    args = op.parse_args()
+    # the invalid case is mostly the error log, records are handled
+    # but not written
+    logging.getLogger().addHandler(logging.NullHandler())
+    print(f"{'':<28} {'before':>8}    {'after':>8}")
+    for name, (before, after) in run(args.number).items():
+        print(f"{name:<28} {before:8.2f} us {after:8.2f} us {before / after:5.1f}x")
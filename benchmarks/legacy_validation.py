@@ -0,0 +1,236 @@
+"""
+Frozen copy of request validation before request classes were compiled
+into schemas, the reference case of bench_validation. Fields keep the
+value being validated and every call looks them up in the class dict.
+Don't change it, it's what the speedup is measured against
+"""
+
+import datetime
+import logging
+import re
+
+ADMIN_LOGIN = "admin"
+OK = 200
+GENDERS = {0: "unknown", 1: "male", 2: "female"}
+
+
+class Field:
+    def __init__(self, value=None, required=True, nullable=False):
+        self.field_name = self.__class__.__name__
+        self.value = value
+        self.required = required
+        self.nullable = nullable
+
+    def __get__(self, instance, owner):
+        return getattr(instance, "value", None)
+
+    def __set__(self, instance, value):
+        self.validate()
+        instance.value = value
+
+    def validate(self):
+        if self.required:
+            if self.value is None:
+                return False, f"{self.field_name} is required"
+        if not self.nullable and not self.value:
+            return False, f"{self.field_name} must not be nullable"
+        elif self.nullable and not self.value:
+            return None, OK
+        return True, OK
+
+
+class CharField(Field):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        parent_result = super().validate()
+        if not parent_result[0]:
+            return parent_result[0], parent_result[1]
+        if not self.value or not isinstance(self.value, str):
+            return False, f"{self.field_name} must be a str"
+        return True, OK
+
+
+class ArgumentsField(Field):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        parent_result = super().validate()
+        if not parent_result[0]:
+            return parent_result[0], parent_result[1]
+        if not self.value or not isinstance(self.value, dict):
+            return False, f"{self.field_name} must be a dict"
+        return True, OK
+
+
+class EmailField(CharField):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        parent_result = super().validate()
+        if not parent_result[0]:
+            return parent_result[0], parent_result[1]
+        if not self.value or not re.match(r"[^@]+@[^@]+\.[^@]+", self.value):
+            return False, f"{self.field_name} must have appropriate email format"
+        return True, OK
+
+
+class PhoneField(Field):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        # self.value = str(self.value)
+        parent_result = super().validate()
+        if not parent_result[0]:
+            return parent_result[0], parent_result[1]
+        if not self.value or not re.match(r"^7\d{10}$", str(self.value)):
+            return False, f"{self.field_name} must have appropriate phone format"
+        return True, OK
+
+
+class DateField(Field):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        parent_result = super().validate()
+        if not parent_result[0]:
+            return parent_result[0], parent_result[1]
+        if self.value:
+            try:
+                datetime.datetime.strptime(self.value, "%d.%m.%Y")
+                return True, OK
+            except ValueError:
+                return False, f"{self.field_name} must have appropriate date format"
+        return True, OK
+
+
+class BirthDayField(DateField):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        parent_result = super().validate()
+        return parent_result[0], parent_result[1]
+
+
+class GenderField(Field):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        parent_result = super().validate()
+        if not parent_result[0] and self.value != 0:
+            return parent_result[0], parent_result[1]
+        if self.value and self.value not in GENDERS:
+            return False, f"{self.field_name} must have value in (0, 1, 2)"
+        return True, OK
+
+
+class ClientIDsField(Field):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.field_name = self.__class__.__name__
+
+    def validate(self):
+        parent_result = super().validate()
+        if not parent_result[0]:
+            return parent_result[0], parent_result[1]
+        if not self.value or (
+            not isinstance(self.value, list)
+            or not all(isinstance(client_id, int) for client_id in self.value)
+        ):
+            return False, f"{self.field_name} must be a list with integer"
+        return True, OK
+
+
+class RequestValidator:
+    def validate(self, request_instance, data):
+        is_fields_valid = {}
+        for field_name, field_instance in request_instance.__class__.__dict__.items():
+            if isinstance(field_instance, Field):
+                field_instance.value = data.get(field_name)
+                request_instance._fields[field_name] = field_instance.value
+                is_valid, error = field_instance.validate()
+                is_fields_valid[field_name] = is_valid, error
+        return is_fields_valid
+
+
+class ClientsInterestsRequest(RequestValidator):
+    client_ids = ClientIDsField(required=True)
+    date = DateField(required=False, nullable=True)
+
+    def __init__(self):
+        self._fields = {}
+
+    def validate(self, data):
+        is_fields_valid = super().validate(self, data)
+        for key, value in is_fields_valid.items():
+            is_valid, error = value
+            if is_valid == False:
+                logging.error(f"Invalid Field '{key}'- {error}")
+                return False
+        return True
+
+
+class OnlineScoreRequest(RequestValidator):
+    first_name = CharField(required=False, nullable=True)
+    last_name = CharField(required=False, nullable=True)
+    email = EmailField(required=False, nullable=True)
+    phone = PhoneField(required=False, nullable=True)
+    birthday = BirthDayField(required=False, nullable=True)
+    gender = GenderField(required=False, nullable=True)
+
+    def __init__(self):
+        self._fields = {}
+
+    def validate(self, data):
+        is_field_valid = super().validate(self, data)
+        for key, value in is_field_valid.items():
+            is_valid, error = value
+            if is_valid == False:
+                logging.error(f"Invalid Field '{key}'- {error}")
+                return False
+        if (
+            (is_field_valid["phone"][0] and is_field_valid["email"][0])
+            or (is_field_valid["first_name"][0] and is_field_valid["last_name"][0])
+            or (is_field_valid["gender"][0] and is_field_valid["birthday"][0])
+        ):
+            return True
+
+        else:
+            return False
+
+
+class MethodRequest(RequestValidator):
+    account = CharField(required=False, nullable=True)
+    login = CharField(required=True, nullable=False)
+    token = CharField(required=True, nullable=True)
+    arguments = ArgumentsField(required=True, nullable=True)
+    method = CharField(required=True, nullable=False)
+
+    def __init__(self):
+        self._fields = {}
+
+    @property
+    def is_admin(self):
+        return self._fields["login"] == ADMIN_LOGIN
+
+    def validate(self, data):
+        is_fields_valid = super().validate(self, data)
+        for key, value in is_fields_valid.items():
+            is_valid, error = value
+            if is_valid == False:
+                return False
+        return True
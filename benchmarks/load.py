@@ -0,0 +1,202 @@
+"""
+Load generator replaying requests against a running server
+
+    python -m benchmarks.load --port 8080 --rps 500 --concurrency 16 -d 30
+    python -m benchmarks.load --serve 8 --rps 0 --save load.json
+
+Requests are read from a JSON lines file of request bodies (--requests),
+bodies without a token are signed. Without the file a mix of methods is
+generated. Requests are sent at the target rate (0 - as fast as the
+connections allow), latency is counted from the time a request was due,
+so a stalled server isn't hidden by requests which weren't sent
+"""
+
+import http.client
+import itertools
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+from app import api
+from benchmarks import baseline
+from benchmarks.micro import ONLINE_SCORE, MemoryStore, make_request, sign
+
+
+def make_traffic(number=1000, seed=0):
+    """
+    Request bodies of the methods in proportion 8:1:1
+    """
+    rng = random.Random(seed)
+    bodies = []
+    for i in range(number):
+        method = rng.choices(
+            ["online_score", "clients_interests", "batch_online_score"],
+            [8, 1, 1],
+        )[0]
+        if method == "online_score":
+            arguments = dict(ONLINE_SCORE, phone="7%010d" % rng.randrange(10000))
+        elif method == "clients_interests":
+            arguments = {"client_ids": rng.sample(range(1000), 20)}
+        else:
+            arguments = {"users": [ONLINE_SCORE] * 10}
+        bodies.append(make_request(method, arguments))
+    return bodies
+
+
+def read_traffic(fp):
+    bodies = []
+    for line in fp:
+        if line.strip():
+            body = json.loads(line)
+            if "token" not in body:
+                sign(body)
+            bodies.append(body)
+    return bodies
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class LoadGenerator:
+    def __init__(self, host, port, bodies, rps=0, concurrency=8, duration=10):
+        self.host = host
+        self.port = port
+        self.bodies = [json.dumps(body).encode("utf-8") for body in bodies]
+        self.rps = rps
+        self.concurrency = concurrency
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.latencies = []
+        self.codes = {}
+
+    def run(self):
+        """
+        Send requests for the duration and return the report
+        """
+        self.start = time.perf_counter()
+        threads = [
+            threading.Thread(target=self.worker) for _ in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - self.start)
+
+    def worker(self):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=10)
+        latencies, codes = [], {}
+        end = self.start + self.duration
+        while True:
+            i = next(self.counter)
+            due = self.start + i / self.rps if self.rps else time.perf_counter()
+            if due >= end:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            code = self.send(connection, self.bodies[i % len(self.bodies)])
+            if code is None:
+                connection.close()
+                code = "error"
+            latencies.append(time.perf_counter() - due)
+            codes[code] = codes.get(code, 0) + 1
+        connection.close()
+        with self.lock:
+            self.latencies.extend(latencies)
+            for code, count in codes.items():
+                self.codes[code] = self.codes.get(code, 0) + count
+
+    def send(self, connection, body):
+        try:
+            connection.request(
+                "POST", "/method", body, {"Content-Type": "application/json"}
+            )
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            return None
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        ms = 1000
+        return {
+            "requests": len(latencies),
+            "errors": sum(n for code, n in self.codes.items() if code != api.OK),
+            "rps": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * ms,
+            "p95_ms": percentile(latencies, 95) * ms,
+            "p99_ms": percentile(latencies, 99) * ms,
+            "max_ms": (latencies[-1] if latencies else 0) * ms,
+        }, self.codes
+
+
+def serve(threads):
+    """
+    Server with an in-memory store in a thread of this process,
+    it shares the interpreter with the load generator
+    """
+    api.MainHTTPHandler.store = MemoryStore(
+        {f"i:{cid}": f'["sport{cid}", "books"]' for cid in range(1000)},
+    )
+    api.MainHTTPHandler.log_message = lambda self, format, *args: None
+    server = api.make_server(0, threads)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("--host", action="store", default="localhost")
+    op.add_argument("-p", "--port", action="store", type=int, default=8080)
+    op.add_argument("--requests", action="store", help="JSON lines of request bodies")
+    op.add_argument("--rps", action="store", type=float, default=100)
+    op.add_argument("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_argument("-d", "--duration", action="store", type=float, default=10)
+    op.add_argument(
+        "--serve",
+        action="store",
+        type=int,
+        metavar="THREADS",
+        help="start a server with an in-memory store in this process",
+    )
+    op.add_argument("--save", action="store", help="save results as a baseline")
+    op.add_argument("--compare", action="store", help="baseline to compare with")
+    op.add_argument("--threshold", action="store", type=float, default=0.1)
+    args = op.parse_args()
+
+    if args.requests:
+        with open(args.requests) as f:
+            bodies = read_traffic(f)
+    else:
+        bodies = make_traffic()
+    host, port = args.host, args.port
+    if args.serve is not None:
+        logging.disable(logging.CRITICAL)
+        host, port = serve(args.serve).server_address[:2]
+
+    generator = LoadGenerator(
+        host, port, bodies, args.rps, args.concurrency, args.duration
+    )
+    results, codes = generator.run()
+    print(f"codes: {codes}")
+    previous = baseline.load(args.compare) if args.compare else {}
+    rows = baseline.compare(
+        results, previous, args.threshold, higher_is_better={"requests", "rps"}
+    )
+    baseline.print_comparison(rows, "")
+    if args.save:
+        baseline.save(args.save, results)
+    sys.exit(1 if any(regressed for *_, regressed in rows) else 0)
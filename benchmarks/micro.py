@@ -0,0 +1,147 @@
+"""
+Micro-benchmarks of the request path without network and Redis
+
+    python -m benchmarks.micro --save baseline.json
+    python -m benchmarks.micro --compare baseline.json
+
+Exits with 1 if a case is slower than its baseline by more than
+the threshold. Logging is disabled, its cost depends on the handler
+"""
+
+import hashlib
+import logging
+import sys
+import timeit
+from argparse import ArgumentParser
+
+from app import api
+from app.scoring import get_interests, get_interests_many, get_score
+from app.store import encode_value, get_codec
+from benchmarks import baseline
+from benchmarks.bench_bulk_scoring import NullStore
+from benchmarks.bench_validation import CASES as VALIDATION_CASES
+
+
+class MemoryStore:
+    """
+    Store and score cache kept in a dict
+    """
+
+    def __init__(self, data=None):
+        self.codec = get_codec()
+        self.data = {key: encode_value(value) for key, value in (data or {}).items()}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def cache_set(self, key, value, timeout=5):
+        self.data[key] = encode_value(value)
+
+    def cache_set_many(self, mapping, timeout=5):
+        for key, value in mapping.items():
+            self.cache_set(key, value, timeout)
+
+    cache_get = get
+    cache_get_many = get_many
+
+
+def sign(request):
+    msg = request["account"] + request["login"] + api.SALT
+    request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+    return request
+
+
+def make_request(method, arguments):
+    request = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": method,
+        "arguments": arguments,
+    }
+    return sign(request)
+
+
+ONLINE_SCORE = {
+    "phone": "79175002040",
+    "email": "stupnikov@otus.ru",
+    "gender": 1,
+    "birthday": "01.01.2000",
+    "first_name": "a",
+    "last_name": "b",
+}
+CLIENT_IDS = list(range(100))
+
+
+def make_cases():
+    store = MemoryStore(
+        {f"i:{cid}": f'["sport{cid}", "books"]' for cid in CLIENT_IDS},
+    )
+    null_store = NullStore()
+    requests = {
+        "online_score": make_request("online_score", ONLINE_SCORE),
+        "clients_interests": make_request(
+            "clients_interests", {"client_ids": CLIENT_IDS, "date": "20.07.2017"}
+        ),
+        "batch_online_score": make_request(
+            "batch_online_score", {"users": [ONLINE_SCORE] * 50}
+        ),
+    }
+    method_request = api.MethodRequest()
+    method_request.validate(requests["online_score"])
+
+    def handle(request):
+        return lambda: api.method_handler({"body": request, "headers": {}}, {}, store)
+
+    def check_auth_cold():
+        api.auth_cache.verified.data.clear()
+        api.check_auth(method_request)
+
+    cases = {
+        "method_handler online_score": handle(requests["online_score"]),
+        "method_handler clients_interests x100": handle(requests["clients_interests"]),
+        "method_handler batch_online_score x50": handle(requests["batch_online_score"]),
+        "check_auth (memoized)": lambda: api.check_auth(method_request),
+        "check_auth (cold)": check_auth_cold,
+        "get_score (cached)": lambda: get_score(store, **ONLINE_SCORE),
+        "get_score (miss)": lambda: get_score(null_store, **ONLINE_SCORE),
+        "get_interests": lambda: get_interests(store, 7),
+        "get_interests_many x100": lambda: get_interests_many(store, CLIENT_IDS),
+    }
+    cases.update(VALIDATION_CASES)
+    return cases
+
+
+def run(number=5000, repeat=5):
+    """
+    Best time of a single call of every case in microseconds
+    """
+    return {
+        name: min(timeit.repeat(case, number=number, repeat=repeat)) / number * 1e6
+        for name, case in make_cases().items()
+    }
+
+
+if __name__ == "__main__":
+    op = ArgumentParser()
+    op.add_argument("-n", "--number", action="store", type=int, default=5000)
+    op.add_argument("--save", action="store", help="save results as a baseline")
+    op.add_argument("--compare", action="store", help="baseline to compare with")
+    op.add_argument(
+        "--threshold",
+        action="store",
+        type=float,
+        default=0.1,
+        help="relative slowdown reported as a regression",
+    )
+    args = op.parse_args()
+    logging.disable(logging.CRITICAL)
+    results = run(args.number)
+    previous = baseline.load(args.compare) if args.compare else {}
+    rows = baseline.compare(results, previous, args.threshold)
+    baseline.print_comparison(rows, "us")
+    if args.save:
+        baseline.save(args.save, results)
+    sys.exit(1 if any(regressed for *_, regressed in rows) else 0)
@@ -1,6 +1,7 @@
 import datetime
 import functools
 import hashlib
+import json
 import subprocess
 import time
 import unittest
@@ -9,8 +10,14 @@ from unittest.mock import patch
 import redis
 
 import app.api as api
-from app.scoring import get_score
-from app.store import RedisStore
+from app.scoring import (
+    decode_score,
+    get_interests_many,
+    get_score,
+    get_scores_many,
+    get_user_score_key,
+)
+from app.store import RedisStore, ReplicatedRedisStore, ShardedRedisStore
 
 
 def cases(cases):
@@ -151,6 +158,73 @@ class TestIntegrationSuite(unittest.TestCase):
 
         self.assertEqual(response, expected_response)
 
+    def test_ok_batch_score_request(self):
+        users = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"first_name": "a", "last_name": "b"},
+            {"phone": "79175002040"},
+        ]
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "batch_online_score",
+            "arguments": {"users": users},
+        }
+        self.set_valid_auth(request)
+        self.redis_conn.set(get_user_score_key(users[1]), 7.0)
+
+        response, code = self.get_response(request)
+
+        self.assertEqual(code, 200)
+        self.assertEqual(
+            response,
+            {
+                "scores": [
+                    {"score": 3.0},
+                    {"score": 7.0},
+                    {"error": "OnlineScoreRequest arguments error"},
+                ]
+            },
+        )
+        value = self.redis_conn.get(get_user_score_key(users[0]))
+        self.assertEqual(decode_score(value), 3.0)
+        self.assertGreater(self.redis_conn.ttl(get_user_score_key(users[0])), 0)
+
+    def test_cache_lock(self):
+        token = self.store.cache_lock("lock:uid:1", timeout=5)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.store.cache_lock("lock:uid:1", timeout=5))
+        self.store.cache_unlock("lock:uid:1", "stale token")
+        self.assertIsNone(self.store.cache_lock("lock:uid:1", timeout=5))
+        self.store.cache_unlock("lock:uid:1", token)
+        self.assertIsNotNone(self.store.cache_lock("lock:uid:1", timeout=5))
+
+    def test_token_bucket(self):
+        self.assertTrue(self.store.take_tokens("rl:a/b", 0.001, 3, 2))
+        self.assertFalse(self.store.take_tokens("rl:a/b", 0.001, 3, 2))
+        self.assertTrue(self.store.take_tokens("rl:a/b", 0.001, 3, 1))
+        self.assertGreater(self.redis_conn.pttl("rl:a/b"), 0)
+        self.assertTrue(self.store.take_tokens("rl:c/d", 0.001, 3, 3))
+
+    def test_partial_failed_interest_request(self):
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "clients_interests",
+            "arguments": {"client_ids": [1, 2, 3]},
+        }
+        self.set_valid_auth(request)
+        self.redis_conn.set("i:1", str(["sport", "music"]))
+        self.redis_conn.rpush("i:2", "sport")
+
+        response, code = self.get_response(request)
+
+        self.assertEqual(code, 200)
+        self.assertEqual(
+            response, {"client1": ["sport", "music"], "client2": None, "client3": None}
+        )
+        self.assertEqual(list(self.context["errors"]), ["client2"])
+
     @cases(
         [
             {
@@ -162,7 +236,7 @@ class TestIntegrationSuite(unittest.TestCase):
         ]
     )
     def test_invalid_conn_interest_request(self, arguments):
-        with patch.object(self.store, "get", side_effect=redis.ConnectionError):
+        with patch.object(self.store, "get_many", side_effect=redis.ConnectionError):
             request = {
                 "account": "horns&hoofs",
                 "login": "h&f",
@@ -204,5 +278,115 @@ class TestIntegrationSuite(unittest.TestCase):
             self.assertEqual(code, 200)
 
 
+class TestShardedIntegration(unittest.TestCase):
+    ports = [6381, 6382, 6383]
+
+    def setUp(self):
+        self.redis_processes = [
+            subprocess.Popen(["redis-server", "--port", str(port)])
+            for port in self.ports
+        ]
+        time.sleep(2)
+
+        self.redis_conns = [
+            redis.StrictRedis(host="localhost", port=port) for port in self.ports
+        ]
+        self.store = ShardedRedisStore([("localhost", port) for port in self.ports])
+
+    def tearDown(self):
+        for conn, process in zip(self.redis_conns, self.redis_processes):
+            if process.poll() is None:
+                conn.flushall()
+            process.terminate()
+            process.wait()
+
+    def test_keys_are_sharded(self):
+        client_ids = list(range(30))
+        for cid in client_ids:
+            conn = self.redis_conns[self.store.ring.get_node(f"i:{cid}")]
+            conn.set(f"i:{cid}", json.dumps([f"sport{cid}"]))
+        self.assertTrue(all(conn.dbsize() for conn in self.redis_conns))
+
+        interests, errors = get_interests_many(self.store, client_ids)
+
+        self.assertEqual(errors, {})
+        self.assertEqual(interests, {cid: [f"sport{cid}"] for cid in client_ids})
+
+    def test_scores_are_sharded(self):
+        users = [{"phone": f"7917500{i:04d}", "email": "a@b.c"} for i in range(30)]
+        self.assertEqual(get_scores_many(self.store, users), [3.0] * 30)
+        for user in users:
+            key = get_user_score_key(user)
+            conn = self.redis_conns[self.store.ring.get_node(key)]
+            self.assertEqual(decode_score(conn.get(key)), 3.0)
+
+    def test_failed_node(self):
+        self.redis_processes[0].terminate()
+        self.redis_processes[0].wait()
+        client_ids = list(range(30))
+
+        interests, errors = get_interests_many(self.store, client_ids)
+
+        failed = [c for c in client_ids if self.store.ring.get_node(f"i:{c}") == 0]
+        self.assertEqual(sorted(errors), failed)
+
+
+class TestReplicaIntegration(unittest.TestCase):
+    def setUp(self):
+        self.redis_processes = [
+            subprocess.Popen(["redis-server", "--port", "6380"]),
+            subprocess.Popen(
+                ["redis-server", "--port", "6384", "--replicaof", "localhost", "6380"]
+            ),
+        ]
+        time.sleep(2)
+
+        self.redis_conn = redis.StrictRedis(host="localhost", port=6380)
+        self.store = ReplicatedRedisStore([("localhost", 6384)], port=6380)
+        self.cache = RedisStore(port=6380, codec=self.store.codec)
+
+    def tearDown(self):
+        self.redis_conn.flushall()
+        for process in self.redis_processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+
+    def test_interests_are_read_from_replica(self):
+        self.redis_conn.set("i:1", json.dumps(["books"]))
+        self.redis_conn.wait(1, 1000)
+
+        interests, errors = get_interests_many(self.store, [1])
+
+        self.assertEqual((interests, errors), ({1: ["books"]}, {}))
+
+    def test_failover_to_primary(self):
+        self.redis_conn.set("i:1", json.dumps(["books"]))
+        self.redis_processes[1].terminate()
+        self.redis_processes[1].wait()
+
+        interests, errors = get_interests_many(self.store, [1])
+
+        self.assertEqual((interests, errors), ({1: ["books"]}, {}))
+
+    def test_separate_cache(self):
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "online_score",
+            "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+        }
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+
+        response, code = api.method_handler(
+            {"body": request, "headers": {}}, {}, self.store, self.cache
+        )
+
+        self.assertEqual((response, code), ({"score": 3.0}, 200))
+        key = get_user_score_key(request["arguments"])
+        self.assertEqual(decode_score(self.redis_conn.get(key)), 3.0)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,53 @@
+import asyncio
+import contextvars
 import datetime
 import functools
 import hashlib
+import http.client
+import io
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import Mock
+from concurrent.futures import Future
+from unittest.mock import AsyncMock, Mock, patch
 
+import redis
+from aiohttp.test_utils import TestClient, TestServer as AioTestServer
 
+import app.admission as admission
 import app.api as api
+import app.async_api as async_api
+import app.deadline as deadline
+import app.log as log
+import app.metrics as metrics
+import app.profiling as profiling
+import app.scoring as scoring
+from app.metrics import Metrics
+from app.migrate import migrate
+from app.snapshot import SnapshotStore, build_snapshot, dump_redis
+from app.store import (
+    AsyncRedisStore,
+    AsyncShardedRedisStore,
+    CircuitBreaker,
+    DeadlineExceeded,
+    HashRing,
+    JSONCodec,
+    LocalCache,
+    MsgpackCodec,
+    RedisStore,
+    ReplicatedRedisStore,
+    ShardedRedisStore,
+    StoreError,
+    get_codec,
+)
+
+JSON_CODECS = ["json"] + (["orjson"] if api.orjson else [])
 
 
 def cases(cases):
@@ -26,6 +68,7 @@ class TestSuite(unittest.TestCase):
         self.context = {}
         self.headers = {}
         self.mock_store_instance = Mock()
+        self.mock_store_instance.codec = get_codec()
         self.store = self.mock_store_instance
 
     def get_response(self, request):
@@ -73,6 +116,17 @@ class TestSuite(unittest.TestCase):
                 "arguments": {},
             },
         ]
+        + [
+            {
+                "account": "horns&hoofs",
+                "login": login,
+                "method": "online_score",
+                "token": token,
+                "arguments": {},
+            }
+            for login in ("h&f", "admin")
+            for token in (0, [], {})
+        ]
     )
     def test_bad_auth(self, request):
         _, code = self.get_response(request)
@@ -166,7 +220,7 @@ class TestSuite(unittest.TestCase):
         ]
     )
     def test_ok_score_request(self, arguments):
-        self.mock_store_instance.cache_get.return_value = 0
+        self.mock_store_instance.cache_get.return_value = None
 
         request = {
             "account": "horns&hoofs",
@@ -182,7 +236,7 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(sorted(self.context["has"]), sorted(arguments.keys()))
 
     def test_ok_score_admin_request(self):
-        self.mock_store_instance.cache_get.return_value = 0
+        self.mock_store_instance.cache_get.return_value = None
         arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
         request = {
             "account": "horns&hoofs",
@@ -196,6 +250,72 @@ class TestSuite(unittest.TestCase):
         score = response.get("score")
         self.assertEqual(score, 3)
 
+    def test_separate_cache(self):
+        cache = Mock()
+        cache.cache_get.return_value = b"5.0"
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "online_score",
+            "arguments": {"first_name": "a", "last_name": "b"},
+        }
+        self.set_valid_auth(request)
+        response, code = api.method_handler(
+            {"body": request, "headers": {}}, self.context, self.store, cache
+        )
+        self.assertEqual((response, code), ({"score": 5.0}, api.OK))
+        self.mock_store_instance.cache_get.assert_not_called()
+        request["method"] = "clients_interests"
+        request["arguments"] = {"client_ids": [1]}
+        self.mock_store_instance.get_many.side_effect = lambda keys: [b'["books"]']
+        response, code = api.method_handler(
+            {"body": request, "headers": {}}, self.context, self.store, cache
+        )
+        self.assertEqual((response, code), ({"client1": ["books"]}, api.OK))
+        cache.get_many.assert_not_called()
+
+    def test_ok_batch_score_request(self):
+        self.mock_store_instance.cache_get_many.side_effect = lambda keys: [
+            None,
+            b"5.0",
+        ]
+        users = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"first_name": "a", "last_name": "b"},
+            {"phone": "89175002040", "email": "stupnikov@otus.ru"},
+            "user",
+        ]
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "batch_online_score",
+            "arguments": {"users": users},
+        }
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        error = {"error": "OnlineScoreRequest arguments error"}
+        self.assertEqual(
+            response, {"scores": [{"score": 3.0}, {"score": 5.0}, error, error]}
+        )
+        self.assertEqual(self.context["nusers"], 4)
+        self.mock_store_instance.cache_get_many.assert_called_once()
+        (mapping, timeout), _ = self.mock_store_instance.cache_set_many.call_args
+        self.assertEqual(list(map(scoring.decode_score, mapping.values())), [3.0])
+        self.mock_store_instance.cache_get.assert_not_called()
+
+    @cases([{}, {"users": []}, {"users": {"phone": "79175002040"}}])
+    def test_invalid_batch_score_request(self, arguments):
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "batch_online_score",
+            "arguments": arguments,
+        }
+        self.set_valid_auth(request)
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code, arguments)
+
     @cases(
         [
             {},
@@ -229,7 +349,9 @@ class TestSuite(unittest.TestCase):
         ]
     )
     def test_ok_interests_request(self, arguments):
-        self.mock_store_instance.get.return_value = ["value1", "value2"]
+        self.mock_store_instance.get_many.side_effect = lambda keys: [
+            ["value1", "value2"] for _ in keys
+        ]
         request = {
             "account": "horns&hoofs",
             "login": "h&f",
@@ -247,6 +369,1718 @@ class TestSuite(unittest.TestCase):
             )
         )
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
+        self.mock_store_instance.get.assert_not_called()
+
+    def test_partial_failed_interests_request(self):
+        self.mock_store_instance.get_many.return_value = [
+            b"['sport']",
+            redis.ResponseError("WRONGTYPE"),
+            b"['sport'",
+            None,
+        ]
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "clients_interests",
+            "arguments": {"client_ids": [1, 2, 3, 4]},
+        }
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(
+            response,
+            {"client1": ["sport"], "client2": None, "client3": None, "client4": None},
+        )
+        self.assertEqual(sorted(self.context["errors"]), ["client2", "client3"])
+        self.mock_store_instance.get_many.assert_called_once_with(
+            ["i:1", "i:2", "i:3", "i:4"]
+        )
+
+
+class TestRequestValidator(unittest.TestCase):
+    def test_requests_dont_share_state(self):
+        first, second = api.OnlineScoreRequest(), api.OnlineScoreRequest()
+        self.assertTrue(first.validate({"first_name": "a", "last_name": "b"}))
+        self.assertFalse(second.validate({"first_name": "c"}))
+        self.assertEqual((first.first_name, first.last_name), ("a", "b"))
+        self.assertEqual((second.first_name, second.last_name), ("c", None))
+        with self.assertRaises(AttributeError):
+            first.unknown = 1
+
+    @cases(
+        [
+            ({"phone": "79175002040"}, None),
+            ({"phone": "89175002040"}, "PhoneField must have appropriate phone format"),
+            ({"gender": 0}, None),
+            ({"gender": 3}, "GenderField must have value in (0, 1, 2)"),
+            (
+                {"birthday": "31.31.1890"},
+                "BirthDayField must have appropriate date format",
+            ),
+        ]
+    )
+    def test_field_errors(self, arguments, error):
+        request = api.OnlineScoreRequest()
+        result = request.clean(arguments)
+        self.assertEqual(result and result[1], error)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        # callers waiting for the result of a call
+        self.waiting = threading.Semaphore(0)
+        waiting = self.waiting
+
+        class WaitedFuture(Future):
+            def result(self, timeout=None):
+                waiting.release()
+                return super().result(timeout)
+
+        patcher = patch.object(scoring, "Future", WaitedFuture)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_coalesced(self, fn, started, release, n=8):
+        """
+        Call fn from n + 1 threads, the first of them blocks until
+        the others wait for its result
+        """
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fn()))]
+        threads[0].start()
+        started.wait()
+        for _ in range(n):
+            threads.append(threading.Thread(target=lambda: results.append(fn())))
+            threads[-1].start()
+        for _ in range(n):
+            self.waiting.acquire(timeout=5)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight, started, release = (
+            scoring.SingleFlight(),
+            threading.Event(),
+            threading.Event(),
+        )
+        fn = Mock(side_effect=lambda: started.set() or release.wait() and 3.0)
+        results = self.run_coalesced(lambda: flight.do("uid:1", fn), started, release)
+        self.assertEqual(fn.call_count, 1)
+        self.assertEqual(results, [3.0] * 9)
+        self.assertEqual(flight.calls, {})
+
+    def test_error_is_raised_and_forgotten(self):
+        flight = scoring.SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do("uid:1", Mock(side_effect=ValueError))
+        self.assertEqual(flight.do("uid:1", lambda: 1.5), 1.5)
+
+    def test_get_score_on_cold_cache(self):
+        store = Mock()
+        store.cache_get.return_value = None
+        started, release = threading.Event(), threading.Event()
+        store.cache_set.side_effect = lambda *args: started.set() or release.wait()
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        results = self.run_coalesced(
+            lambda: scoring.get_score(store, **arguments), started, release
+        )
+        store.cache_set.assert_called_once()
+        self.assertEqual(results, [3.0] * 9)
+
+    def test_redis_lock_holder_computes(self):
+        store = Mock()
+        store.cache_lock.return_value = "token"
+        flight = scoring.RedisSingleFlight()
+        self.assertEqual(flight.do("uid:1", lambda: 3.0, store), 3.0)
+        store.cache_lock.assert_called_once_with("lock:uid:1", 1)
+        store.cache_unlock.assert_called_once_with("lock:uid:1", "token")
+
+    def test_redis_lock_waiter_reads_cache(self):
+        store = Mock()
+        store.cache_lock.return_value = None
+        store.cache_get.side_effect = [None, b"3.0"]
+        fn = Mock()
+        flight = scoring.RedisSingleFlight(poll_interval=0)
+        self.assertEqual(flight.do("uid:1", fn, store), 3.0)
+        fn.assert_not_called()
+        store.cache_unlock.assert_not_called()
+
+    def test_redis_lock_waiter_computes_after_timeout(self):
+        store = Mock()
+        store.cache_lock.return_value = None
+        store.cache_get.return_value = None
+        flight = scoring.RedisSingleFlight(lock_timeout=0.01, poll_interval=0.001)
+        self.assertEqual(flight.do("uid:1", lambda: 3.0, store), 3.0)
+
+
+class TestScoreCache(unittest.TestCase):
+    arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+
+    def setUp(self):
+        self.store = Mock()
+        self.refresher = scoring.Refresher()
+        patcher = patch.object(scoring, "score_refresher", self.refresher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_refreshes(self):
+        if self.refresher.executor:
+            self.refresher.executor.shutdown(wait=True)
+
+    @cases([b"0", b"0;%d" % (time.time() + 60)])
+    def test_zero_score_is_served_from_cache(self, value):
+        self.store.cache_get.return_value = value
+        score = scoring.get_score(self.store, **self.arguments)
+        self.assertEqual((score, type(score)), (0, int))
+        self.wait_refreshes()
+        self.store.cache_set.assert_not_called()
+
+    def test_zero_score_is_the_same_cached_or_computed(self):
+        self.store.cache_get.return_value = None
+        computed = scoring.get_score(self.store, gender=0, birthday="01.01.2000")
+        (_, value, _), _ = self.store.cache_set.call_args
+        self.store.cache_get.return_value = value
+        self.store.cache_get_many.return_value = [value]
+        cached = scoring.get_score(self.store, gender=0, birthday="01.01.2000")
+        [batched] = scoring.get_scores_many(
+            self.store, [{"gender": 0, "birthday": "01.01.2000"}]
+        )
+        for score in (computed, cached, batched):
+            self.assertEqual(json.dumps({"score": score}), '{"score": 0}')
+
+    def test_score_is_cached_with_refresh_time(self):
+        self.store.cache_get.return_value = None
+        self.assertEqual(scoring.get_score(self.store, **self.arguments), 3.0)
+        (key, value, ttl), _ = self.store.cache_set.call_args
+        score, refresh_at = scoring.parse_score(value)
+        self.assertEqual((score, ttl), (3.0, scoring.SCORE_TTL))
+        self.assertAlmostEqual(
+            refresh_at, time.time() + scoring.SCORE_SOFT_TTL, delta=2
+        )
+
+    def test_soft_ttl_disabled(self):
+        with patch.object(scoring, "SCORE_SOFT_TTL", 0):
+            self.assertEqual(scoring.encode_score(3.0), 3.0)
+        self.assertEqual(scoring.parse_score(b"3.0"), (3.0, None))
+
+    def test_stale_score_is_refreshed_in_background(self):
+        self.store.cache_get.return_value = b"5.0;%d" % (time.time() - 1)
+        self.assertEqual(scoring.get_score(self.store, **self.arguments), 5.0)
+        self.wait_refreshes()
+        (key, value, ttl), _ = self.store.cache_set.call_args
+        self.assertEqual(scoring.decode_score(value), 3.0)
+        self.assertEqual(self.refresher.pending, set())
+
+    def test_refreshes_of_key_are_not_repeated(self):
+        release = threading.Event()
+        fn = Mock(side_effect=lambda: release.wait())
+        self.refresher.submit("uid:1", fn)
+        self.refresher.submit("uid:1", fn)
+        release.set()
+        self.wait_refreshes()
+        fn.assert_called_once()
+
+    def test_stale_scores_of_batch_are_rewritten(self):
+        users = [{"phone": "79175002040"}, {"email": "stupnikov@otus.ru"}]
+        keys = ["uid:1", "uid:2"]
+        cached = [b"1.5;%d" % (time.time() - 1), b"1.5;%d" % (time.time() + 60)]
+        scores, missing = scoring.collect_scores(users, keys, cached)
+        self.assertEqual(scores, [1.5, 1.5])
+        self.assertEqual(list(missing), ["uid:1"])
+
+
+class TestBulkScoring(unittest.TestCase):
+    rows = [
+        {},
+        {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+        {"phone": 79175002040, "gender": 0, "birthday": "01.01.2000"},
+        {"gender": 1, "birthday": "1.2.2000", "first_name": "a", "last_name": "b"},
+        {"first_name": "Юрий", "last_name": ""},
+    ]
+
+    def expected(self):
+        store = Mock()
+        store.cache_get.return_value = None
+        return [
+            (
+                scoring.get_score_key(
+                    **{
+                        k: v
+                        for k, v in row.items()
+                        if k in ("phone", "birthday", "first_name", "last_name")
+                    }
+                ),
+                scoring.get_score(store, **row),
+            )
+            for row in self.rows
+        ]
+
+    def test_score_columns(self):
+        keys, scores = scoring.score_columns(scoring.rows_to_columns(self.rows))
+        self.assertEqual(list(zip(keys, scores)), self.expected())
+        self.assertEqual([type(s) for s in scores], [int, float, float, float, int])
+
+    def test_score_columns_without_numpy(self):
+        with patch.object(scoring, "np", None):
+            self.test_score_columns()
+
+    def test_readers(self):
+        jsonl = io.StringIO("\n".join(json.dumps(row) for row in self.rows))
+        csv = io.StringIO(
+            "phone,email,gender,birthday,first_name,last_name\n"
+            ",,,,,\n"
+            "79175002040,stupnikov@otus.ru,,,,\n"
+            "79175002040,,0,01.01.2000,,\n"
+            ",,1,1.2.2000,a,b\n"
+            ",,,,Юрий,\n"
+        )
+        for chunks in (scoring.read_jsonl(jsonl, 2), scoring.read_csv(csv, 2)):
+            results = [
+                pair
+                for keys, scores in scoring.score_chunks(chunks)
+                for pair in zip(keys, scores)
+            ]
+            self.assertEqual(results, self.expected())
+
+
+class TestJSONCodecs(unittest.TestCase):
+    @cases(JSON_CODECS)
+    def test_codec(self, name):
+        codec = api.JSON_CODECS[name]()
+        body = bytes('{"login": "Юрий", "arguments": {"phone": 79175002040}}', "utf-8")
+        self.assertEqual(
+            codec.loads(body), {"login": "Юрий", "arguments": {"phone": 79175002040}}
+        )
+        response = {"response": {"score": 3.0, "client1": None}, "code": 200}
+        self.assertEqual(json.loads(codec.dumps(response)), response)
+        self.assertEqual(json.loads(codec.dumps({"id": 2**70})), {"id": 2**70})
+        with self.assertRaises(ValueError):
+            codec.loads(b"\xff{")
+
+
+class TestLogging(unittest.TestCase):
+    def test_json_lines(self):
+        formatter = log.JSONFormatter(datefmt=log.DATE_FORMAT)
+        record = logging.makeLogRecord({"msg": {"request_id": "1", "code": 200}})
+        entry = json.loads(formatter.format(record))
+        self.assertEqual((entry["request_id"], entry["code"]), ("1", 200))
+        record = logging.makeLogRecord({"msg": "Started %s", "args": (8080,)})
+        self.assertEqual(
+            json.loads(formatter.format(record))["message"], "Started 8080"
+        )
+
+    def test_traceback_is_rendered_when_queued(self):
+        records = queue.SimpleQueue()
+        handler = log.AsyncQueueHandler(records)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.makeLogRecord(
+                {"msg": "failed", "exc_info": sys.exc_info()}
+            )
+        handler.handle(record)
+        queued = records.get_nowait()
+        self.assertIsNone(queued.exc_info)
+        self.assertIn("ValueError: boom", queued.exc_text)
+        self.assertIn("ValueError: boom", log.TextFormatter().format(queued))
+
+    def test_queued_context_is_a_snapshot(self):
+        records = queue.SimpleQueue()
+        handler = log.AsyncQueueHandler(records)
+        ctx = {"request_id": "1", "errors": {"1": "Store unavailable"}}
+        handler.handle(logging.makeLogRecord({"msg": ctx}))
+        ctx["code"] = 500
+        ctx["errors"]["2"] = "Store unavailable"
+        queued = records.get_nowait()
+        self.assertEqual(
+            queued.msg, {"request_id": "1", "errors": {"1": "Store unavailable"}}
+        )
+
+    def test_forked_worker_writes_queued_records(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers, root.level
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "server.log")
+            writer = log.setup_logging(path, fmt="json")
+            try:
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        for i in range(1000):
+                            logging.info({"request_id": str(i)})
+                        log.stop_logging()
+                    finally:
+                        os._exit(0)
+                os.waitpid(pid, 0)
+            finally:
+                writer.stop()
+                writer.handler.close()
+                root.handlers, root.level = handlers, level
+                log.writer = None
+            with open(path) as f:
+                lines = f.readlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(json.loads(lines[-1])["request_id"], "999")
+
+    def test_request_body_is_truncated(self):
+        with patch.object(log, "BODY_MAX_SIZE", 8), self.assertLogs(level="INFO") as cm:
+            log.log_request_body("/method", b'{"login": "h&f"}', "1")
+        self.assertEqual(cm.records[0].msg["body"], '{"login"... (16 bytes)')
+
+    def test_request_body_is_sampled(self):
+        with patch.object(log, "BODY_SAMPLE_RATE", 0), self.assertNoLogs(level="INFO"):
+            log.log_request_body("/method", b"{}", "1")
+
+    def test_response_is_not_logged(self):
+        ctx = {"request_id": "1"}
+        with self.assertLogs(level="INFO"):
+            api.log_response(ctx, {"response": {"score": 3.0}, "code": 200})
+        self.assertEqual(ctx, {"request_id": "1", "code": 200})
+        with self.assertLogs(level="INFO"):
+            api.log_response(ctx, {"error": "Forbidden", "code": 403})
+        self.assertEqual(ctx["error"], "Forbidden")
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1))
+        self.metrics.gauge("score_cache_hit_ratio", scoring.score_cache_hit_ratio)
+        for module in ("app.api", "app.scoring", "app.store"):
+            patcher = patch(f"{module}.metrics", self.metrics)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_shards_of_threads_are_summed(self):
+        labels = (("method", "online_score"),)
+
+        def record():
+            for _ in range(100):
+                self.metrics.inc("requests", labels)
+                self.metrics.observe("latency", labels, 0.5)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counters, histograms = self.metrics.collect()
+        self.assertEqual(len(self.metrics.shards), 4)
+        self.assertEqual(counters[("requests", labels)], 400)
+        self.assertEqual(histograms[("latency", labels)], [0, 400, 0, 200.0, 400])
+
+    def test_render(self):
+        labels = (("method", 'a"b'),)
+        self.metrics.inc("api_requests_total", labels, 2)
+        self.metrics.observe("api_request_duration_seconds", labels, 0.05)
+        self.metrics.observe("api_request_duration_seconds", labels, 2)
+        self.metrics.gauge("ratio", lambda counters: 0.5)
+        lines = self.metrics.render().splitlines()
+        self.assertIn("# TYPE api_requests_total counter", lines)
+        self.assertIn('api_requests_total{method="a\\"b"} 2', lines)
+        self.assertIn(
+            'api_request_duration_seconds_bucket{method="a\\"b",le="1"} 1', lines
+        )
+        self.assertIn(
+            'api_request_duration_seconds_bucket{method="a\\"b",le="+Inf"} 2', lines
+        )
+        self.assertIn('api_request_duration_seconds_count{method="a\\"b"} 2', lines)
+        self.assertIn("ratio 0.5", lines)
+
+    def test_store_and_auth_caches(self):
+        store = RedisStore(
+            host="metrics", port=1, breaker_threshold=1, local_cache_size=10
+        )
+        store.local_cache.set("i:1", b"[]")
+        store.local_get("i:1")
+        store.local_get("i:2")
+        store.cache_breaker.record_failure()
+        store.cache_breaker.allow()
+        request = api.MethodRequest()
+        request.clean({"account": "a", "login": "metrics", "token": "bad"})
+        self.assertFalse(api.check_auth(request))
+        lines = metrics.metrics.render().splitlines()
+        for line in [
+            "# TYPE circuit_breaker_state gauge",
+            'circuit_breaker_state{breaker="cache metrics:1"} 2',
+            "# TYPE circuit_breaker_rejected_total counter",
+            'circuit_breaker_rejected_total{breaker="cache metrics:1"} 1',
+            'local_cache_hits_total{node="metrics:1"} 1',
+            'local_cache_misses_total{node="metrics:1"} 1',
+            'local_cache_size{node="metrics:1"} 1',
+        ]:
+            self.assertIn(line, lines)
+        misses = [line for line in lines if line.startswith("auth_cache_misses")]
+        self.assertEqual(len(misses), 1)
+        self.assertGreater(int(misses[0].split()[1]), 0)
+
+    def test_score_cache_lookups(self):
+        users = [{"phone": "79175002040"}, {"email": "a@b.ru"}, {"phone": "7"}]
+        cached = [b"1.5", b"1.5;%d" % (time.time() - 1), None]
+        scoring.collect_scores(users, ["uid:1", "uid:2", "uid:3"], cached)
+        counters, _ = self.metrics.collect()
+        name = "score_cache_requests_total"
+        self.assertEqual(counters[(name, scoring.HIT)], 1)
+        self.assertEqual(counters[(name, scoring.STALE)], 1)
+        self.assertEqual(counters[(name, scoring.MISS)], 1)
+        self.assertAlmostEqual(scoring.score_cache_hit_ratio(counters), 2 / 3)
+
+    @patch("app.store.time.sleep")
+    def test_redis_retries(self, sleep):
+        store = RedisStore(max_retries=3, timeout=10)
+        connection = Mock()
+        connection.get.side_effect = redis.ConnectionError
+        with patch.object(store, "connect", return_value=connection):
+            with self.assertRaises(StoreError):
+                store.get("i:1")
+        counters, histograms = self.metrics.collect()
+        labels = (("node", "localhost:6379"),)
+        self.assertEqual(counters[("redis_retries_total", labels)], 2)
+        self.assertEqual(counters[("redis_failures_total", labels)], 1)
+        self.assertEqual(histograms[("redis_call_duration_seconds", labels)][-1], 1)
+
+    def test_endpoint(self):
+        store = Mock()
+        store.cache_get.return_value = None
+        server = api.make_server(0, threads=1)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with patch.object(api.MainHTTPHandler, "store", store):
+                conn = http.client.HTTPConnection("localhost", server.server_address[1])
+                request = {
+                    "account": "horns&hoofs",
+                    "login": "h&f",
+                    "method": "online_score",
+                    "arguments": {"phone": "79175002040", "email": "a@b.ru"},
+                }
+                msg = request["account"] + request["login"] + api.SALT
+                request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+                conn.request("POST", "/method", json.dumps(request))
+                conn.getresponse().read()
+                conn.request("GET", "/metrics")
+                response = conn.getresponse()
+                lines = response.read().decode("utf-8").splitlines()
+                conn.request("GET", "/other")
+                missing = conn.getresponse()
+                missing.read()
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(response.status, api.OK)
+        self.assertEqual(missing.status, api.NOT_FOUND)
+        self.assertIn('api_requests_total{method="online_score",code="200"} 1', lines)
+        self.assertIn('score_cache_requests_total{result="miss"} 1', lines)
+        self.assertIn("score_cache_hit_ratio 0.0", lines)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.store = Mock()
+        self.store.cache_get.return_value = None
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "online_score",
+            "arguments": {"phone": "79175002040", "email": "a@b.ru"},
+        }
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+        self.request = request
+
+    def handle(self, headers):
+        ctx = {}
+        start = time.perf_counter()
+        profiling.start_timing(headers)
+        api.method_handler({"body": self.request, "headers": {}}, ctx, self.store)
+        profiling.finish_timing(ctx, start)
+        return ctx
+
+    def test_phases_are_timed_on_request(self):
+        ctx = self.handle({"X-Timing": "1"})
+        self.assertEqual(set(ctx["timings"]), {"validate", "auth", "handler", "total"})
+        self.assertLessEqual(ctx["timings"]["handler"], ctx["timings"]["total"])
+
+    def test_timing_is_off_by_default(self):
+        self.assertNotIn("timings", self.handle({}))
+        with patch.object(profiling, "TIMING_SAMPLE_RATE", 1):
+            self.assertIn("timings", self.handle({}))
+
+    def test_redis_time(self):
+        store = RedisStore()
+        connection = Mock()
+        connection.get.return_value = b"1"
+        ctx = {}
+        with patch.object(store, "connect", return_value=connection):
+            profiling.start_timing({"X-Timing": "1"})
+            store.get("i:1")
+            profiling.finish_timing(ctx, time.perf_counter())
+        self.assertIn("redis", ctx["timings"])
+
+    def test_timings_are_logged_by_server(self):
+        server = api.make_server(0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with patch.object(api.MainHTTPHandler, "store", self.store):
+                with self.assertLogs(level="INFO") as cm:
+                    conn = http.client.HTTPConnection(
+                        "localhost", server.server_address[1]
+                    )
+                    conn.request(
+                        "POST",
+                        "/method",
+                        json.dumps(self.request),
+                        {"X-Timing": "1"},
+                    )
+                    conn.getresponse().read()
+                    conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        (ctx,) = [
+            r.msg for r in cm.records if isinstance(r.msg, dict) and "code" in r.msg
+        ]
+        timings = ctx["timings"]
+        for phase in ("read", "parse", "validate", "auth", "handler", "serialize"):
+            self.assertIn(phase, timings)
+
+    def test_sampling_profiler(self):
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        worker = threading.Thread(target=busy_loop)
+        worker.start()
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = profiling.SamplingProfiler(directory, interval=0.001)
+            profiler.toggle()
+            time.sleep(0.1)
+            profiler.toggle()
+            profiler.thread.join()
+            stop.set()
+            worker.join()
+            (name,) = os.listdir(directory)
+            with open(os.path.join(directory, name)) as f:
+                lines = f.read().splitlines()
+        self.assertTrue(any("busy_loop" in line for line in lines))
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.store = Mock()
+        self.store.cache_get.return_value = None
+        self.store.get_many.return_value = [None] * 3
+
+    def make_request(self, login, method, arguments):
+        request = {
+            "account": "horns&hoofs",
+            "login": login,
+            "method": method,
+            "arguments": arguments,
+        }
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+        return request
+
+    def handle(self, request):
+        return api.method_handler({"body": request, "headers": {}}, {}, self.store)
+
+    @patch("app.admission.time.monotonic")
+    def test_token_bucket(self, monotonic):
+        monotonic.return_value = 100
+        limiter = admission.RateLimiter(rate=2, burst=3)
+        self.assertTrue(limiter.take("a", 2))
+        self.assertFalse(limiter.take("a", 2))
+        self.assertTrue(limiter.take("b", 3))
+        monotonic.return_value = 100.5
+        self.assertTrue(limiter.take("a", 2))
+        self.assertFalse(limiter.take("a", 1))
+
+    def test_buckets_are_bounded(self):
+        limiter = admission.RateLimiter(rate=1, burst=1, max_keys=2)
+        for key in ("a", "b", "c"):
+            limiter.take(key)
+        self.assertEqual(list(limiter.buckets), ["b", "c"])
+
+    @cases(
+        [
+            ({"client_ids": [1, 2, 3]}, 3),
+            ({"users": [{}, {}]}, 2),
+            ({"phone": "79175002040"}, 1),
+            ({"client_ids": []}, 1),
+            ("arguments", 1),
+        ]
+    )
+    def test_request_cost(self, arguments, cost):
+        self.assertEqual(admission.request_cost({"arguments": arguments}), cost)
+
+    def test_rate_limit_per_login(self):
+        limiter = admission.RateLimiter(rate=0.001, burst=4)
+        interests = {"client_ids": [1, 2, 3]}
+        with patch.object(api, "admission", admission.Admission(limiter=limiter)):
+            request = self.make_request("h&f", "clients_interests", interests)
+            self.assertEqual(self.handle(request)[1], api.OK)
+            self.assertEqual(self.handle(request)[1], api.TOO_MANY_REQUESTS)
+            other = self.make_request("other", "clients_interests", interests)
+            self.assertEqual(self.handle(other)[1], api.OK)
+            # unauthenticated requests don't take tokens of the login
+            forged = dict(request, token="bad")
+            self.assertEqual(self.handle(forged)[1], api.FORBIDDEN)
+
+    def test_request_cost_limit(self):
+        with patch.object(api, "admission", admission.Admission(max_cost=2)):
+            request = self.make_request(
+                "h&f", "clients_interests", {"client_ids": [1, 2, 3]}
+            )
+            response, code = self.handle(request)
+        self.assertEqual(code, api.PAYLOAD_TOO_LARGE)
+        self.assertEqual(response, "Request cost 3 exceeds 2")
+
+    def test_in_flight_limit(self):
+        control = admission.Admission(max_in_flight=1)
+        self.assertTrue(control.acquire())
+        self.assertFalse(control.acquire())
+        control.release()
+        self.assertTrue(control.acquire())
+
+    def test_busy_server_rejects(self):
+        control = admission.Admission(max_in_flight=1)
+        control.acquire()
+        server = api.make_server(0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with patch.object(api, "admission", control):
+                conn = http.client.HTTPConnection("localhost", server.server_address[1])
+                request = self.make_request("h&f", "online_score", {})
+                conn.request("POST", "/method", json.dumps(request))
+                response = conn.getresponse()
+                data = json.loads(response.read())
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(response.status, api.UNAVAILABLE)
+        self.assertEqual(response.getheader("Connection"), "close")
+        self.assertEqual(data, {"error": "Server is busy", "code": api.UNAVAILABLE})
+        self.assertEqual(control.in_flight, 1)
+
+    def test_queued_connections_are_rejected(self):
+        control = admission.Admission(max_in_flight=2)
+        entered = threading.Semaphore(0)
+        proceed = threading.Event()
+
+        def get_many(keys):
+            entered.release()
+            proceed.wait(5)
+            return [None] * len(keys)
+
+        self.store.get_many.side_effect = get_many
+        server = api.make_server(0, threads=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        request = self.make_request("h&f", "clients_interests", {"client_ids": [1]})
+        results = []
+
+        def post():
+            conn = http.client.HTTPConnection(
+                "localhost", server.server_address[1], timeout=5
+            )
+            conn.request("POST", "/method", json.dumps(request))
+            response = conn.getresponse()
+            results.append((response.status, json.loads(response.read())))
+            conn.close()
+
+        try:
+            with patch.object(api, "admission", control), patch.object(
+                api.MainHTTPHandler, "store", self.store
+            ):
+                handled = [threading.Thread(target=post) for _ in range(2)]
+                for client in handled:
+                    client.start()
+                for _ in handled:
+                    self.assertTrue(entered.acquire(timeout=5))
+                # both threads are busy, the others don't wait in the queue
+                queued = [threading.Thread(target=post) for _ in range(8)]
+                for client in queued:
+                    client.start()
+                for client in queued:
+                    client.join()
+                busy = {"error": "Server is busy", "code": api.UNAVAILABLE}
+                self.assertEqual(results, [(api.UNAVAILABLE, busy)] * 8)
+                proceed.set()
+                for client in handled:
+                    client.join()
+        finally:
+            proceed.set()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual([status for status, _ in results[8:]], [api.OK] * 2)
+        self.assertEqual(control.in_flight, 0)
+
+    def test_redis_tokens(self):
+        store = RedisStore()
+        connection = Mock()
+        connection.eval.return_value = 0
+        with patch.object(store, "connect", return_value=connection):
+            self.assertFalse(store.take_tokens("rl:a/b", 1, 5, 2))
+            key, rate, burst, cost = connection.eval.call_args.args[2:]
+            self.assertEqual((key, rate, burst, cost), ("rl:a/b", 1, 5, 2))
+            connection.eval.side_effect = redis.ConnectionError
+            with patch("app.store.time.sleep"):
+                self.assertTrue(store.take_tokens("rl:a/b", 1, 5, 2))
+
+
+class TestDeadline(unittest.TestCase):
+    def setUp(self):
+        self.store = Mock()
+        self.store.codec = get_codec()
+        self.store.cache_get.return_value = None
+        # the deadline set by a test doesn't outlive it
+        self.context = contextvars.copy_context()
+
+    def in_request(self, fn, timeout):
+        def run():
+            deadline.current.set(time.monotonic() + timeout)
+            return fn()
+
+        return self.context.run(run)
+
+    def handle(self, arguments, timeout):
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "clients_interests",
+            "arguments": arguments,
+        }
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+        return self.in_request(
+            lambda: api.method_handler(
+                {"body": request, "headers": {}}, {}, self.store
+            ),
+            timeout,
+        )
+
+    @cases(
+        [
+            ({}, 5),
+            ({"X-Request-Timeout": "0.5"}, 0.5),
+            ({"X-Request-Timeout": "100"}, 30),
+            ({"X-Request-Timeout": "0"}, 5),
+            ({"X-Request-Timeout": "soon"}, 5),
+        ]
+    )
+    def test_start(self, headers, timeout):
+        left = self.context.run(lambda: deadline.start(headers) - time.monotonic())
+        self.assertAlmostEqual(left, timeout, delta=0.1)
+
+    def test_no_deadline(self):
+        with patch.object(deadline, "REQUEST_TIMEOUT", 0):
+            self.assertIsNone(self.context.run(deadline.start, {}))
+        self.assertIsNone(self.context.run(deadline.remaining))
+
+    def test_expired_request_is_not_handled(self):
+        response, code = self.handle({"client_ids": [1, 2]}, -1)
+        self.assertEqual(code, api.GATEWAY_TIMEOUT)
+        self.store.get_many.assert_not_called()
+
+    def test_store_deadline_is_gateway_timeout(self):
+        self.store.get_many.side_effect = DeadlineExceeded("late")
+        self.assertEqual(
+            self.handle({"client_ids": [1, 2]}, 5), ("late", api.GATEWAY_TIMEOUT)
+        )
+
+    def test_store_call_after_deadline(self):
+        store = RedisStore()
+        connection = Mock()
+        with patch.object(store, "connect", return_value=connection):
+            with self.assertRaises(DeadlineExceeded):
+                self.in_request(lambda: store.get("i:1"), -1)
+        connection.get.assert_not_called()
+
+    @patch("app.store.random.uniform", return_value=0.05)
+    @patch("app.store.time.sleep")
+    def test_retries_are_trimmed(self, sleep, uniform):
+        store = RedisStore(max_retries=10, timeout=10)
+        connection = Mock()
+        connection.get.side_effect = redis.ConnectionError
+        with patch.object(store, "connect", return_value=connection):
+            with self.assertRaises(DeadlineExceeded):
+                self.in_request(lambda: store.get("i:1"), 0.01)
+            self.assertEqual(connection.get.call_count, 1)
+            sleep.assert_not_called()
+            # retries of the call itself don't fit its timeout
+            store.timeout = 0.01
+            with self.assertRaises(StoreError) as cm:
+                self.in_request(lambda: store.get("i:1"), 5)
+            self.assertNotIsInstance(cm.exception, DeadlineExceeded)
+
+    @patch("app.store.random.uniform", return_value=0.05)
+    def test_request_deadline_never_changes_breaker_state(self, uniform):
+        store = ReplicatedRedisStore([("localhost", 6381)], breaker_threshold=1)
+        replica, replica_breaker = store.replicas[0]
+        connection = Mock()
+        for command in ("get", "mget", "setex", "set", "pipeline", "eval"):
+            getattr(connection, command).side_effect = redis.ConnectionError
+        calls = [
+            lambda: store.cache_get("uid:1"),
+            lambda: store.cache_set("uid:1", 3.0),
+            lambda: store.cache_get_many(["uid:1", "uid:2"]),
+            lambda: store.cache_set_many({"uid:1": 3.0}),
+            lambda: store.cache_lock("lock:uid:1"),
+        ]
+        replica_connection = Mock()
+        replica_connection.get.return_value = None
+        replica_connection.mget.return_value = [None, None]
+        with patch.object(store, "connect", return_value=connection):
+            with patch.object(replica, "connect", return_value=replica_connection):
+                # out of time before the call
+                for call in calls:
+                    self.in_request(call, -1)
+                for call in (
+                    lambda: store.take_tokens("rl:a/b", 1, 5),
+                    lambda: store.get("i:1"),
+                ):
+                    with self.assertRaises(DeadlineExceeded):
+                        self.in_request(call, -1)
+                self.assertEqual(connection.method_calls, [])
+                self.assertEqual(replica_connection.method_calls, [])
+                # out of time for retries of writes to the primary
+                for call in calls:
+                    self.in_request(call, 0.01)
+                self.assertEqual(connection.setex.call_count, 1)
+                with self.assertRaises(DeadlineExceeded):
+                    self.in_request(lambda: store.take_tokens("rl:a/b", 1, 5), 0.01)
+                # the trial call of a half open breaker is given back
+                store.cache_breaker.state = CircuitBreaker.HALF_OPEN
+                self.in_request(calls[1], 0.01)
+        for breaker in (store.cache_breaker, replica_breaker):
+            self.assertEqual((breaker.failures, breaker.trial_calls), (0, 0))
+        self.assertEqual(replica_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(store.cache_breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_short_deadlines_of_clients_keep_cache(self):
+        store = RedisStore(breaker_threshold=5)
+        connection = Mock()
+        connection.get.return_value = None
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "online_score",
+            "arguments": {"phone": "79175002040", "email": "a@b.ru"},
+        }
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+        with patch.object(store, "connect", return_value=connection):
+            for i in range(150):
+                headers = {"X-Request-Timeout": str(0.00001 * (1 + i % 3))}
+
+                def handle():
+                    deadline.start(headers)
+                    return api.method_handler(
+                        {"body": request, "headers": headers}, {}, store
+                    )
+
+                self.context.run(handle)
+        self.assertEqual(
+            store.cache_breaker.stats(),
+            {"state": "closed", "failures": 0, "rejected": 0},
+        )
+
+    def test_coalesced_wait_is_bounded(self):
+        flight = scoring.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def leader():
+            started.set()
+            release.wait()
+            return 1.0
+
+        thread = threading.Thread(target=flight.do, args=("uid:1", leader))
+        thread.start()
+        started.wait()
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                self.in_request(lambda: flight.do("uid:1", Mock()), 0.05)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_async_call_is_cut_at_deadline(self):
+        store = AsyncRedisStore()
+        connection = AsyncMock()
+
+        async def slow_get(key):
+            await asyncio.sleep(5)
+
+        connection.get.side_effect = slow_get
+
+        async def get():
+            deadline.current.set(time.monotonic() + 0.05)
+            with self.assertRaises(DeadlineExceeded):
+                await store.get("i:1")
+
+        with patch.object(store, "connect", return_value=connection):
+            start = time.monotonic()
+            asyncio.run(get())
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class TestAuthCache(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(api, "auth_cache", api.AuthCache(maxsize=2))
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_request(self, body):
+        request = api.MethodRequest()
+        request.validate(dict(body, arguments={}, method="online_score"))
+        return request
+
+    def test_verified_triples_are_memoized(self):
+        msg = "horns&hoofs" + "h&f" + api.SALT
+        token = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+        body = {"account": "horns&hoofs", "login": "h&f", "token": token}
+        self.assertTrue(api.check_auth(self.make_request(body)))
+        self.assertTrue(api.check_auth(self.make_request(body)))
+        self.assertFalse(api.check_auth(self.make_request(dict(body, token="x"))))
+        self.assertFalse(api.check_auth(self.make_request(dict(body, token="ы"))))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 3, 1))
+
+    def test_admin_digest_rolls_over(self):
+        token = hashlib.sha512(
+            bytes(
+                datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT, "utf-8"
+            )
+        ).hexdigest()
+        body = {"login": api.ADMIN_LOGIN, "token": token}
+        self.assertTrue(api.check_auth(self.make_request(body)))
+        self.assertTrue(api.check_auth(self.make_request(body)))
+        self.assertEqual(self.cache.admin_refreshes, 1)
+        # the hour is over
+        self.cache.admin = "stale", 0
+        self.assertTrue(api.check_auth(self.make_request(body)))
+        self.assertEqual(self.cache.admin_refreshes, 2)
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.store = Mock()
+        self.store.cache_get.return_value = None
+        patcher = patch.object(api.MainHTTPHandler, "store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, port, body):
+        conn = http.client.HTTPConnection("localhost", port, timeout=5)
+        conn.request("POST", "/method", json.dumps(body))
+        response = conn.getresponse()
+        data = json.loads(response.read())
+        conn.close()
+        return response.status, data
+
+    def test_thread_pool_server(self):
+        server = api.make_server(0, threads=4)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            port = server.server_address[1]
+            request = {
+                "account": "horns&hoofs",
+                "login": "h&f",
+                "method": "online_score",
+                "arguments": {"phone": "79175002040", "email": "a@b.ru"},
+            }
+            msg = request["account"] + request["login"] + api.SALT
+            request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+            results = []
+            clients = [
+                threading.Thread(
+                    target=lambda: results.append(self.post(port, request))
+                )
+                for _ in range(8)
+            ]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(len(results), 8)
+        for status, data in results:
+            self.assertEqual(status, api.OK)
+            self.assertEqual(data["response"], {"score": 3.0})
+
+    def interests_request(self, client_ids):
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": "clients_interests",
+            "arguments": {"client_ids": client_ids},
+        }
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+        return json.dumps(request)
+
+    @cases(JSON_CODECS)
+    @patch.object(api, "STREAM_CHUNK_SIZE", 3)
+    @patch.object(api, "STREAM_THRESHOLD", 4)
+    def test_streamed_interests(self, json_codec):
+        patcher = patch.object(api, "json_codec", api.JSON_CODECS[json_codec]())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store.get_many.reset_mock()
+        self.store.codec = get_codec()
+        self.store.get_many.side_effect = lambda keys: [
+            bytes(str([key]), "utf-8") for key in keys
+        ]
+        server = api.make_server(0, threads=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection(
+                "localhost", server.server_address[1], timeout=5
+            )
+            bodies = []
+            for client_ids in ([1, 2], list(range(10)), [5, 6]):
+                conn.request("POST", "/method", self.interests_request(client_ids))
+                response = conn.getresponse()
+                bodies.append(
+                    (response.getheader("Transfer-Encoding"), response.read())
+                )
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        expected = {f"client{i}": [f"i:{i}"] for i in range(10)}
+        self.assertEqual(bodies[1][0], "chunked")
+        self.assertEqual(
+            bodies[1][1],
+            api.json_codec.dumps({"response": expected, "code": 200}),
+        )
+        self.assertEqual(self.store.get_many.call_count, 6)
+        # the connection is still usable after the stream
+        self.assertEqual(
+            json.loads(bodies[2][1])["response"],
+            {"client5": ["i:5"], "client6": ["i:6"]},
+        )
+
+    @patch.object(api, "STREAM_CHUNK_SIZE", 3)
+    @patch.object(api, "STREAM_THRESHOLD", 4)
+    def test_streamed_interests_failures(self):
+        self.store.codec = get_codec()
+        self.store.get_many.side_effect = StoreError
+        context = {}
+        body = json.loads(self.interests_request(list(range(10))))
+        _, code = api.method_handler({"body": body, "headers": {}}, context, self.store)
+        self.assertEqual(code, api.INTERNAL_ERROR)
+
+        down = StoreError("down")
+        self.store.get_many.side_effect = [
+            [b"[]"] * 3,
+            [b"[]", down, b"[]"],
+            StoreError,
+            [b"[]"] * 3,
+            [b"[]"] * 3,
+            [b"[]"] * 3,
+            [down],
+        ]
+        request = self.interests_request(list(range(10)))
+        server = api.make_server(0, threads=2)
+        thread = threading.Thread(target=server.serve_forever)
+        with self.assertLogs(level="INFO") as cm:
+            thread.start()
+            try:
+                conn = http.client.HTTPConnection(
+                    "localhost", server.server_address[1], timeout=5
+                )
+                conn.request("POST", "/method", request)
+                response = conn.getresponse()
+                self.assertEqual(response.status, api.OK)
+                with self.assertRaises(http.client.IncompleteRead):
+                    response.read()
+                conn.close()
+                conn = http.client.HTTPConnection(
+                    "localhost", server.server_address[1], timeout=5
+                )
+                conn.request("POST", "/method", request)
+                response = conn.getresponse()
+                self.assertIsNone(json.loads(response.read())["response"]["client9"])
+                conn.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+        # contexts are logged once the streams are written
+        logged = [
+            r.msg for r in cm.records if isinstance(r.msg, dict) and "code" in r.msg
+        ]
+        self.assertEqual(logged[0]["errors"], {"client4": "down"})
+        self.assertEqual(logged[0]["error"], "Response is truncated")
+        self.assertEqual(logged[1]["errors"], {"client9": "down"})
+        self.assertNotIn("error", logged[1])
+
+    def test_keep_alive(self):
+        server = api.make_server(0, threads=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with patch.object(api.MainHTTPHandler, "max_requests", 2):
+                conn = http.client.HTTPConnection(
+                    "localhost", server.server_address[1], timeout=5
+                )
+                responses = []
+                for _ in range(3):
+                    conn.request("POST", "/method", "{}")
+                    response = conn.getresponse()
+                    body = response.read()
+                    self.assertEqual(
+                        int(response.getheader("Content-Length")), len(body)
+                    )
+                    responses.append((response.getheader("Connection"), conn.sock))
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        # the second response closes the connection, the third one is new
+        self.assertEqual([c for c, _ in responses], [None, "close", None])
+        self.assertIsNone(responses[1][1])
+        self.assertIsNotNone(responses[0][1])
+
+    def test_serial_server_closes_connections(self):
+        server = api.make_server(0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection(
+                "localhost", server.server_address[1], timeout=5
+            )
+            conn.request("POST", "/method", "{}")
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(response.getheader("Connection"), "close")
+
+    def test_serve_worker(self):
+        server = Mock()
+        store = Mock()
+        with patch("app.api.signal.signal"), patch.object(
+            api.MainHTTPHandler, "store"
+        ), patch.object(api.MainHTTPHandler, "cache"):
+            api.serve_worker(server, lambda: store)
+            self.assertIs(api.MainHTTPHandler.store, store)
+        server.serve_forever.assert_called_once()
+        server.server_close.assert_called_once()
+
+
+class TestAsyncSuite(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.context = {}
+        self.store = AsyncMock()
+        self.store.codec = get_codec()
+
+    def make_request(self, method, arguments):
+        request = {
+            "account": "horns&hoofs",
+            "login": "h&f",
+            "method": method,
+            "arguments": arguments,
+        }
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(bytes(msg, "utf-8")).hexdigest()
+        return request
+
+    async def get_response(self, request):
+        return await async_api.method_handler(
+            {"body": request, "headers": {}}, self.context, self.store
+        )
+
+    async def test_concurrent_scores_are_coalesced(self):
+        self.store.cache_get.return_value = None
+
+        async def cache_set(*args):
+            await asyncio.sleep(0.01)
+
+        self.store.cache_set.side_effect = cache_set
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        scores = await asyncio.gather(
+            *(scoring.async_get_score(self.store, **arguments) for _ in range(5))
+        )
+        self.assertEqual(scores, [3.0] * 5)
+        self.store.cache_set.assert_awaited_once()
+
+    async def test_stale_score_is_refreshed(self):
+        self.store.cache_get.return_value = b"5.0;%d" % (time.time() - 1)
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        self.assertEqual(await scoring.async_get_score(self.store, **arguments), 5.0)
+        await asyncio.gather(*scoring.refresh_tasks)
+        (key, value, ttl), _ = self.store.cache_set.call_args
+        self.assertEqual(scoring.decode_score(value), 3.0)
+
+    async def test_ok_score_request(self):
+        self.store.cache_get.return_value = None
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        response, code = await self.get_response(
+            self.make_request("online_score", arguments)
+        )
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {"score": 3.0})
+        self.assertEqual(sorted(self.context["has"]), sorted(arguments.keys()))
+        self.store.cache_set.assert_awaited_once()
+
+    async def test_ok_interests_request(self):
+        self.store.get_many.side_effect = lambda keys: [
+            bytes(str([key]), "utf-8") for key in keys
+        ]
+        response, code = await self.get_response(
+            self.make_request("clients_interests", {"client_ids": [1, 2]})
+        )
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {"client1": ["i:1"], "client2": ["i:2"]})
+        self.assertEqual(self.context["nclients"], 2)
+
+    async def test_invalid_conn_interests_request(self):
+        self.store.get_many.side_effect = Exception
+        _, code = await self.get_response(
+            self.make_request("clients_interests", {"client_ids": [1, 2]})
+        )
+        self.assertEqual(api.INTERNAL_ERROR, code)
+
+    async def test_ok_batch_score_request(self):
+        self.store.cache_get_many.side_effect = lambda keys: [None] * len(keys)
+        users = [{"phone": "79175002040", "email": "stupnikov@otus.ru"}, {}]
+        response, code = await self.get_response(
+            self.make_request("batch_online_score", {"users": users})
+        )
+        self.assertEqual(api.OK, code)
+        self.assertEqual(
+            response,
+            {
+                "scores": [
+                    {"score": 3.0},
+                    {"error": "OnlineScoreRequest arguments error"},
+                ]
+            },
+        )
+        self.store.cache_set_many.assert_awaited_once()
+
+    async def test_invalid_method_request(self):
+        _, code = await self.get_response(self.make_request("unknown", {}))
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+    async def test_server_responses(self):
+        client = TestClient(AioTestServer(async_api.make_app(self.store)))
+        await client.start_server()
+        try:
+            resp = await client.post("/method", data="{")
+            self.assertEqual(resp.status, api.INVALID_REQUEST)
+            self.assertEqual(
+                await resp.json(), {"error": "Invalid Request", "code": 422}
+            )
+            resp = await client.post("/unknown", data=json.dumps({"a": 1}))
+            self.assertEqual(resp.status, api.NOT_FOUND)
+            self.store.cache_get.return_value = b"5.0"
+            request = self.make_request(
+                "online_score", {"first_name": "a", "last_name": "b"}
+            )
+            resp = await client.post("/method", data=json.dumps(request))
+            self.assertEqual(resp.status, api.OK)
+            self.assertEqual(
+                await resp.json(), {"response": {"score": 5.0}, "code": 200}
+            )
+        finally:
+            await client.close()
+
+
+class TestRedisStore(unittest.TestCase):
+    def setUp(self):
+        self.connection = Mock()
+        self.store = RedisStore(max_retries=4, timeout=10)
+        patcher = patch.object(self.store, "connect", return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("app.store.time.sleep")
+    def test_retry_backoff(self, sleep):
+        self.connection.get.side_effect = redis.ConnectionError
+        with self.assertRaises(StoreError):
+            self.store.get("i:1")
+        self.assertEqual(self.connection.get.call_count, 4)
+        delays = [c.args[0] for c in sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= self.store.backoff_base * 2**attempt)
+
+    @patch("app.store.time.sleep")
+    def test_retry_deadline(self, sleep):
+        self.store.timeout = 0
+        self.connection.get.side_effect = redis.TimeoutError
+        with self.assertRaises(StoreError):
+            self.store.get("i:1")
+        self.assertEqual(self.connection.get.call_count, 1)
+        sleep.assert_not_called()
+
+    @patch("app.store.time.sleep")
+    def test_retry_recovered(self, sleep):
+        self.connection.get.side_effect = [redis.ConnectionError, b"1"]
+        self.assertEqual(self.store.get("i:1"), b"1")
+
+    def test_pool_settings(self):
+        self.store = RedisStore(max_connections=7, socket_timeout=0.1)
+        pool = self.store.connect().connection_pool
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 0.1)
+
+
+class TestShardedStore(unittest.TestCase):
+    nodes = [("localhost", 6381), ("localhost", 6382), ("localhost", 6383)]
+
+    def setUp(self):
+        self.store = ShardedRedisStore(self.nodes)
+        self.store.nodes = [Mock() for _ in self.nodes]
+        for i, node in enumerate(self.store.nodes):
+            node.max_connections = 50
+            node.get_many.side_effect = lambda keys, i=i: [(i, k) for k in keys]
+            node.cache_get_many.side_effect = lambda keys: [b"1.5"] * len(keys)
+        self.keys = [f"i:{cid}" for cid in range(100)]
+
+    def test_ring(self):
+        ring = HashRing([f"{h}:{p}" for h, p in self.nodes])
+        keys = [f"uid:{i}" for i in range(3000)]
+        counts = [0] * len(self.nodes)
+        for key in keys:
+            counts[ring.get_node(key)] += 1
+        self.assertTrue(all(800 < count < 1200 for count in counts), counts)
+        # keys of a new node are the only ones moved
+        grown = HashRing([f"{h}:{p}" for h, p in self.nodes] + ["localhost:6384"])
+        moved = [key for key in keys if ring.get_node(key) != grown.get_node(key)]
+        self.assertTrue(all(grown.get_node(key) == 3 for key in moved))
+        self.assertLess(len(moved), len(keys) / 3)
+
+    def test_get_many(self):
+        values = self.store.get_many(self.keys)
+        ring = self.store.ring
+        self.assertEqual(values, [(ring.get_node(k), k) for k in self.keys])
+        for node in self.store.nodes:
+            node.get_many.assert_called_once()
+
+    def test_concurrent_requests_dont_queue(self):
+        def slow(keys):
+            time.sleep(0.05)
+            return [None] * len(keys)
+
+        for node in self.store.nodes:
+            node.get_many.side_effect = slow
+        threads = [
+            threading.Thread(target=self.store.get_many, args=(self.keys,))
+            for _ in range(16)
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 16 requests one after another take 0.8 s
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_get_many_failed_node(self):
+        error = StoreError("down")
+        self.store.nodes[1].get_many.side_effect = error
+        values = self.store.get_many(self.keys)
+        for key, value in zip(self.keys, values):
+            self.assertEqual(value is error, self.store.ring.get_node(key) == 1)
+        for node in self.store.nodes:
+            node.get_many.side_effect = error
+        with self.assertRaises(StoreError):
+            self.store.get_many(self.keys)
+
+    def test_cache_failed_node_is_missed(self):
+        self.store.nodes[0].cache_get_many.side_effect = StoreError("down")
+        values = self.store.cache_get_many(self.keys)
+        for key, value in zip(self.keys, values):
+            expected = None if self.store.ring.get_node(key) == 0 else b"1.5"
+            self.assertEqual(value, expected)
+
+    def test_cache_set_many(self):
+        self.store.cache_set_many({key: 1.5 for key in self.keys}, 60)
+        written = {}
+        for i, node in enumerate(self.store.nodes):
+            (mapping, timeout), _ = node.cache_set_many.call_args
+            self.assertEqual(timeout, 60)
+            self.assertTrue(all(self.store.ring.get_node(k) == i for k in mapping))
+            written.update(mapping)
+        self.assertEqual(sorted(written), sorted(self.keys))
+
+    def test_make_store(self):
+        self.assertIsInstance(api.make_store(self.nodes), ShardedRedisStore)
+        store = api.make_store([api.redis_address("127.0.0.1:6380")])
+        self.assertEqual((store.host, store.port), ("127.0.0.1", 6380))
+        self.assertEqual(api.redis_address("6380"), ("localhost", 6380))
+
+
+class TestAsyncShardedStore(unittest.IsolatedAsyncioTestCase):
+    async def test_get_many(self):
+        store = AsyncShardedRedisStore(TestShardedStore.nodes)
+        store.nodes = [AsyncMock() for _ in TestShardedStore.nodes]
+        for i, node in enumerate(store.nodes):
+            node.get_many.side_effect = lambda keys, i=i: [(i, k) for k in keys]
+        store.nodes[2].get_many.side_effect = StoreError("down")
+        keys = [f"i:{cid}" for cid in range(100)]
+        values = await store.get_many(keys)
+        for key, value in zip(keys, values):
+            node = store.ring.get_node(key)
+            if node == 2:
+                self.assertIsInstance(value, StoreError)
+            else:
+                self.assertEqual(value, (node, key))
+
+
+class TestReplicatedStore(unittest.TestCase):
+    def setUp(self):
+        self.store = ReplicatedRedisStore(
+            [("localhost", 6381), ("localhost", 6382)], port=6380, breaker_threshold=1
+        )
+        self.connections = {}
+        for store in [self.store] + [replica for replica, _ in self.store.replicas]:
+            connection = self.connections[store.port] = Mock()
+            connection.get.return_value = b"%d" % store.port
+            patcher = patch.object(store, "connect", return_value=connection)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_reads_from_replicas_in_turn(self):
+        values = [self.store.get("i:1") for _ in range(4)]
+        self.assertEqual(values, [b"6381", b"6382", b"6381", b"6382"])
+        self.connections[6380].get.assert_not_called()
+
+    def test_writes_to_primary(self):
+        self.store.cache_set("uid:1", 3.0, 60)
+        self.connections[6380].setex.assert_called_once_with("uid:1", 60, 3.0)
+        self.connections[6381].setex.assert_not_called()
+
+    @patch("app.store.time.sleep")
+    def test_failover_to_primary(self, sleep):
+        self.connections[6381].get.side_effect = redis.ConnectionError
+        values = [self.store.get("i:1") for _ in range(4)]
+        self.assertEqual(values, [b"6380", b"6382", b"6382", b"6382"])
+        # the failed replica isn't read until its breaker is half open
+        self.assertEqual(self.connections[6381].get.call_count, 1)
+        self.assertEqual(self.store.replicas[0][1].state, CircuitBreaker.OPEN)
+
+    def test_make_store(self):
+        store = api.make_store([("localhost", 6380)], [("localhost", 6381)])
+        self.assertIsInstance(store, ReplicatedRedisStore)
+        self.assertEqual(store.replicas[0][0].max_retries, 1)
+
+
+class TestSnapshotStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "interests.snap")
+        self.interests = {f"i:{cid}": [f"sport{cid}", "books"] for cid in range(1000)}
+        build_snapshot(self.interests.items(), self.path)
+        self.store = SnapshotStore(self.path, check_interval=0)
+
+    def test_get(self):
+        for key, interests in self.interests.items():
+            self.assertEqual(self.store.codec.decode(self.store.get(key)), interests)
+        self.assertIsNone(self.store.get("i:1000"))
+        self.assertIsNone(self.store.get("uid:1"))
+
+    def test_get_interests(self):
+        self.assertEqual(scoring.get_interests(self.store, 7), ["sport7", "books"])
+        interests, errors = scoring.get_interests_many(self.store, [1, 1001])
+        self.assertEqual(
+            (interests, errors), ({1: ["sport1", "books"], 1001: None}, {})
+        )
+
+    @cases(["json", "msgpack"])
+    def test_codec(self, name):
+        build_snapshot([("i:1", ["books"]), ("i:2", [])], self.path, name)
+        store = SnapshotStore(self.path)
+        self.assertEqual(store.codec.name, name)
+        self.assertEqual(scoring.get_interests(store, 1), ["books"])
+
+    def test_reload(self):
+        snapshot = self.store.snapshot
+        self.assertFalse(self.store.reload())
+        build_snapshot([("i:1", ["music"])], self.path)
+        self.assertTrue(self.store.reload())
+        self.assertEqual(scoring.get_interests(self.store, 1), ["music"])
+        self.assertIsNone(self.store.get("i:2"))
+        # lookups started before the swap read the previous snapshot
+        self.assertEqual(snapshot.get("i:2"), b'["sport2","books"]')
+
+    def test_checked_for_new_snapshot(self):
+        self.store.check_interval = 60
+        self.store.next_check = time.monotonic() + 60
+        build_snapshot([("i:1", ["music"])], self.path)
+        self.assertEqual(scoring.get_interests(self.store, 1), ["sport1", "books"])
+        self.store.next_check = 0
+        self.assertEqual(scoring.get_interests(self.store, 1), ["music"])
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 64)
+        with self.assertRaises(StoreError):
+            SnapshotStore(self.path)
+
+    def test_dump_redis(self):
+        connection = Mock()
+        connection.scan_iter.return_value = [b"i:1", b"i:2", b"i:3"]
+        connection.mget.return_value = [b"['sport']", b"[a", None]
+        self.assertEqual(list(dump_redis(connection)), [("i:1", ["sport"])])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    @patch("app.store.time.monotonic")
+    def test_transitions(self, monotonic):
+        monotonic.return_value = 100
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        monotonic.return_value = 111
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        monotonic.return_value = 122
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(
+            breaker.stats(), {"state": "closed", "failures": 0, "rejected": 2}
+        )
+
+    @patch("app.store.time.sleep")
+    def test_open_cache_skips_redis(self, sleep):
+        store = RedisStore(breaker_threshold=1, max_retries=1)
+        connection = Mock()
+        connection.get.side_effect = redis.ConnectionError
+        with patch.object(store, "connect", return_value=connection):
+            self.assertIsNone(store.cache_get("uid:1"))
+            self.assertIsNone(store.cache_get("uid:1"))
+            store.cache_set("uid:1", 1, 60)
+        self.assertEqual(connection.get.call_count, 1)
+        connection.setex.assert_not_called()
+        self.assertEqual(store.cache_breaker.state, CircuitBreaker.OPEN)
+
+
+class TestLocalCache(unittest.TestCase):
+    @patch("app.store.time.monotonic")
+    def test_ttl_and_eviction(self, monotonic):
+        monotonic.return_value = 0
+        cache = LocalCache(maxsize=2, ttl=10)
+        cache.set("a", b"1")
+        cache.set("b", b"2", ttl=3600)
+        self.assertEqual(cache.get("a"), b"1")
+        cache.set("c", b"3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"1")
+        monotonic.return_value = 11
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(
+            cache.stats(),
+            {"hits": 2, "misses": 2, "hit_ratio": 0.5, "size": 1, "maxsize": 2},
+        )
+
+    def test_store_local_tier(self):
+        store = RedisStore(local_cache_size=10, local_cache_ttl=60)
+        connection = Mock()
+        connection.get.return_value = b"['sport']"
+        pipe = connection.pipeline.return_value
+        pipe.execute.return_value = [b"['music']"]
+        with patch.object(store, "connect", return_value=connection):
+            self.assertEqual(store.get("i:1"), b"['sport']")
+            self.assertEqual(store.get("i:1"), b"['sport']")
+            self.assertEqual(
+                store.get_many(["i:1", "i:2"]), [b"['sport']", b"['music']"]
+            )
+            pipe.get.assert_called_once_with("i:2")
+            store.cache_set("uid:1", 3.0, 3600)
+            self.assertEqual(store.cache_get("uid:1"), b"3.0")
+        self.assertEqual(connection.get.call_count, 1)
+        self.assertEqual(store.local_cache.stats()["hits"], 3)
+
+
+class TestCodecs(unittest.TestCase):
+    @cases(["json", "msgpack", "literal"])
+    def test_roundtrip(self, name):
+        codec = get_codec(name)
+        value = ["sport", "музыка"]
+        self.assertEqual(codec.decode(codec.encode(value)), value)
+        # values which weren't migrated yet are still readable
+        self.assertEqual(codec.decode(bytes(str(value), "utf-8")), value)
+
+    def test_literal_is_not_evaluated(self):
+        with self.assertRaises(ValueError):
+            get_codec().decode(b"__import__('os').getcwd()")
+
+    def test_migrate(self):
+        connection = Mock()
+        connection.scan_iter.return_value = ["i:1", "i:2", "i:3", "i:4"]
+        connection.mget.side_effect = lambda keys: [
+            {"i:1": b"['sport']", "i:2": b'["music"]', "i:3": b"[a"}.get(k)
+            for k in keys
+        ]
+        pipe = connection.pipeline.return_value
+        stats = migrate(connection, JSONCodec(), batch=3)
+        self.assertEqual(stats, {"migrated": 1, "skipped": 1, "failed": 1})
+        pipe.set.assert_called_once_with("i:1", b'["sport"]', keepttl=True)
+        self.assertEqual(pipe.execute.call_count, 2)
+
+    def test_msgpack_migrate(self):
+        connection = Mock()
+        connection.scan_iter.return_value = ["i:1"]
+        connection.mget.return_value = [b"['sport']"]
+        pipe = connection.pipeline.return_value
+        migrate(connection, MsgpackCodec())
+        data = pipe.set.call_args.args[1]
+        self.assertEqual(get_codec("msgpack").decode(data), ["sport"])
+
+    @cases(
+        [
+            ([("localhost", 6379)], None),
+            ([("localhost", 6379)], [("localhost", 6380)]),
+            (TestShardedStore.nodes, None),
+        ]
+    )
+    def test_store_codec(self, nodes, replicas):
+        store = api.make_store(nodes, replicas, codec=get_codec("msgpack"))
+        values = [MsgpackCodec().encode(["sport"]), b"['music']"]
+        with patch.object(store, "get_many", return_value=values):
+            interests, errors = scoring.get_interests_many(store, [1, 2])
+        self.assertEqual(interests, {1: ["sport"], 2: ["music"]})
+        self.assertEqual(errors, {})
 
 
 if __name__ == "__main__":